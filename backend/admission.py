@@ -0,0 +1,260 @@
+import math
+import threading
+import time
+from collections import deque
+
+from flask import g, has_request_context, jsonify, request
+
+import metrics
+
+# Admission control for requests that process documents. Every POST and PUT
+# request is weighed by its upload size, or by the size of the stored document
+# it names, and again by its page count once the document has been parsed, and only runs while the weights of the running
+# requests fit in the slots of its lane. Requests that do not fit wait in a
+# short FIFO queue; when the queue is full, or a request has waited too long,
+# it is answered with 503 and Retry-After instead of tying up a worker thread.
+# Small uploads have a lane of their own, so they are never stuck behind large
+# ones. Limits apply per server process.
+REJECTED_MESSAGE = 'Server is busy, please try again later'
+DRAIN_CHUNK_BYTES = 64 * 1024
+
+
+def _discard(stream):
+    while stream.read(DRAIN_CHUNK_BYTES):
+        pass
+
+
+class _Waiter:
+    def __init__(self, weight):
+        self.weight = weight
+        self.admitted = False
+        self.event = threading.Event()
+
+
+class Lane:
+    def __init__(self, name, slots, queue_size):
+        self.name = name
+        self.slots = slots
+        self.queue_size = queue_size
+        self.in_use = 0
+        self.admitted = 0
+        self.rejected = {'queue full': 0, 'timeout': 0}
+        self._waiting = deque()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, weight):
+        # Takes the slots only if they are free and no one is waiting for them
+        with self._lock:
+            if self._waiting or self.in_use + weight > self.slots:
+                return False
+            self._take(weight)
+            return True
+
+    def acquire(self, weight, timeout):
+        # Returns None once the slots are taken, or the reason the request
+        # was turned away
+        with self._lock:
+            if not self._waiting and self.in_use + weight <= self.slots:
+                self._take(weight)
+                return None
+            if len(self._waiting) >= self.queue_size:
+                self.rejected['queue full'] += 1
+                return 'queue full'
+            waiter = _Waiter(weight)
+            self._waiting.append(waiter)
+            metrics.admission_queued.inc(self.name)
+
+        waiter.event.wait(timeout)
+        with self._lock:
+            if waiter.admitted:
+                return None
+            self._waiting.remove(waiter)
+            metrics.admission_queued.dec(self.name)
+            self.rejected['timeout'] += 1
+            # The request behind this one may fit where this one did not
+            self._admit_waiting()
+            return 'timeout'
+
+    def add(self, weight):
+        # A running request turned out to be heavier than estimated. It keeps
+        # running, and the lane stays over its slots until enough is released.
+        with self._lock:
+            self.in_use += weight
+            metrics.admission_slots_in_use.inc(self.name, amount=weight)
+
+    def release(self, weight):
+        with self._lock:
+            self.in_use -= weight
+            metrics.admission_slots_in_use.dec(self.name, amount=weight)
+            self._admit_waiting()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'inUse': self.in_use,
+                'queued': len(self._waiting),
+                'queueSize': self.queue_size,
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+            }
+
+    def _take(self, weight):
+        self.in_use += weight
+        self.admitted += 1
+        metrics.admission_slots_in_use.inc(self.name, amount=weight)
+
+    def _admit_waiting(self):
+        # Strictly in arrival order, so heavy requests are not starved by
+        # lighter ones that arrive after them
+        while self._waiting and self.in_use + self._waiting[0].weight <= self.slots:
+            waiter = self._waiting.popleft()
+            metrics.admission_queued.dec(self.name)
+            self._take(waiter.weight)
+            waiter.admitted = True
+            waiter.event.set()
+
+
+class Ticket:
+    # The slots held by one admitted request, released once its response has
+    # been sent
+    def __init__(self, lane, weight, heavy_lane=None):
+        self.lane = lane
+        self.weight = weight
+        # A request in the small lane that turns out to weigh more than one
+        # slot moves here, so the small lane stays free for small requests
+        self.heavy_lane = heavy_lane
+        self._released = False
+        self._lock = threading.Lock()
+
+    def reweigh(self, weight):
+        # Weights only ever go up: the upload size still counts for memory
+        with self._lock:
+            if self._released:
+                return
+            old_lane, old_weight = self.lane, self.weight
+            if weight > 1 and self.heavy_lane is not None:
+                self.lane, self.heavy_lane = self.heavy_lane, None
+            self.weight = min(max(weight, old_weight), self.lane.slots)
+            lane, weight = self.lane, self.weight
+        if lane is not old_lane:
+            lane.add(weight)
+            old_lane.release(old_weight)
+        elif weight > old_weight:
+            lane.add(weight - old_weight)
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.lane.release(self.weight)
+
+
+class AdmissionControl:
+    def __init__(self, slots=4, queue_size=6, queue_timeout=30, slot_bytes=32 * 1024 * 1024, slot_pages=1000,
+                 small_bytes=1024 * 1024, small_slots=2, small_queue_size=4, retry_after=10,
+                 drain_bytes=16 * 1024 * 1024):
+        self.main = Lane('main', slots, queue_size)
+        self.small = Lane('small', small_slots, small_queue_size) if small_slots > 0 else None
+        self.queue_timeout = queue_timeout
+        self.slot_bytes = slot_bytes
+        self.slot_pages = slot_pages
+        self.small_bytes = small_bytes
+        self.retry_after = retry_after
+        self.drain_bytes = drain_bytes
+
+    @property
+    def enabled(self):
+        return self.main.slots > 0
+
+    def bytes_weight(self, content_length):
+        # Uploads of unknown length count as the largest
+        if content_length is None:
+            return self.main.slots
+        return max(1, min(math.ceil(content_length / self.slot_bytes), self.main.slots))
+
+    def pages_weight(self, pages):
+        return max(1, math.ceil(pages / self.slot_pages))
+
+    def admit(self, content_length, light=False):
+        # Returns (ticket, None), or (None, reason) when the request is turned away
+        weight = 1 if light else self.bytes_weight(content_length)
+        if self.small is not None and content_length is not None and content_length <= self.small_bytes:
+            # Small requests may also borrow an idle slot of the main lane
+            if self.small.try_acquire(1):
+                return Ticket(self.small, 1, heavy_lane=self.main), None
+            if self.main.try_acquire(1):
+                return Ticket(self.main, 1), None
+            reason = self.small.acquire(1, self.queue_timeout)
+            if reason is not None:
+                return None, reason
+            return Ticket(self.small, 1, heavy_lane=self.main), None
+        reason = self.main.acquire(weight, self.queue_timeout)
+        if reason is not None:
+            return None, reason
+        return Ticket(self.main, weight), None
+
+    def record_bytes(self, size):
+        # Raises the weight of the current request once it turns out to read
+        # a document stored earlier, whose size its own body does not show
+        if not has_request_context():
+            return
+        ticket = g.get('admission_ticket')
+        if ticket is not None:
+            ticket.reweigh(self.bytes_weight(size))
+
+    def record_pages(self, pages):
+        # Raises the weight of the current request once its page count is known
+        if not has_request_context():
+            return
+        ticket = g.get('admission_ticket')
+        if ticket is not None and self.slot_pages > 0:
+            ticket.reweigh(self.pages_weight(pages))
+
+    def stats(self):
+        lanes = [self.main] + ([self.small] if self.small is not None else [])
+        return {lane.name: lane.stats() for lane in lanes}
+
+    def init_app(self, app, light_endpoints=()):
+        # Must be registered before any before_request function that reads
+        # the request body, so that turned away uploads are never parsed.
+        # light_endpoints only store their upload, so they weigh one slot.
+        @app.before_request
+        def admit_request():
+            if request.method not in ('POST', 'PUT') or not self.enabled:
+                return None
+            content_length = request.content_length
+            max_length = request.max_content_length
+            if content_length is not None and max_length is not None and content_length > max_length:
+                # Rejected with 413 as soon as the body is read, without reading it
+                return None
+            start = time.perf_counter()
+            ticket, reason = self.admit(content_length, light=request.endpoint in light_endpoints)
+            if ticket is None:
+                metrics.requests_rejected.inc(request.endpoint or 'unknown', reason)
+                if content_length is not None and content_length <= self.drain_bytes:
+                    # Servers close the connection on an unread body, and most
+                    # clients then report a reset instead of the 503
+                    _discard(request.stream)
+                response = jsonify({'error': REJECTED_MESSAGE})
+                response.headers['Retry-After'] = str(self.retry_after)
+                return response, 503
+            g.admission_ticket = ticket
+            g.queue_seconds = time.perf_counter() - start
+            return None
+
+        @app.after_request
+        def release_when_sent(response):
+            # Streamed responses are written after the handler has returned,
+            # so the slots are held until the response is closed
+            ticket = g.pop('admission_ticket', None)
+            if ticket is not None:
+                metrics.call_on_close(response, ticket.release)
+            return response
+
+        @app.teardown_request
+        def release_failed_request(error=None):
+            ticket = g.pop('admission_ticket', None)
+            if ticket is not None:
+                ticket.release()
@@ -0,0 +1,84 @@
+# Latency of small requests while large uploads keep the server busy, with
+# admission control on and off. The server runs in a fresh process per run,
+# threaded like a gthread worker, and is driven over HTTP.
+# Run from the backend directory: python -m benchmarks.admission --seconds 20
+import argparse
+import json
+import os
+import threading
+import time
+
+from benchmarks.measure import multipart, percentile, post, run_child
+from benchmarks.synthetic import text_pdf
+
+PORT = 5099
+
+
+def run(seconds, large_clients, large_pages, small_pages):
+    from werkzeug.serving import make_server
+    import pdf_server
+
+    server = make_server('127.0.0.1', PORT, pdf_server.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    large = multipart({'watermarkText': 'LARGE'}, {'file': ('large.pdf', text_pdf(large_pages))})
+    small = multipart({'watermarkText': 'SMALL'}, {'file': ('small.pdf', text_pdf(small_pages))})
+    deadline = time.monotonic() + seconds
+    statuses = {'large': {}, 'small': {}}
+    small_latency = []
+    lock = threading.Lock()
+
+    def client(kind, body):
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            status, _ = post(PORT, '/watermark-pdf', *body)
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[kind][status] = statuses[kind].get(status, 0) + 1
+                if kind == 'small' and status == 200:
+                    small_latency.append(elapsed)
+            if status == 503:
+                # A real client would honour Retry-After; wait a little instead
+                time.sleep(0.5)
+
+    threads = [threading.Thread(target=client, args=('large', large)) for _ in range(large_clients)]
+    threads.append(threading.Thread(target=client, args=('small', small)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    return {
+        'statuses': statuses,
+        'smallP50': percentile(small_latency, 0.5),
+        'smallP95': percentile(small_latency, 0.95),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure small request latency under load')
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--large-clients', type=int, default=12)
+    parser.add_argument('--large-pages', type=int, default=2000)
+    parser.add_argument('--small-pages', type=int, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.seconds, args.large_clients, args.large_pages, args.small_pages)))
+        return
+
+    print(f"{args.large_clients} clients posting {args.large_pages} pages, one posting {args.small_pages} pages, "
+          f"{args.seconds:.0f}s")
+    print(f"{'admission':<10} {'small p50':>10} {'small p95':>10} {'small ok':>9} {'large ok':>9} {'large 503':>10}")
+    for label, slots in [('off', '0'), ('on', os.getenv('ADMISSION_SLOTS', '4'))]:
+        env = dict(os.environ, ADMISSION_SLOTS=slots, REQUEST_LOG='false', RESULT_CACHE_BYTES='0')
+        row = run_child('benchmarks.admission', '--child', '--seconds', args.seconds, '--large-clients', args.large_clients,
+                        '--large-pages', args.large_pages, '--small-pages', args.small_pages, env=env)
+        large, small = row['statuses']['large'], row['statuses']['small']
+        print(f"{label:<10} {row['smallP50'] * 1000:>8.0f}ms {row['smallP95'] * 1000:>8.0f}ms "
+              f"{small.get('200', 0):>9} {large.get('200', 0):>9} {large.get('503', 0):>10}")
+
+
+if __name__ == '__main__':
+    main()
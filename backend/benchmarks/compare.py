@@ -0,0 +1,97 @@
+# Compare a benchmark result file with a stored baseline. Result files are
+# written by benchmarks.functions, benchmarks.load and benchmarks.startup; keep
+# one from a known good build (on the same machine) and compare later runs
+# against it.
+# Run from the backend directory:
+#   python -m benchmarks.compare benchmarks/results/baseline.json benchmarks/results/functions.json
+# Exits with status 1 when a metric regressed by more than the tolerance.
+import argparse
+import json
+import sys
+
+# Metric: (whether lower is better, changes smaller than this are noise)
+METRICS = {
+    'seconds': (True, 0.005),
+    'peakRssKb': (True, 1024),
+    'p50': (True, 0.005),
+    'p95': (True, 0.005),
+    'p99': (True, 0.005),
+    'throughput': (False, 0.1),
+    'rssKb': (True, 1024),
+    'pssKb': (True, 1024),
+    'privateKb': (True, 1024),
+}
+# Facts about the run that make results incomparable when they differ
+MACHINE_FIELDS = ('python', 'platform', 'cpus', 'engine')
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(baseline, current, tolerance=0.2):
+    # Returns (rows, regressions); a row is (name, metric, old, new, change, status)
+    rows = []
+    regressions = 0
+    for name, result in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            rows.append((name, None, None, None, None, 'new'))
+            continue
+        for metric, (lower_is_better, noise) in METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            worse = new > old if lower_is_better else new < old
+            if abs(new - old) <= noise or abs(change) <= tolerance:
+                status = ''
+            elif worse:
+                status = 'REGRESSION'
+                regressions += 1
+            else:
+                status = 'improved'
+            rows.append((name, metric, old, new, change, status))
+    for name in sorted(set(baseline['results']) - set(current['results'])):
+        rows.append((name, None, None, None, None, 'missing'))
+    return rows, regressions
+
+
+def print_comparison(baseline, current, tolerance=0.2, show_all=False):
+    # Prints the changes and returns the number of regressions
+    for field in MACHINE_FIELDS:
+        old, new = baseline.get('meta', {}).get(field), current.get('meta', {}).get(field)
+        if old != new:
+            print(f"warning: {field} differs from the baseline ({old} -> {new})")
+    rows, regressions = compare(baseline, current, tolerance)
+    print(f"{'result':<36} {'metric':<10} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, metric, old, new, change, status in rows:
+        if metric is None:
+            print(f"{name:<36} {status}")
+        elif status or show_all:
+            print(f"{name:<36} {metric:<10} {old:>12.4g} {new:>12.4g} {change:>+7.1%}  {status}")
+    print(f"{regressions} regression(s) beyond {tolerance:.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare benchmark results with a baseline')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change that counts (default 0.2)')
+    parser.add_argument('--all', action='store_true', help='show unchanged metrics too')
+    args = parser.parse_args()
+
+    regressions = print_comparison(load_results(args.baseline), load_results(args.current), args.tolerance, args.all)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Compare protect and unlock against the old page-by-page rewrite, which
+# copied every page into a new PdfWriter before encrypting or after decrypting.
+# Run from the backend directory: python -m benchmarks.encryption --pages 100 1000 10000
+import argparse
+import io
+import time
+
+from PyPDF2 import PdfReader, PdfWriter
+
+import pdf_engine
+from pdf_io import write_upload
+from pdf_server import protect_document, unlock_document
+from benchmarks.synthetic import text_pdf
+
+PASSWORD = 'benchmark'
+
+
+def rebuild(source, password=None, decrypt=None):
+    # The old path: every page copied into a new writer
+    reader = PdfReader(io.BytesIO(source))
+    if decrypt is not None:
+        reader.decrypt(decrypt)
+    writer = PdfWriter()
+    for page in reader.pages:
+        writer.add_page(page)
+    if password is not None:
+        writer.encrypt(password)
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def write(document):
+    output = io.BytesIO()
+    try:
+        document.write(output)
+    finally:
+        document.close()
+    return output.getvalue()
+
+
+def unlock(source, password):
+    document, error = unlock_document(io.BytesIO(source), password)
+    if error:
+        raise RuntimeError(error)
+    if not document.is_encrypted:
+        # What /unlock-pdf does with a document that is not encrypted
+        document.close()
+        output = io.BytesIO()
+        write_upload(io.BytesIO(source), output)
+        return output.getvalue()
+    return write(document)
+
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(output)
+
+
+def cases(source, protected, engines):
+    yield 'protect', 'rebuild', lambda: rebuild(source, PASSWORD)
+    for engine in engines:
+        yield 'protect', engine, lambda engine=engine: write(protect_document(io.BytesIO(source), PASSWORD, engine))
+    if 'pikepdf' in engines:
+        yield 'protect', 'pikepdf aes256', lambda: write(protect_document(io.BytesIO(source), PASSWORD, 'pikepdf', True))
+    yield 'unlock', 'rebuild', lambda: rebuild(protected, decrypt=PASSWORD)
+    for engine in engines:
+        yield 'unlock', engine, lambda engine=engine: unlock(protected, PASSWORD)
+    yield 'unlock plain', 'rebuild', lambda: rebuild(source)
+    yield 'unlock plain', 'pass-through', lambda: unlock(source, '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark protect and unlock')
+    parser.add_argument('--pages', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    engines = ['pypdf2']
+    if pdf_engine.pikepdf is not None:
+        engines.append('pikepdf')
+    else:
+        print("pikepdf is not installed, only PyPDF2 is measured")
+
+    print(f"{'pages':>6} {'operation':<13} {'path':<15} {'seconds':>9} {'speedup':>8} {'output':>10}")
+    for pages in args.pages:
+        source = text_pdf(pages)
+        protected = write(protect_document(io.BytesIO(source), PASSWORD, 'pypdf2'))
+        baseline = {}
+        for operation, path, function in cases(source, protected, engines):
+            seconds, output_size = timed(function, args.repeat)
+            baseline.setdefault(operation, seconds)
+            print(f"{pages:>6} {operation:<13} {path:<15} {seconds:>9.3f} "
+                  f"{baseline[operation] / seconds:>7.1f}x {output_size:>10}")
+
+
+if __name__ == '__main__':
+    main()
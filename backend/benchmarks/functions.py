@@ -0,0 +1,190 @@
+# Latency and peak memory of the functions behind the endpoints:
+# create_watermark_pdf, add_watermark (every page, or add_watermark_page for
+# the first page only), protect_document (encryption) and unlock_document
+# (decryption), on synthetic text, image and mixed page size documents. Every case runs in a fresh process so its peak RSS is its own.
+# Results are written as JSON and can be compared with a stored baseline.
+# Run from the backend directory:
+#   python -m benchmarks.functions --pages 1 100 1000 10000 --output benchmarks/results/functions.json
+#   python -m benchmarks.functions --baseline benchmarks/results/baseline.json
+# Output modes can be compared the same way:
+#   python -m benchmarks.functions --functions add_watermark_page --output-mode full --output benchmarks/results/full.json
+#   python -m benchmarks.functions --functions add_watermark_page --output-mode incremental --baseline benchmarks/results/full.json
+import argparse
+import gc
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import pdf_engine
+from benchmarks.compare import load_results, print_comparison, save_results
+from benchmarks.measure import CountingSink, current_rss_kb, peak_rss_kb, run_child, run_metadata
+from benchmarks.synthetic import logo_image, make_pdf
+
+FUNCTIONS = ['create_watermark_pdf', 'add_watermark', 'add_watermark_page', 'protect_document', 'unlock_document']
+KINDS = ['text', 'image', 'mixed']
+PASSWORD = 'benchmark'
+
+
+def prepare(function, variant, input_path, engine, temp_dir):
+    # Returns a function that makes one call and returns the output size
+    import pdf_server
+
+    if function == 'create_watermark_pdf':
+        # A stamp rendered from scratch, as for a new watermark
+        output_path = os.path.join(temp_dir, 'stamp.pdf')
+        content = 'CONFIDENTIAL' if variant == 'text' else input_path
+
+        def call():
+            pdf_server.stamp_cache.clear()
+            pdf_server.image_cache.clear()
+            if not pdf_server.create_watermark_pdf(variant, content, output_path):
+                raise RuntimeError('create_watermark_pdf failed')
+            return os.path.getsize(output_path)
+        return call
+
+    with open(input_path, 'rb') as f:
+        source = f.read()
+
+    if function in ('add_watermark', 'add_watermark_page'):
+        selected_pages = '1' if function == 'add_watermark_page' else 'all'
+
+        def stamp(pagesize):
+            return pdf_server.get_watermark_stamp('text', 'CONFIDENTIAL', 50, 0.3, 45, 'center', 100, pagesize)
+
+        def call():
+            sink = CountingSink()
+            if not pdf_server.add_watermark(io.BytesIO(source), stamp, sink, selected_pages=selected_pages,
+                                            engine=engine, workers=1):
+                raise RuntimeError('add_watermark failed')
+            return sink.size
+        return call
+
+    def call():
+        if function == 'protect_document':
+            document = pdf_server.protect_document(io.BytesIO(source), PASSWORD, engine)
+        else:
+            document, error = pdf_server.unlock_document(io.BytesIO(source), PASSWORD, engine)
+            if error:
+                raise RuntimeError(error)
+        sink = CountingSink()
+        try:
+            document.write(sink)
+        finally:
+            document.close()
+        return sink.size
+    return call
+
+
+def measure(function, variant, input_path, repeat, engine):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        call = prepare(function, variant, input_path, engine, temp_dir)
+        gc.collect()
+        baseline = current_rss_kb()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output_size = call()
+            timings.append(time.perf_counter() - start)
+            gc.collect()
+        peak = peak_rss_kb()
+    return {
+        'seconds': statistics.median(timings),
+        'secondsMin': min(timings),
+        'peakRssKb': peak - baseline,
+        'outputBytes': output_size,
+    }
+
+
+def protect_file(input_path, output_path):
+    document = pdf_engine.open_document(open(input_path, 'rb'), 'pypdf2')
+    try:
+        document.encrypt(PASSWORD, False)
+        with open(output_path, 'wb') as f:
+            document.write(f)
+    finally:
+        document.close()
+
+
+def cases(args, temp_dir):
+    # Yields (name, function, variant, input path, details), writing inputs as needed
+    if 'create_watermark_pdf' in args.functions:
+        image_path = os.path.join(temp_dir, 'logo.png')
+        with open(image_path, 'wb') as f:
+            f.write(logo_image(2000, 1500))
+        yield 'create_watermark_pdf/text', 'create_watermark_pdf', 'text', '', {}
+        yield 'create_watermark_pdf/image', 'create_watermark_pdf', 'image', image_path, {}
+
+    for kind in args.kinds:
+        for pages in (args.image_pages if kind == 'image' else args.pages):
+            input_path = os.path.join(temp_dir, f'{kind}-{pages}.pdf')
+            with open(input_path, 'wb') as f:
+                f.write(make_pdf(kind, pages))
+            details = {'kind': kind, 'pages': pages, 'inputBytes': os.path.getsize(input_path)}
+            for function in args.functions:
+                if function == 'create_watermark_pdf':
+                    continue
+                path = input_path
+                if function == 'unlock_document':
+                    path = os.path.join(temp_dir, f'{kind}-{pages}-protected.pdf')
+                    protect_file(input_path, path)
+                yield f'{function}/{kind}/{pages}', function, kind, path, details
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure latency and peak memory of the PDF functions')
+    parser.add_argument('--functions', nargs='+', choices=FUNCTIONS, default=FUNCTIONS)
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=KINDS)
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 100, 1000, 10000],
+                        help='page counts of text and mixed documents')
+    parser.add_argument('--image-pages', type=int, nargs='+', default=[1, 10, 100],
+                        help='page counts of image documents (about 340 KB a page)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--engine', choices=sorted(pdf_engine.ENGINES), default=None)
+    parser.add_argument('--output-mode', choices=['auto', 'full', 'incremental'], default=None,
+                        help='how watermarked documents are written (default: WATERMARK_OUTPUT_MODE)')
+    parser.add_argument('--output', default=os.path.join('benchmarks', 'results', 'functions.json'))
+    parser.add_argument('--baseline', help='result file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--child', nargs=4, metavar=('FUNCTION', 'VARIANT', 'INPUT', 'REPEAT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    engine = args.engine or os.getenv('PDF_ENGINE', 'pypdf2')
+    if engine == 'pikepdf' and pdf_engine.pikepdf is None:
+        engine = 'pypdf2'
+
+    if args.child:
+        function, variant, input_path, repeat = args.child
+        print(json.dumps(measure(function, variant, input_path, int(repeat), engine)))
+        return
+
+    env = dict(os.environ, PDF_ENGINE=engine, REQUEST_LOG='false')
+    output_mode = args.output_mode or os.getenv('WATERMARK_OUTPUT_MODE', 'auto')
+    env['WATERMARK_OUTPUT_MODE'] = output_mode
+    results = {}
+    print(f"{'result':<36} {'seconds':>9} {'min':>9} {'peak RSS (KiB)':>15} {'output':>11}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, function, variant, input_path, details in cases(args, temp_dir):
+            row = run_child('benchmarks.functions', '--child', function, variant, input_path or '-', args.repeat, env=env)
+            results[name] = dict(details, **row)
+            print(f"{name:<36} {row['seconds']:>9.3f} {row['secondsMin']:>9.3f} {row['peakRssKb']:>15} {row['outputBytes']:>11}")
+
+    report = {
+        'suite': 'functions',
+        'meta': run_metadata(engine, repeat=args.repeat, outputMode=output_mode),
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    save_results(args.output, report)
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        regressions = print_comparison(load_results(args.baseline), report, args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# Load test: runs the app under gunicorn, with the settings of gunicorn.conf.py
+# unless overridden, and drives it with concurrent local clients for a fixed
+# time, then reports p50/p95/p99 latency and throughput per endpoint. Results
+# are written as JSON and can be compared with a stored baseline, like those of
+# benchmarks.functions.
+# Run from the backend directory:
+#   python -m benchmarks.load --clients 8 --seconds 30 --pages 100
+#   python -m benchmarks.load --baseline benchmarks/results/load-baseline.json
+import argparse
+import io
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pdf_engine
+from benchmarks.compare import load_results, print_comparison, save_results
+from benchmarks.measure import multipart, percentile, post, run_metadata, wait_for_server
+from benchmarks.synthetic import make_pdf
+
+PASSWORD = 'benchmark'
+ENDPOINTS = {
+    'watermark': ('/watermark-pdf', {'watermarkText': 'CONFIDENTIAL'}),
+    'protect': ('/protect-pdf', {'password': PASSWORD}),
+    'unlock': ('/unlock-pdf', {'password': PASSWORD}),
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def protect(source):
+    document = pdf_engine.open_document(io.BytesIO(source), 'pypdf2')
+    try:
+        document.encrypt(PASSWORD, False)
+        output = io.BytesIO()
+        document.write(output)
+        return output.getvalue()
+    finally:
+        document.close()
+
+
+def start_server(port, args):
+    command = [sys.executable, '-m', 'gunicorn', 'pdf_server:app', '--bind', f'127.0.0.1:{port}']
+    if args.workers:
+        command += ['--workers', str(args.workers)]
+    if args.threads == 0:
+        command += ['--worker-class', 'sync']
+    elif args.threads:
+        command += ['--threads', str(args.threads)]
+    command += args.gunicorn_args.split()
+    env = dict(os.environ, REQUEST_LOG='false')
+    if not args.result_cache:
+        # Every request is processed, rather than served from the result cache
+        env['RESULT_CACHE_BYTES'] = '0'
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(port)
+    except OSError:
+        server.kill()
+        raise
+    return server
+
+
+def drive(port, requests, clients, seconds, warmup):
+    # Each client posts the requests in turn until the time is up. Requests
+    # that finish during the warm-up are not recorded.
+    start = time.monotonic()
+    record_from = start + warmup
+    deadline = record_from + seconds
+    samples = {name: [] for name in requests}
+    statuses = {name: {} for name in requests}
+    lock = threading.Lock()
+
+    def client(offset):
+        names = list(requests)
+        i = offset
+        while time.monotonic() < deadline:
+            name = names[i % len(names)]
+            i += 1
+            path, body, content_type = requests[name]
+            sent = time.perf_counter()
+            try:
+                status, _ = post(port, path, body, content_type)
+            except OSError:
+                status = 'error'
+            elapsed = time.perf_counter() - sent
+            if time.monotonic() < record_from:
+                continue
+            with lock:
+                statuses[name][str(status)] = statuses[name].get(str(status), 0) + 1
+                if status == 200:
+                    samples[name].append(elapsed)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Requests still running at the deadline are counted when they finish
+    elapsed = time.monotonic() - record_from
+    return samples, statuses, elapsed
+
+
+def summarize(latencies, statuses, elapsed):
+    return {
+        'requests': sum(statuses.values()),
+        'statuses': statuses,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'throughput': len(latencies) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the PDF server under gunicorn')
+    parser.add_argument('--endpoints', nargs='+', choices=sorted(ENDPOINTS), default=sorted(ENDPOINTS))
+    parser.add_argument('--kind', choices=['text', 'image', 'mixed'], default='text')
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--workers', type=int, default=None, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=None, help='threads per gthread worker (0 for sync workers)')
+    parser.add_argument('--gunicorn-args', default='', help='more gunicorn options, as one string')
+    parser.add_argument('--result-cache', action='store_true', help='leave the result cache on')
+    parser.add_argument('--output', default=os.path.join('benchmarks', 'results', 'load.json'))
+    parser.add_argument('--baseline', help='result file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    source = make_pdf(args.kind, args.pages)
+    protected = protect(source)
+    requests = {}
+    for name in args.endpoints:
+        path, fields = ENDPOINTS[name]
+        content = protected if name == 'unlock' else source
+        requests[name] = (path, *multipart(fields, {'file': ('input.pdf', content)}))
+
+    port = free_port()
+    server = start_server(port, args)
+    try:
+        samples, statuses, elapsed = drive(port, requests, args.clients, args.seconds, args.warmup)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+    label = f'{args.kind}/{args.pages}'
+    results = {f'load/{name}/{label}': summarize(samples[name], statuses[name], elapsed) for name in requests}
+    all_statuses = {}
+    for counts in statuses.values():
+        for status, count in counts.items():
+            all_statuses[status] = all_statuses.get(status, 0) + count
+    results[f'load/all/{label}'] = summarize(
+        [latency for latencies in samples.values() for latency in latencies], all_statuses, elapsed)
+
+    print(f"{args.clients} clients, {args.seconds:.0f}s, {args.kind} PDF of {args.pages} pages ({len(source)} bytes)")
+    print(f"{'result':<28} {'requests':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>7}  statuses")
+    for name, result in results.items():
+        latencies = [result[p] for p in ('p50', 'p95', 'p99')]
+        text = ' '.join(f"{v * 1000:>6.0f}ms" if v is not None else f"{'-':>8}" for v in latencies)
+        print(f"{name:<28} {result['requests']:>8} {text} {result['throughput']:>7.2f}  {result['statuses']}")
+
+    engine = os.getenv('PDF_ENGINE', 'pypdf2')
+    if engine == 'pikepdf' and pdf_engine.pikepdf is None:
+        engine = 'pypdf2'
+    report = {
+        'suite': 'load',
+        'meta': run_metadata(engine, clients=args.clients, seconds=args.seconds, workers=args.workers,
+                             threads=args.threads, gunicornArgs=args.gunicorn_args),
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    save_results(args.output, report)
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        regressions = print_comparison(load_results(args.baseline), report, args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
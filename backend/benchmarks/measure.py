@@ -0,0 +1,136 @@
+# Helpers shared by the benchmarks: memory readings, an output sink that only
+# counts bytes, child processes that report one JSON line, and a small HTTP
+# client for benchmarks that drive a running server.
+import datetime
+import http.client
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import uuid
+
+
+def _status_kb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def current_rss_kb():
+    # The peak is a high-water mark, so the starting point is the current RSS
+    rss = _status_kb('VmRSS:')
+    return rss if rss is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def peak_rss_kb():
+    # VmHWM starts again in every new program. ru_maxrss does not on Linux:
+    # it keeps the parent's peak, such as generating a large input.
+    peak = _status_kb('VmHWM:')
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class CountingSink:
+    # Output stream that keeps nothing, so writing the output costs no memory
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+
+def run_metadata(engine, **extra):
+    # Where and on what the results were measured, stored with the results
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'engine': engine,
+        'commit': commit or None,
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        **extra,
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_child(module, *args, env=None):
+    # Runs python -m module args in a fresh process and returns the JSON
+    # object printed on its last line
+    result = subprocess.run(
+        [sys.executable, '-m', module, *[str(arg) for arg in args]],
+        capture_output=True, text=True, env=env
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{module} {' '.join(str(arg) for arg in args)} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def multipart(fields, files):
+    # files maps a field name to (file name, content)
+    boundary = uuid.uuid4().hex
+    body = bytearray()
+    for name, value in fields.items():
+        body += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+    for name, (file_name, content) in files.items():
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{file_name}"\r\n'
+                 f'Content-Type: application/pdf\r\n\r\n').encode()
+        body += content + b'\r\n'
+    body += f'--{boundary}--\r\n'.encode()
+    return bytes(body), f'multipart/form-data; boundary={boundary}'
+
+
+def post(port, path, body, content_type, timeout=600):
+    # Returns (status, response size); the response is read and dropped
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        connection.request('POST', path, body=body, headers={'Content-Type': content_type})
+        response = connection.getresponse()
+        size = 0
+        while True:
+            chunk = response.read(256 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+        return response.status, size
+    finally:
+        connection.close()
+
+
+def wait_for_server(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        try:
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+        finally:
+            connection.close()
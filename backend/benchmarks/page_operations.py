@@ -0,0 +1,90 @@
+# Peak RSS and time of the page operations behind /extract-pages,
+# /remove-pages, /rotate-pdf, /split-pdf and /merge-pdf, each measured in a
+# fresh process. The input is read from a file, like a large upload that has
+# been spilled to disk. (The server maps such uploads into memory; the page
+# cache pages that the mapping touches show up in RSS but can be reclaimed.)
+# Run from the backend directory: python -m benchmarks.page_operations --pages 2000
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.measure import CountingSink, current_rss_kb, peak_rss_kb, run_child
+from benchmarks.synthetic import image_pdf, text_pdf
+
+OPERATIONS = ['extract', 'remove', 'rotate', 'split', 'merge', 'copy all']
+
+
+def run(operation, document, input_path):
+    import pdf_server
+    from pdf_engine import open_document
+
+    sink = CountingSink()
+    if operation == 'split':
+        parts = [list(range(start, min(start + 100, document.page_count))) for start in range(0, document.page_count, 100)]
+        pdf_server.write_split_archive(sink, document, parts, 'input')
+        return sink.size
+    if operation == 'rotate':
+        output = document
+        output.rotate_page(0, 90)
+    elif operation == 'merge':
+        other = open_document(open(input_path, 'rb'), pdf_server.PDF_ENGINE)
+        output = document
+        output.append(other)
+    else:
+        indexes = {
+            'extract': range(10),
+            'remove': range(10, document.page_count),
+            'copy all': range(document.page_count),
+        }[operation]
+        output = document.select_pages(indexes)
+    output.write(sink)
+    return sink.size
+
+
+def measure(operation, input_path):
+    import pdf_server
+    from pdf_engine import open_document
+
+    baseline = current_rss_kb()
+    start = time.perf_counter()
+    document = open_document(open(input_path, 'rb'), pdf_server.PDF_ENGINE)
+    output_size = run(operation, document, input_path)
+    seconds = time.perf_counter() - start
+    peak = peak_rss_kb()
+    return {
+        'operation': operation,
+        'seconds': seconds,
+        'outputBytes': output_size,
+        'rssKb': peak - baseline,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure peak RSS of page operations')
+    parser.add_argument('--pages', type=int, nargs='+', default=[200, 2000])
+    parser.add_argument('--kind', choices=['text', 'image'], default='image')
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument('--child', nargs=2, metavar=('OPERATION', 'INPUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(*args.child)))
+        return
+
+    print(f"{'pages':>6} {'input':>10} {'operation':>10} {'seconds':>8} {'output':>11} {'RSS (KiB)':>10}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for pages in args.pages:
+            input_path = os.path.join(temp_dir, f'{pages}.pdf')
+            with open(input_path, 'wb') as f:
+                f.write(text_pdf(pages) if args.kind == 'text' else image_pdf(pages))
+            input_size = os.path.getsize(input_path)
+            for operation in args.operations:
+                row = run_child('benchmarks.page_operations', '--child', operation, input_path)
+                print(f"{pages:>6} {input_size:>10} {operation:>10} {row['seconds']:>8.2f} "
+                      f"{row['outputBytes']:>11} {row['rssKb']:>10}")
+
+
+if __name__ == '__main__':
+    main()
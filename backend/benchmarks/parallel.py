@@ -0,0 +1,51 @@
+# Wall-clock scaling of parallel watermarking from 1 to N worker processes.
+# Parallel watermarking is only used in merge mode.
+# Run from the backend directory: python -m benchmarks.parallel --pages 10000
+import argparse
+import functools
+import io
+import os
+import time
+
+import pdf_server
+from pdf_server import add_watermark, get_process_pool, get_watermark_stamp
+from benchmarks.synthetic import text_pdf
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parallel watermarking')
+    parser.add_argument('--pages', type=int, default=10000)
+    parser.add_argument('--workers', type=int, nargs='+', default=None)
+    parser.add_argument('--mode', choices=['xobject', 'merge'], default='merge')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    # Measure the parallel path whatever threshold is configured
+    pdf_server.WATERMARK_PARALLEL_PAGES = 1
+    cpus = os.cpu_count() or 1
+    workers = args.workers or sorted({1, 2, 4, 8, 16, cpus} & set(range(1, cpus + 1)))
+    source = text_pdf(args.pages)
+    render_stamp = functools.partial(get_watermark_stamp, 'text', 'CONFIDENTIAL', 50, 0.3, 45, 'center', 100)
+    print(f"{args.pages} pages, {len(source)} bytes, {args.mode} mode, {cpus} CPUs")
+
+    print(f"{'workers':>7} {'seconds':>9} {'speedup':>8} {'output':>10}")
+    baseline = None
+    for count in workers:
+        if count > 1:
+            # Start the pool outside the timed runs, as a server would have done
+            pool = get_process_pool(count)
+            list(pool.map(abs, range(count)))
+        timings = []
+        for _ in range(args.repeat):
+            output = io.BytesIO()
+            start = time.perf_counter()
+            if not add_watermark(io.BytesIO(source), render_stamp, output, 'above', 'all', args.mode, workers=count):
+                raise RuntimeError(f"add_watermark failed with {count} workers")
+            timings.append(time.perf_counter() - start)
+        seconds = min(timings)
+        baseline = baseline or seconds
+        print(f"{count:>7} {seconds:>9.2f} {baseline / seconds:>7.2f}x {len(output.getvalue()):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# Peak RSS of a single request to each endpoint, measured in a fresh process
+# per run so earlier requests do not hide the high-water mark.
+# Run from the backend directory: python -m benchmarks.request_memory --pages 2000
+import argparse
+import io
+import json
+import os
+import tempfile
+
+from benchmarks.measure import current_rss_kb, peak_rss_kb, run_child
+from benchmarks.synthetic import image_pdf, text_pdf
+
+ENDPOINTS = {
+    'watermark': ('/watermark-pdf', {'watermarkText': 'CONFIDENTIAL'}),
+    'protect': ('/protect-pdf', {'password': 'secret'}),
+    'unlock': ('/unlock-pdf', {'password': ''}),
+    'extract': ('/extract-pages', {'selectedPages': '1-10'}),
+    'remove': ('/remove-pages', {'selectedPages': '1-10'}),
+    'rotate': ('/rotate-pdf', {'angle': '90', 'selectedPages': '1'}),
+    'split': ('/split-pdf', {'everyPages': '100'}),
+    # Merges the input with a copy of itself
+    'merge': ('/merge-pdf', {}),
+}
+
+
+def measure(endpoint, input_path):
+    # Merging the largest inputs posts more than the default upload limit
+    os.environ.setdefault('MAX_CONTENT_LENGTH', '0')
+    import pdf_server
+
+    url, fields = ENDPOINTS[endpoint]
+    with open(input_path, 'rb') as f:
+        source = f.read()
+    client = pdf_server.app.test_client()
+    baseline = current_rss_kb()
+
+    data = dict(fields)
+    if endpoint == 'merge':
+        data['files'] = [(io.BytesIO(source), 'input.pdf'), (io.BytesIO(source), 'copy.pdf')]
+    else:
+        data['file'] = (io.BytesIO(source), 'input.pdf')
+    response = client.post(url, data=data, content_type='multipart/form-data')
+    output_size = 0
+    for chunk in response.response:
+        output_size += len(chunk)
+    response.close()
+
+    peak = peak_rss_kb()
+    return {
+        'endpoint': endpoint,
+        'status': response.status_code,
+        'inputBytes': len(source),
+        'outputBytes': output_size,
+        'baselineRssKb': baseline,
+        'peakRssKb': peak,
+        'requestRssKb': peak - baseline,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure peak RSS per request')
+    parser.add_argument('--pages', type=int, nargs='+', default=[100, 2000])
+    parser.add_argument('--kind', choices=['text', 'image'], default='text')
+    parser.add_argument('--endpoints', nargs='+', choices=sorted(ENDPOINTS), default=sorted(ENDPOINTS))
+    parser.add_argument('--child', nargs=2, metavar=('ENDPOINT', 'INPUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(*args.child)))
+        return
+
+    print(f"{'pages':>6} {'endpoint':>10} {'input':>10} {'output':>10} {'request RSS (KiB)':>18}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for pages in args.pages:
+            input_path = os.path.join(temp_dir, f'{pages}.pdf')
+            with open(input_path, 'wb') as f:
+                f.write(text_pdf(pages) if args.kind == 'text' else image_pdf(pages))
+            for endpoint in args.endpoints:
+                row = run_child('benchmarks.request_memory', '--child', endpoint, input_path)
+                print(f"{pages:>6} {endpoint:>10} {row['inputBytes']:>10} {row['outputBytes']:>10} {row['requestRssKb']:>18}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# Compare the per-page merge_page path with the shared Form XObject path.
+# Run from the backend directory: python -m benchmarks.stamping --pages 10 2000
+import argparse
+import io
+import os
+import tempfile
+import time
+
+from pdf_server import add_watermark, get_watermark_stamp
+from benchmarks.synthetic import text_pdf
+
+
+def run(pages, layer, repeat, engine=None):
+    source = text_pdf(pages)
+    stamp = get_watermark_stamp('text', 'CONFIDENTIAL', 50, 0.3, 45, 'center')
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = os.path.join(temp_dir, 'out.pdf')
+        for mode in ('merge', 'xobject'):
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                if not add_watermark(io.BytesIO(source), io.BytesIO(stamp), output_path, layer, 'all', mode, engine):
+                    raise RuntimeError(f"add_watermark failed in {mode} mode")
+                timings.append(time.perf_counter() - start)
+            results[mode] = (min(timings), os.path.getsize(output_path))
+    return len(source), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark watermark stamping modes')
+    parser.add_argument('--pages', type=int, nargs='+', default=[10, 200, 2000])
+    parser.add_argument('--layer', choices=['above', 'below'], default='above')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--engine', choices=['pypdf2', 'pikepdf'], default=None)
+    args = parser.parse_args()
+
+    print(f"{'pages':>6} {'input':>10} {'mode':>8} {'seconds':>9} {'output':>10}")
+    for pages in args.pages:
+        input_size, results = run(pages, args.layer, args.repeat, args.engine)
+        for mode, (seconds, output_size) in results.items():
+            print(f"{pages:>6} {input_size:>10} {mode:>8} {seconds:>9.3f} {output_size:>10}")
+        speedup = results['merge'][0] / results['xobject'][0]
+        print(f"{'':>6} xobject is {speedup:.1f}x faster, "
+              f"{results['xobject'][1] / results['merge'][1]:.2f}x the output size")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# Startup cost and worker memory under gunicorn: how long importing pdf_server
+# takes, how long the server takes to answer its first health check, the
+# latency of the first watermark request, and the RSS, PSS (RSS with shared
+# pages split between the processes sharing them) and private memory of the
+# workers after they have served some requests.
+# Run from the backend directory:
+#   python -m benchmarks.startup --workers 4
+# To measure another checkout, such as the previous commit, with its own
+# gunicorn settings:
+#   python -m benchmarks.startup --app-dir /tmp/before/backend --gunicorn-args "--worker-class gthread --threads 16"
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from benchmarks.compare import load_results, print_comparison, save_results
+from benchmarks.load import free_port
+from benchmarks.measure import multipart, post, run_metadata, wait_for_server
+from benchmarks.synthetic import text_pdf
+
+IMPORT_SCRIPT = 'import time; start = time.perf_counter(); import pdf_server; print(time.perf_counter() - start)'
+
+
+def import_seconds(app_dir, env, repeat):
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=app_dir, env=env,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"importing pdf_server failed:\n{result.stderr}")
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return statistics.median(timings)
+
+
+def memory_kb(pid):
+    # Rss, Pss and private memory of a process, from /proc (Linux only)
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rssKb': fields.get('Rss', 0),
+        'pssKb': fields.get('Pss', 0),
+        'privateKb': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+    }
+
+
+def children(pid):
+    found = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # The command name is in brackets and may contain spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            found.append(int(name))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold start and worker memory under gunicorn')
+    parser.add_argument('--app-dir', default='.', help='backend directory to run (default: this one)')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--gunicorn-args', default='', help='more gunicorn options, as one string')
+    parser.add_argument('--requests', type=int, default=40, help='watermark requests served before measuring memory')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3, help='imports to time')
+    parser.add_argument('--output', default=os.path.join('benchmarks', 'results', 'startup.json'))
+    parser.add_argument('--baseline', help='result file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    app_dir = os.path.abspath(args.app_dir)
+    env = dict(os.environ, REQUEST_LOG='false', RESULT_CACHE_BYTES='0')
+    results = {'startup/import': {'seconds': import_seconds(app_dir, env, args.repeat)}}
+
+    # gunicorn reads gunicorn.conf.py from its working directory when there is one
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', 'pdf_server:app', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(args.workers), *args.gunicorn_args.split()]
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=app_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(port, timeout=60)
+        results['startup/ready'] = {'seconds': time.perf_counter() - started}
+
+        body = multipart({'watermarkText': 'STARTUP'}, {'file': ('input.pdf', text_pdf(args.pages))})
+        sent = time.perf_counter()
+        status, _ = post(port, '/watermark-pdf', *body)
+        if status != 200:
+            raise RuntimeError(f'first request failed with status {status}')
+        results['startup/first-request'] = {'seconds': time.perf_counter() - sent}
+
+        remaining = [args.requests]
+        lock = threading.Lock()
+
+        def client():
+            while True:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                post(port, '/watermark-pdf', *body)
+
+        threads = [threading.Thread(target=client) for _ in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        master = memory_kb(server.pid)
+        workers = [memory_kb(pid) for pid in children(server.pid)]
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+
+    results['startup/master'] = master
+    for field in ('rssKb', 'pssKb', 'privateKb'):
+        results.setdefault('startup/worker', {})[field] = statistics.median(w[field] for w in workers)
+    results['startup/all-processes'] = {'pssKb': master['pssKb'] + sum(w['pssKb'] for w in workers)}
+
+    print(f"{args.workers} workers, {args.gunicorn_args or 'default gunicorn options'} in {app_dir}")
+    for name, result in results.items():
+        text = ', '.join(f"{key} {value:.3f}" if key == 'seconds' else f"{key} {value:.0f}"
+                         for key, value in result.items())
+        print(f"{name:<24} {text}")
+
+    report = {
+        'suite': 'startup',
+        'meta': run_metadata(os.getenv('PDF_ENGINE', 'pypdf2'), workers=args.workers,
+                             gunicornArgs=args.gunicorn_args, appDir=app_dir),
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    save_results(args.output, report)
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        regressions = print_comparison(load_results(args.baseline), report, args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import io
+import os
+
+from PIL import Image, ImageDraw
+from reportlab.lib.pagesizes import A4, landscape, legal, letter
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+
+# Page sizes of a document put together from several sources
+MIXED_PAGE_SIZES = (letter, A4, landscape(letter), legal)
+
+
+# Synthetic documents for the benchmarks, generated locally with ReportLab
+def text_pdf(pages, pagesizes=(letter,), lines=40):
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer)
+    for i in range(pages):
+        page_width, page_height = pagesizes[i % len(pagesizes)]
+        c.setPageSize((page_width, page_height))
+        c.setFont("Helvetica", 10)
+        y = page_height - 72
+        for line in range(lines):
+            c.drawString(72, y, f"Page {i + 1}, line {line + 1}: the quick brown fox jumps over the lazy dog")
+            y -= 14
+            if y < 72:
+                break
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def image_pdf(pages, pagesizes=(letter,), image_px=600):
+    # Every page gets its own noise image so nothing is shared or compressible
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer)
+    for i in range(pages):
+        page_width, page_height = pagesizes[i % len(pagesizes)]
+        c.setPageSize((page_width, page_height))
+        image = Image.frombytes('RGB', (image_px, image_px), os.urandom(image_px * image_px * 3))
+        jpeg = io.BytesIO()
+        image.save(jpeg, 'JPEG', quality=85)
+        jpeg.seek(0)
+        c.drawImage(ImageReader(jpeg), 72, 72, width=page_width - 144, height=page_height - 144)
+        c.drawString(72, 48, f"Page {i + 1}")
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def logo_image(width, height, format='PNG', alpha=True):
+    # A flat-colour logo on a transparent (or white) background, the kind of
+    # image that is uploaded as a watermark, encoded as PNG or JPEG
+    mode = 'RGBA' if alpha else 'RGB'
+    image = Image.new(mode, (width, height), (255, 255, 255, 0) if alpha else (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((width // 10, height // 10, width * 9 // 10, height * 9 // 10), fill=(200, 30, 40))
+    draw.rectangle((width // 4, height * 2 // 5, width * 3 // 4, height * 3 // 5), fill=(255, 255, 255))
+    for i in range(0, width, max(1, width // 40)):
+        draw.line((i, 0, width - i, height), fill=(20, 60, 160), width=max(1, width // 400))
+    buffer = io.BytesIO()
+    image.save(buffer, format, **({'quality': 90} if format == 'JPEG' else {}))
+    return buffer.getvalue()
+
+
+def make_pdf(kind, pages):
+    # 'text', 'image' (a noise image on every page) or 'mixed' (text in mixed page sizes)
+    if kind == 'image':
+        return image_pdf(pages)
+    if kind == 'mixed':
+        return text_pdf(pages, pagesizes=MIXED_PAGE_SIZES)
+    return text_pdf(pages)
@@ -0,0 +1,53 @@
+# Compare a per-page watermark template with a static text watermark.
+# Run from the backend directory: python -m benchmarks.templates --pages 5000
+import argparse
+import functools
+import io
+import time
+
+from pdf_server import add_watermark, get_watermark_stamp
+from watermark_template import WatermarkTemplate, parse_template
+from benchmarks.synthetic import text_pdf
+
+TEMPLATE = 'Copy for {user} - page {n} of {total}'
+
+
+def run(source, watermark, mode, repeat):
+    timings = []
+    for _ in range(repeat):
+        output = io.BytesIO()
+        start = time.perf_counter()
+        if not add_watermark(io.BytesIO(source), watermark, output, 'above', 'all', mode, workers=1):
+            raise RuntimeError(f"add_watermark failed in {mode} mode")
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(output.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark per-page watermark templates')
+    parser.add_argument('--pages', type=int, nargs='+', default=[500, 5000])
+    parser.add_argument('--mode', choices=['xobject', 'merge'], nargs='+', default=['xobject', 'merge'])
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    runs, _ = parse_template(TEMPLATE, {'user': 'Alice Example'})
+    watermarks = {
+        'static': functools.partial(get_watermark_stamp, 'text', 'Copy for Alice Example', 30, 0.3, 45, 'center', 100),
+        'template': WatermarkTemplate(runs, 30, 0.3, 45, 'center'),
+    }
+
+    print(f"{'pages':>6} {'mode':>8} {'watermark':>9} {'seconds':>9} {'output':>10}")
+    for pages in args.pages:
+        source = text_pdf(pages)
+        for mode in args.mode:
+            results = {}
+            for name, watermark in watermarks.items():
+                results[name] = run(source, watermark, mode, args.repeat)
+                seconds, output_size = results[name]
+                print(f"{pages:>6} {mode:>8} {name:>9} {seconds:>9.2f} {output_size:>10}")
+            print(f"{'':>6} template takes {results['template'][0] / results['static'][0]:.2f}x the time "
+                  f"and {results['template'][1] / results['static'][1]:.2f}x the output size")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# Compare image watermarks prepared for their placed size with the old path,
+# which drew the full-resolution upload through ImageReader on every render.
+# Run from the backend directory: python -m benchmarks.watermark_images --pages 20
+import argparse
+import io
+import time
+
+from PIL import Image
+from reportlab.lib.pagesizes import A4, letter
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+import pdf_server
+from pdf_server import add_watermark, render_watermark_stamp, stamp_position
+from benchmarks.synthetic import logo_image, text_pdf
+
+IMAGES = {
+    'png alpha': lambda width, height: logo_image(width, height, 'PNG', alpha=True),
+    'png opaque': lambda width, height: logo_image(width, height, 'PNG', alpha=False),
+    'jpeg': lambda width, height: logo_image(width, height, 'JPEG', alpha=False),
+}
+
+
+def render_original(content, opacity, rotation, position, image_size, pagesize):
+    # The stamp as it was rendered before images were prepared
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=pagesize)
+    img = Image.open(io.BytesIO(content))
+    new_width = img.size[0] * image_size / 100.0
+    new_height = img.size[1] * image_size / 100.0
+    x, y = stamp_position(position, pagesize[0], pagesize[1], new_width, new_height)
+    c.saveState()
+    c.translate(x + new_width / 2, y + new_height / 2)
+    c.rotate(rotation)
+    c.drawImage(ImageReader(img), -new_width / 2, -new_height / 2, width=new_width, height=new_height, mask='auto')
+    c.restoreState()
+    c.save()
+    return buffer.getvalue()
+
+
+def render_prepared(content, opacity, rotation, position, image_size, pagesize):
+    return render_watermark_stamp('image', content, 50, opacity, rotation, position, image_size, pagesize)
+
+
+def watermark(source, render, content, image_size):
+    # A document with two page sizes needs two stamps, as in a request
+    stamps = {}
+
+    def stamp(pagesize=letter):
+        key = tuple(pagesize)
+        if key not in stamps:
+            stamps[key] = render(content, 0.3, 45, 'center', image_size, pagesize)
+        return stamps[key]
+
+    output = io.BytesIO()
+    if not add_watermark(io.BytesIO(source), stamp, output, 'above', 'all', 'xobject', workers=1):
+        raise RuntimeError('add_watermark failed')
+    return output.getvalue()
+
+
+def timed(function, repeat, before=None):
+    timings = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        output = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image watermark preparation')
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--image', type=int, nargs=2, default=[6000, 4000], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--image-size', type=int, nargs='+', default=[5, 20],
+                        help='placed size in percent of one point per pixel')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    source = text_pdf(args.pages, pagesizes=(letter, A4))
+    print(f"watermark {args.image[0]}x{args.image[1]} on {args.pages} pages (letter and A4), "
+          f"{pdf_server.WATERMARK_IMAGE_DPI} dpi")
+    print(f"{'image':<11} {'size':>5} {'path':<16} {'seconds':>9} {'output':>10}")
+    for name, make in IMAGES.items():
+        content = make(*args.image)
+        for image_size in args.image_size:
+            cases = [
+                ('original', render_original, None),
+                # Every request prepares the image again
+                ('prepared cold', render_prepared, pdf_server.image_cache.clear),
+                # Same image in a later request, stamps for new options
+                ('prepared cached', render_prepared, None),
+            ]
+            baseline = None
+            for path, render, before in cases:
+                seconds, output_size = timed(lambda: watermark(source, render, content, image_size), args.repeat, before)
+                baseline = baseline or (seconds, output_size)
+                print(f"{name:<11} {image_size:>4}% {path:<16} {seconds:>9.3f} {output_size:>10}"
+                      f"   {baseline[0] / seconds:>5.1f}x faster, {output_size / baseline[1]:.2f}x size")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+# Uploaded documents kept on disk for a while, so that later requests can
+# refer to them by id instead of uploading them again. Each document is a
+# directory holding the document, a meta.json file and files derived from
+# the document, such as single pages. Like jobs, documents live on disk so
+# that every server process can find them. A document is removed ttl seconds
+# after it was last used, and the least recently used go first once the
+# store holds more than max_bytes.
+DOCUMENT_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+DOCUMENT_FILE = 'document.pdf'
+META_FILE = 'meta.json'
+
+
+def _read_meta(document_dir):
+    try:
+        with open(os.path.join(document_dir, META_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_file(path, write):
+    # Replace the file in one step so readers never see a partial write
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _dir_size(path):
+    size = 0
+    for name in os.listdir(path):
+        try:
+            size += os.path.getsize(os.path.join(path, name))
+        except OSError:
+            pass
+    return size
+
+
+class DocumentStore:
+    def __init__(self, root=None, ttl=1800, max_bytes=4 * 1024 * 1024 * 1024, cleanup_interval=60):
+        self.root = root or os.path.join(tempfile.gettempdir(), 'zenpdf-documents')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.cleanup_interval = cleanup_interval
+        self._last_cleanup = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def document_dir(self, document_id):
+        if not document_id or not DOCUMENT_ID_PATTERN.match(document_id):
+            return None
+        return os.path.join(self.root, document_id)
+
+    def file_path(self, document_id, name=DOCUMENT_FILE):
+        # Path of the document, or of a file derived from it
+        document_dir = self.document_dir(document_id)
+        if document_dir is None:
+            return None
+        return os.path.join(document_dir, name)
+
+    def put(self, upload, file_name):
+        # Stores an upload and returns its meta data, which includes its id
+        return self._add(uuid.uuid4().hex, file_name, upload.save)
+
+    def put_file(self, path, file_name, document_id=None):
+        # Moves a file that is already on disk, such as a finished chunked
+        # upload, into the store without copying it where possible
+        return self._add(document_id or uuid.uuid4().hex, file_name, lambda target: shutil.move(path, target))
+
+    def _add(self, document_id, file_name, save):
+        self.cleanup()
+        document_dir = self.document_dir(document_id)
+        os.makedirs(document_dir)
+        try:
+            save(os.path.join(document_dir, DOCUMENT_FILE))
+            meta = {
+                'id': document_id,
+                'fileName': file_name,
+                'bytes': os.path.getsize(os.path.join(document_dir, DOCUMENT_FILE)),
+                'createdAt': time.time(),
+            }
+            self._write_meta(document_dir, meta)
+        except Exception:
+            shutil.rmtree(document_dir, ignore_errors=True)
+            raise
+        return meta
+
+    def get(self, document_id):
+        # Returns a document's meta data, or None when it is unknown or has
+        # expired. Looking a document up counts as using it.
+        document_dir = self.document_dir(document_id)
+        if document_dir is None:
+            return None
+        meta = _read_meta(document_dir)
+        if meta is None:
+            return None
+        try:
+            os.utime(document_dir)
+        except OSError:
+            return None
+        return meta
+
+    def update(self, document_id, **changes):
+        document_dir = self.document_dir(document_id)
+        meta = _read_meta(document_dir) or {}
+        meta.update(changes)
+        self._write_meta(document_dir, meta)
+        return meta
+
+    def write_file(self, document_id, name, write):
+        # Stores a file derived from the document; write(stream) writes its content
+        _write_file(self.file_path(document_id, name), write)
+
+    def _write_meta(self, document_dir, meta):
+        _write_file(os.path.join(document_dir, META_FILE), lambda f: f.write(json.dumps(meta).encode()))
+
+    def cleanup(self, force=False):
+        # Removes documents that were last used more than ttl seconds ago, then
+        # the least recently used ones while the store holds more than
+        # max_bytes. Runs at most once per cleanup_interval.
+        now = time.time()
+        if not force and now - self._last_cleanup < self.cleanup_interval:
+            return 0
+        self._last_cleanup = now
+
+        removed = 0
+        kept = []
+        for name in os.listdir(self.root):
+            document_dir = self.document_dir(name)
+            if document_dir is None:
+                continue
+            try:
+                last_used = os.path.getmtime(document_dir)
+                size = _dir_size(document_dir)
+            except OSError:
+                continue
+            if now - last_used > self.ttl:
+                shutil.rmtree(document_dir, ignore_errors=True)
+                removed += 1
+            else:
+                kept.append((last_used, size, document_dir))
+
+        total = sum(size for _, size, _ in kept)
+        for _, size, document_dir in sorted(kept):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(document_dir, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def stats(self):
+        documents = 0
+        size = 0
+        for name in os.listdir(self.root):
+            document_dir = self.document_dir(name)
+            if document_dir is None:
+                continue
+            documents += 1
+            try:
+                size += _dir_size(document_dir)
+            except OSError:
+                pass
+        return {
+            'documents': documents,
+            'bytes': size,
+            'maxBytes': self.max_bytes,
+            'ttl': self.ttl,
+        }
@@ -0,0 +1,60 @@
+# gunicorn settings for the backend, read by `gunicorn --config gunicorn.conf.py`
+# (see the Procfile). Each can be changed in the environment or in .env.
+import gc
+import os
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def env_flag(name, default):
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+def admission_threads():
+    # Enough threads per worker for the slots and queues of both admission
+    # lanes, so that queued requests do not hold up health checks and GETs
+    names = {'ADMISSION_SLOTS': 4, 'ADMISSION_QUEUE': 6, 'ADMISSION_SMALL_SLOTS': 2, 'ADMISSION_SMALL_QUEUE': 4}
+    counts = {name: int(os.getenv(name, default)) for name, default in names.items()}
+    if counts['ADMISSION_SLOTS'] <= 0:
+        return 16
+    return sum(counts.values())
+
+
+# The master imports the app and warms it up (pdf_server.warm_up) before it
+# forks the workers, which start at once and share the libraries, fonts and
+# stamps it loaded until they write to them
+preload_app = env_flag('GUNICORN_PRELOAD', 'true')
+
+# Processing holds the GIL, so one process per CPU; threads wait on uploads,
+# downloads and the admission queues
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY') or os.cpu_count() or 1)
+threads = int(os.getenv('GUNICORN_THREADS') or admission_threads())
+
+# Workers are replaced after this many requests (plus up to the jitter, so they
+# do not all restart together) to give back memory fragmented by large
+# documents. A replaced worker finishes its requests first, for up to
+# graceful_timeout seconds.
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 100))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 120))
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before the first fork
+    if not preload_app:
+        return
+    import pdf_server
+
+    start = time.perf_counter()
+    pdf_server.warm_up()
+    # Everything loaded so far is shared with the workers. Frozen objects are
+    # left out of garbage collection, which would otherwise write to them and
+    # make each worker copy the pages they are on.
+    gc.collect()
+    gc.freeze()
+    server.log.info("Warmed up in %.0f ms, %d objects frozen", (time.perf_counter() - start) * 1000,
+                    gc.get_freeze_count())
@@ -0,0 +1,202 @@
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+# Background jobs for documents that are too large to process inside a request.
+# Each job is a directory holding the input, the output and a status.json file.
+# Status lives on disk rather than in memory so that any server process can
+# report on a job, and so that pool workers can publish their progress.
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+STATUS_FILE = 'status.json'
+INPUT_FILE = 'input.pdf'
+OUTPUT_FILE = 'output.pdf'
+
+
+def _read_status(job_dir):
+    try:
+        with open(os.path.join(job_dir, STATUS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_status(job_dir, status):
+    # Replace the file in one step so readers never see a partial write
+    status['updatedAt'] = time.time()
+    temp_path = os.path.join(job_dir, f"{STATUS_FILE}.{os.getpid()}.tmp")
+    with open(temp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(temp_path, os.path.join(job_dir, STATUS_FILE))
+
+
+def _update_status(job_dir, **changes):
+    status = _read_status(job_dir) or {}
+    status.update(changes)
+    _write_status(job_dir, status)
+    return status
+
+
+class JobProgress:
+    # Passed to the job function, which calls it with (pages done, total pages).
+    # Writes are throttled so large documents do not spend their time on status updates.
+    def __init__(self, job_dir, interval=0.5):
+        self.job_dir = job_dir
+        self.interval = interval
+        self._last_write = 0
+
+    def __call__(self, done, total):
+        now = time.monotonic()
+        if done < total and now - self._last_write < self.interval:
+            return
+        self._last_write = now
+        _update_status(self.job_dir, pagesDone=done, pagesTotal=total)
+
+
+def _run_job(job_dir, function, args):
+    # Runs in a pool worker process
+    _update_status(job_dir, status='running', startedAt=time.time())
+    try:
+        function(
+            os.path.join(job_dir, INPUT_FILE),
+            os.path.join(job_dir, OUTPUT_FILE),
+            JobProgress(job_dir),
+            *args
+        )
+    except Exception as e:
+        print(f"Error in job {os.path.basename(job_dir)}: {str(e)}")
+        _update_status(job_dir, status='failed', error=str(e), finishedAt=time.time())
+        return
+    finally:
+        # The input is not needed once the job has run
+        try:
+            os.remove(os.path.join(job_dir, INPUT_FILE))
+        except OSError:
+            pass
+    _update_status(job_dir, status='done', finishedAt=time.time())
+
+
+class JobManager:
+    def __init__(self, root=None, workers=2, max_pending=16, ttl=3600, cleanup_interval=60):
+        self.root = root or os.path.join(tempfile.gettempdir(), 'zenpdf-jobs')
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._pool = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._last_cleanup = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def _get_pool(self):
+        # Created on first use so that it is never inherited by forked server workers.
+        # Pool workers are spawned, not forked, so they do not inherit server threads.
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._pool
+
+    def job_dir(self, job_id):
+        if not job_id or not JOB_ID_PATTERN.match(job_id):
+            return None
+        return os.path.join(self.root, job_id)
+
+    def submit(self, job_type, upload, download_name, function, *args):
+        # Returns the new job's status, or None when too many jobs are pending
+        self.cleanup()
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                return None
+
+            job_id = uuid.uuid4().hex
+            job_dir = self.job_dir(job_id)
+            os.makedirs(job_dir)
+            try:
+                upload.save(os.path.join(job_dir, INPUT_FILE))
+                status = {
+                    'id': job_id,
+                    'type': job_type,
+                    'status': 'queued',
+                    'pagesDone': 0,
+                    'pagesTotal': None,
+                    'error': None,
+                    'downloadName': download_name,
+                    'createdAt': time.time(),
+                    'startedAt': None,
+                    'finishedAt': None,
+                }
+                _write_status(job_dir, status)
+                future = self._get_pool().submit(_run_job, job_dir, function, args)
+            except Exception:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                raise
+
+            self._pending.add(future)
+        # Outside the lock: a job that has already finished runs the callback
+        # at once, in this thread, and the callback takes the lock
+        future.add_done_callback(self._job_finished(job_dir))
+        return status
+
+    def _job_finished(self, job_dir):
+        def finished(future):
+            with self._lock:
+                self._pending.discard(future)
+            error = future.exception()
+            if error is not None:
+                # The worker died before it could record the failure itself
+                print(f"Error in job {os.path.basename(job_dir)}: {str(error)}")
+                _update_status(job_dir, status='failed', error=str(error), finishedAt=time.time())
+        return finished
+
+    def status(self, job_id):
+        job_dir = self.job_dir(job_id)
+        if job_dir is None:
+            return None
+        return _read_status(job_dir)
+
+    def result_path(self, job_id):
+        job_dir = self.job_dir(job_id)
+        if job_dir is None:
+            return None
+        return os.path.join(job_dir, OUTPUT_FILE)
+
+    def cleanup(self, force=False):
+        # Removes jobs that finished, or stopped reporting progress, more than
+        # ttl seconds ago. Runs at most once per cleanup_interval.
+        now = time.time()
+        if not force and now - self._last_cleanup < self.cleanup_interval:
+            return 0
+        self._last_cleanup = now
+
+        removed = 0
+        for name in os.listdir(self.root):
+            job_dir = self.job_dir(name)
+            if job_dir is None:
+                continue
+            status = _read_status(job_dir)
+            if status is not None:
+                last_seen = status.get('finishedAt') or status.get('updatedAt') or 0
+            else:
+                last_seen = os.path.getmtime(job_dir)
+            if now - last_seen > self.ttl:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                removed += 1
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'maxPending': self.max_pending,
+                'workers': self.workers,
+                'ttl': self.ttl,
+            }
@@ -0,0 +1,283 @@
+import json
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request
+from werkzeug.wsgi import ClosingIterator
+
+# Lightweight request instrumentation: each request's stages are timed and
+# reported in a Server-Timing header, a JSON log line, and Prometheus
+# histograms served by /metrics. Metrics are kept per server process.
+REQUEST_LOG = os.getenv('REQUEST_LOG', 'true').lower() in ('1', 'true', 'yes')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+PAGE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+BYTE_BUCKETS = tuple(2 ** n for n in range(10, 31, 2))
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, count, total) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    bucket_labels = _label_text(self.labels + ('le',), labels + (repr(float(bound)),))
+                    lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_label_text(self.labels + ('le',), labels + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{_label_text(self.labels, labels)} {total}")
+                lines.append(f"{self.name}_count{_label_text(self.labels, labels)} {count}")
+        return lines
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+request_duration = Histogram(
+    'zenpdf_request_duration_seconds', 'Time from the start of a request until its response is closed.', ('endpoint',))
+stage_duration = Histogram(
+    'zenpdf_stage_duration_seconds', 'Time spent in each stage of a request.', ('endpoint', 'stage'))
+document_pages = Histogram(
+    'zenpdf_document_pages', 'Pages in the documents processed.', ('endpoint',), PAGE_BUCKETS)
+document_bytes = Histogram(
+    'zenpdf_document_bytes', 'Size of request and response bodies.', ('endpoint', 'direction'), BYTE_BUCKETS)
+requests_total = Counter(
+    'zenpdf_requests_total', 'Requests handled, by status code.', ('endpoint', 'status'))
+requests_in_flight = Gauge(
+    'zenpdf_requests_in_flight', 'Requests that are being handled or whose response is still being sent.')
+requests_rejected = Counter(
+    'zenpdf_requests_rejected_total', 'Requests turned away by admission control, by reason.', ('endpoint', 'reason'))
+admission_slots_in_use = Gauge(
+    'zenpdf_admission_slots_in_use', 'Admission slots held by running requests.', ('lane',))
+admission_queued = Gauge(
+    'zenpdf_admission_queued', 'Requests waiting for admission.', ('lane',))
+
+REGISTRY = [
+    request_duration, stage_duration, document_pages, document_bytes, requests_total, requests_in_flight,
+    requests_rejected, admission_slots_in_use, admission_queued,
+]
+
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class _StageTimer:
+    def __init__(self, request_metrics, name):
+        self.request_metrics = request_metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.request_metrics.add_time(self.name, time.perf_counter() - self.start)
+
+
+class _NoTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class RequestMetrics:
+    # Timings and sizes for one request. Stages may be timed from other
+    # threads, such as the one that writes a streamed response.
+    def __init__(self, endpoint, method, path):
+        self.endpoint = endpoint
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.pages = None
+        self.input_bytes = None
+        self.output_bytes = None
+        self.status = None
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def stage(self, name):
+        return _StageTimer(self, name)
+
+    def add_time(self, name, seconds):
+        # Stages entered more than once, such as stamp rendering, add up
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def server_timing(self):
+        with self._lock:
+            stages = list(self.stages.items())
+        stages.append(('total', time.perf_counter() - self.start))
+        return ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages)
+
+    def finish(self):
+        # Called once the response has been sent, or dropped by the client
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            stages = dict(self.stages)
+        duration = time.perf_counter() - self.start
+
+        requests_in_flight.dec()
+        requests_total.inc(self.endpoint, self.status)
+        request_duration.observe(duration, self.endpoint)
+        for name, seconds in stages.items():
+            stage_duration.observe(seconds, self.endpoint, name)
+        if self.pages is not None:
+            document_pages.observe(self.pages, self.endpoint)
+        if self.input_bytes is not None:
+            document_bytes.observe(self.input_bytes, self.endpoint, 'input')
+        if self.output_bytes is not None:
+            document_bytes.observe(self.output_bytes, self.endpoint, 'output')
+
+        if REQUEST_LOG:
+            print(json.dumps({
+                'event': 'request',
+                'method': self.method,
+                'path': self.path,
+                'endpoint': self.endpoint,
+                'status': self.status,
+                'durationMs': round(duration * 1000, 1),
+                'stagesMs': {name: round(seconds * 1000, 1) for name, seconds in stages.items()},
+                'pages': self.pages,
+                'inputBytes': self.input_bytes,
+                'outputBytes': self.output_bytes,
+            }), flush=True)
+
+
+def current():
+    # Metrics of the request being handled, or None outside of a request
+    if not has_request_context():
+        return None
+    return g.get('request_metrics')
+
+
+def timed(name):
+    # Times a stage of the current request; does nothing outside of one
+    request_metrics = current()
+    if request_metrics is None:
+        return _NoTimer()
+    return request_metrics.stage(name)
+
+
+def record_pages(pages):
+    request_metrics = current()
+    if request_metrics is not None:
+        request_metrics.pages = pages
+
+
+def call_on_close(response, function):
+    # Runs function once the response has been sent. Files from send_file
+    # are handed to the server as they are, without the response's own
+    # close, so for those the body itself is wrapped.
+    if response.direct_passthrough:
+        response.response = ClosingIterator(response.response, function)
+    else:
+        response.call_on_close(function)
+
+
+def init_app(app, skip_endpoints=('metrics_endpoint',)):
+    @app.before_request
+    def start_request_metrics():
+        if request.endpoint in skip_endpoints:
+            return
+        request_metrics = RequestMetrics(request.endpoint or 'unknown', request.method, request.path)
+        g.request_metrics = request_metrics
+        requests_in_flight.inc()
+        request_metrics.input_bytes = request.content_length
+        # Time spent waiting for admission, before this request was started
+        queue_seconds = g.get('queue_seconds')
+        if queue_seconds:
+            request_metrics.add_time('queue', queue_seconds)
+        if request.method == 'POST':
+            # Receiving and parsing the multipart body
+            with request_metrics.stage('upload'):
+                request.files
+
+    @app.after_request
+    def report_request_metrics(response):
+        request_metrics = g.get('request_metrics')
+        if request_metrics is None:
+            return response
+        request_metrics.status = response.status_code
+        if not response.is_streamed and response.content_length is not None:
+            request_metrics.output_bytes = response.content_length
+        # A streamed body is written after the headers are sent, so its
+        # write stage only appears in the log line and the histograms
+        response.headers['Server-Timing'] = request_metrics.server_timing()
+        call_on_close(response, request_metrics.finish)
+        return response
+
+    @app.teardown_request
+    def finish_failed_request(error=None):
+        # Requests that never produced a response are finished here
+        request_metrics = g.get('request_metrics')
+        if request_metrics is not None and request_metrics.status is None:
+            request_metrics.status = 500
+            request_metrics.finish()
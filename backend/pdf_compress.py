@@ -0,0 +1,326 @@
+import hashlib
+import io
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from PIL import Image
+
+from pdf_engine import _inherited, pikepdf_source
+
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+# Compression presets: images drawn at more than `dpi` are downsampled to it,
+# and recompressed images are saved as JPEG with the given quality
+COMPRESSION_PRESETS = {
+    'high': {'dpi': 300, 'jpeg_quality': 85},
+    'medium': {'dpi': 150, 'jpeg_quality': 70},
+    'low': {'dpi': 96, 'jpeg_quality': 50},
+}
+# Order in which presets are tried when the output must fit a target size
+PRESET_ORDER = ['high', 'medium', 'low']
+
+# Images are only downsampled when they are this much larger than needed
+DOWNSAMPLE_MARGIN = 1.1
+IDENTITY = (1, 0, 0, 1, 0, 0)
+
+
+class Timer:
+    # Records the time spent in each named stage, in milliseconds
+    def __init__(self):
+        self.stages = {}
+
+    def stage(self, name):
+        return _Stage(self.stages, name)
+
+
+class _Stage:
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = (time.perf_counter() - self.start) * 1000
+        self.stages[self.name] = round(self.stages.get(self.name, 0) + elapsed, 1)
+
+
+def _multiply(m, n):
+    a, b, c, d, e, f = m
+    A, B, C, D, E, F = n
+    return (a * A + b * C, a * B + b * D, c * A + d * C, c * B + d * D, e * A + f * C + E, e * B + f * D + F)
+
+
+def _image_placements(pdf):
+    # Largest size, in points, at which each image is drawn on any page
+    sizes = {}
+
+    def scan(content, resources, ctm, depth):
+        xobjects = resources.get('/XObject') if resources is not None else None
+        if xobjects is None or depth > 8:
+            return
+        stack = []
+        for instruction in pikepdf.parse_content_stream(content, 'q Q cm Do'):
+            operands, operator = instruction.operands, str(instruction.operator)
+            if operator == 'q':
+                stack.append(ctm)
+            elif operator == 'Q':
+                ctm = stack.pop() if stack else ctm
+            elif operator == 'cm':
+                ctm = _multiply(tuple(float(v) for v in operands), ctm)
+            elif operator == 'Do':
+                xobject = xobjects.get(operands[0])
+                if xobject is None:
+                    continue
+                subtype = xobject.get('/Subtype')
+                if subtype == '/Image':
+                    a, b, c, d = ctm[:4]
+                    width, height = math.hypot(a, b), math.hypot(c, d)
+                    key = xobject.objgen
+                    old_width, old_height = sizes.get(key, (0, 0))
+                    sizes[key] = (max(width, old_width), max(height, old_height))
+                elif subtype == '/Form':
+                    matrix = tuple(float(v) for v in xobject.get('/Matrix', IDENTITY))
+                    scan(xobject, xobject.get('/Resources', resources), _multiply(matrix, ctm), depth + 1)
+
+    for page in pdf.pages:
+        scan(page, _inherited(page.obj, '/Resources'), IDENTITY, 0)
+    return sizes
+
+
+def _image_source(image):
+    # Returns (kind, data, mode) for images that can be recompressed, or None.
+    # Only 8-bit gray and RGB images without decode arrays or color key masks
+    # are touched; everything else is left exactly as it is.
+    if image.get('/ImageMask') or '/Decode' in image or '/Mask' in image:
+        return None
+    if image.get('/BitsPerComponent') != 8:
+        return None
+
+    color_space = image.get('/ColorSpace')
+    if color_space == '/DeviceRGB':
+        mode = 'RGB'
+    elif color_space == '/DeviceGray':
+        mode = 'L'
+    elif isinstance(color_space, pikepdf.Array) and len(color_space) == 2 and color_space[0] == '/ICCBased':
+        mode = {1: 'L', 3: 'RGB'}.get(int(color_space[1].get('/N', 0)))
+        if mode is None:
+            return None
+    else:
+        return None
+
+    filters = image.get('/Filter')
+    if isinstance(filters, pikepdf.Array):
+        filters = list(filters)
+    elif filters is not None:
+        filters = [filters]
+    else:
+        filters = []
+    if filters == ['/DCTDecode']:
+        return 'jpeg', image.read_raw_bytes(), mode
+    if filters in ([], ['/FlateDecode']):
+        return 'raw', image.read_bytes(), mode
+    return None
+
+
+def recompress_image(kind, data, mode, size, target_size, quality):
+    # Runs in a pool thread. Pillow releases the GIL while it decodes,
+    # resizes and encodes, so images are processed in parallel.
+    if kind == 'jpeg':
+        image = Image.open(io.BytesIO(data))
+        # Let the JPEG decoder skip detail that is thrown away anyway
+        image.draft(mode, target_size)
+        if image.mode != mode:
+            return None
+    else:
+        image = Image.frombytes(mode, size, data)
+
+    if image.size[0] > target_size[0] * DOWNSAMPLE_MARGIN or image.size[1] > target_size[1] * DOWNSAMPLE_MARGIN:
+        image = image.resize(target_size, Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue(), image.size
+
+
+def _image_task(image, placement, preset):
+    # Arguments for recompress_image, or None when the image is left alone
+    source = _image_source(image)
+    if source is None:
+        return None
+    kind, data, mode = source
+    size = (int(image.Width), int(image.Height))
+    # Pixels needed to draw the image at the preset resolution
+    width_pt, height_pt = placement
+    scale = min(1, max(
+        width_pt / 72 * preset['dpi'] / size[0],
+        height_pt / 72 * preset['dpi'] / size[1],
+    ))
+    target_size = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+    return kind, data, mode, size, target_size, preset['jpeg_quality']
+
+
+def _replace_image(image, result, size):
+    # Returns what happened to the image: 'skipped', 'recompressed' or 'downsampled'
+    # Keep the original unless the new image is smaller
+    if result is None or len(result[0]) >= len(image.read_raw_bytes()):
+        return 'skipped'
+    data, new_size = result
+    image.write(data, filter=pikepdf.Name.DCTDecode)
+    if '/DecodeParms' in image:
+        del image['/DecodeParms']
+    if new_size == size:
+        return 'recompressed'
+    image.Width, image.Height = new_size
+    return 'downsampled'
+
+
+def _recompress_images(pdf, preset, workers, timer):
+    with timer.stage('analyze'):
+        placements = _image_placements(pdf)
+
+    counts = {'recompressed': 0, 'downsampled': 0, 'skipped': 0}
+
+    def finish(future):
+        # The document is only touched from this thread, never from the pool
+        key, size = running.pop(future)
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Warning: Could not recompress image {key}: {str(e)}")
+            result = None
+        counts[_replace_image(pdf.get_object(key), result, size)] += 1
+
+    with timer.stage('images'), ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        for key, placement in placements.items():
+            try:
+                task = _image_task(pdf.get_object(key), placement, preset)
+            except Exception as e:
+                print(f"Warning: Could not read image {key}: {str(e)}")
+                task = None
+            if task is None:
+                counts['skipped'] += 1
+                continue
+            running[pool.submit(recompress_image, *task)] = (key, task[3])
+            # Only a few decoded images are held in memory at a time
+            if len(running) >= workers * 2:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+        for future in list(running):
+            finish(future)
+
+    # Downsampled images are recompressed too
+    counts['recompressed'] += counts['downsampled']
+    return counts
+
+
+def _object_key(value):
+    # Hashable description of a PDF value; indirect objects are compared by reference
+    if not isinstance(value, pikepdf.Object):
+        return repr(value)
+    if value.is_indirect:
+        return ('ref', value.objgen)
+    if isinstance(value, pikepdf.Dictionary):
+        return tuple(sorted((key, _object_key(value[key])) for key in value.keys()))
+    if isinstance(value, pikepdf.Array):
+        return tuple(_object_key(item) for item in value)
+    return repr(value)
+
+
+def _replace_references(container, replacements, depth=0):
+    # Points references to duplicate objects at the copy that is kept
+    if depth > 32:
+        return
+    if isinstance(container, pikepdf.Array):
+        items = enumerate(list(container))
+    else:
+        items = [(key, container[key]) for key in container.keys()]
+    for key, value in items:
+        if not isinstance(value, pikepdf.Object):
+            continue
+        if value.is_indirect:
+            replacement = replacements.get(value.objgen)
+            if replacement is not None:
+                container[key] = replacement
+        elif isinstance(value, (pikepdf.Dictionary, pikepdf.Array)):
+            _replace_references(value, replacements, depth + 1)
+
+
+def _deduplicate_streams(pdf):
+    # Streams with identical data and dictionaries are stored once
+    kept = {}
+    replacements = {}
+    for obj in pdf.objects:
+        if not isinstance(obj, pikepdf.Stream):
+            continue
+        digest = hashlib.sha256(obj.read_raw_bytes()).digest()
+        key = (digest, tuple(sorted(
+            (name, _object_key(obj.stream_dict[name])) for name in obj.stream_dict.keys() if name != '/Length'
+        )))
+        original = kept.setdefault(key, obj)
+        if original.objgen != obj.objgen:
+            replacements[obj.objgen] = original
+
+    if replacements:
+        for obj in pdf.objects:
+            if isinstance(obj, (pikepdf.Dictionary, pikepdf.Array, pikepdf.Stream)):
+                _replace_references(obj, replacements)
+        _replace_references(pdf.trailer, replacements)
+    return len(replacements)
+
+
+def compress_pdf(source, quality='medium', workers=4):
+    # Returns the compressed PDF's bytes and a report of what was done,
+    # including the time spent in each stage
+    preset = COMPRESSION_PRESETS[quality]
+    timer = Timer()
+
+    with timer.stage('open'):
+        pdf = pikepdf.open(pikepdf_source(source))
+    try:
+        # Duplicates go first, so a repeated image is only recompressed once
+        with timer.stage('deduplicate'):
+            duplicates = _deduplicate_streams(pdf)
+
+        images = _recompress_images(pdf, preset, workers, timer)
+
+        with timer.stage('unused'):
+            # Drop fonts, images and forms that no page draws
+            pdf.remove_unreferenced_resources()
+
+        with timer.stage('save'):
+            # Only objects reachable from the trailer are written, which drops
+            # unused ones; object streams also pack the cross-reference table
+            output = io.BytesIO()
+            pdf.save(
+                output,
+                compress_streams=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            )
+    finally:
+        pdf.close()
+
+    return output.getvalue(), {
+        'quality': quality,
+        'images': images,
+        'duplicateStreams': duplicates,
+        'timings': timer.stages,
+    }
+
+
+def compress_to_size(source, quality='medium', target_size=None, workers=4):
+    # Compresses with the chosen preset, then steps down through the lower
+    # presets until the output fits in target_size bytes or none are left
+    for attempt, preset in enumerate(PRESET_ORDER[PRESET_ORDER.index(quality):], 1):
+        source.seek(0)
+        data, report = compress_pdf(source, preset, workers)
+        if target_size is None or len(data) <= target_size:
+            break
+    report['attempts'] = attempt
+    return data, report
@@ -0,0 +1,759 @@
+import contextlib
+import io
+import os
+import re
+import shutil
+import tempfile
+import uuid
+
+from PyPDF2 import PdfReader, PdfWriter, PageObject
+from PyPDF2.constants import (
+    CatalogDictionary as CD, PageAttributes as PG, PagesAttributes as PA, Ressources as RES, TrailerKeys as TK
+)
+from PyPDF2.generic import (
+    ArrayObject, ByteStringObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject, NumberObject,
+    RectangleObject
+)
+
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+# The PDF engine does the parsing, stamping, encryption and writing.
+# Both engines expose the same small document interface:
+#   is_encrypted, decrypt(password), page_count, page_geometry(index),
+#   import_stamp(source, name), import_stamps(source, name),
+#   stamp_page(index, stamp, ctm, layer, mode),
+#   extract_pages(start, end), select_pages(indexes), append(other), rotate_page(index, angle),
+#   release_objects(), encrypt(password, aes256), write(stream), close(),
+#   read_pages_lazily(), incremental_update()
+DEFAULT_ENGINE = 'pypdf2'
+IDENTITY_MATRIX = (1, 0, 0, 1, 0, 0)
+COPY_CHUNK_BYTES = 1024 * 1024
+# Output of qpdf written for a stream that cannot seek is kept in memory up to
+# this size, and spilled to a temporary file beyond it
+WRITE_SPOOL_BYTES = 8 * 1024 * 1024
+# Page attributes that pages inherit from the nodes of the page tree above them
+INHERITED_PAGE_ATTRIBUTES = (PG.RESOURCES, PG.MEDIABOX, PG.CROPBOX, PG.ROTATE)
+# Deepest page tree that is followed, so that a tree that loops ends
+MAX_PAGE_TREE_DEPTH = 64
+
+
+def pdf_number(value):
+    return f"{value:.4f}".rstrip('0').rstrip('.') or '0'
+
+def _draw_operators(name, ctm):
+    cm = '' if ctm == IDENTITY_MATRIX else ' '.join(pdf_number(v) for v in ctm) + ' cm '
+    return f"q {cm}{name} Do Q\n".encode()
+
+def _box_geometry(box, rotation):
+    left, bottom, right, top = [float(v) for v in box]
+    rotation = ((int(rotation) + 45) // 90 * 90) % 360
+    return (min(left, right), min(bottom, top), abs(right - left), abs(top - bottom), rotation)
+
+
+# PyPDF2 ---------------------------------------------------------------------
+
+def _add_content_stream(writer, data):
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    return writer._add_object(stream)
+
+def _page_content_refs(page):
+    # /Contents can be a single stream, an array of streams, or missing
+    if PG.CONTENTS not in page:
+        return []
+    contents = page.raw_get(PG.CONTENTS)
+    if isinstance(contents.get_object(), ArrayObject):
+        return list(contents.get_object())
+    return [contents]
+
+def _stamp_form_xobject(writer, stamp_page):
+    # Turn the stamp page into a Form XObject that every page can reference.
+    # The content is copied as bytes; parsing its operators is not needed.
+    form = DecodedStreamObject()
+    form.set_data(b"\n".join(ref.get_object().get_data() for ref in _page_content_refs(stamp_page)))
+    form = form.flate_encode()
+    form[NameObject('/Type')] = NameObject('/XObject')
+    form[NameObject('/Subtype')] = NameObject('/Form')
+    form[NameObject('/BBox')] = RectangleObject(stamp_page.mediabox)
+    if PG.RESOURCES in stamp_page:
+        form[NameObject(PG.RESOURCES)] = stamp_page.raw_get(PG.RESOURCES).clone(writer)
+    return writer._add_object(form)
+
+def _place_stamp_xobject(writer, page, xobject, name, ctm, layer, shared_streams):
+    resources = page.get(PG.RESOURCES)
+    if resources is None:
+        resources = DictionaryObject()
+        page[NameObject(PG.RESOURCES)] = resources
+    else:
+        resources = resources.get_object()
+    xobjects = resources.get(RES.XOBJECT)
+    if xobjects is None:
+        xobjects = DictionaryObject()
+        resources[NameObject(RES.XOBJECT)] = xobjects
+    else:
+        xobjects = xobjects.get_object()
+
+    shared = True
+    name = NameObject(name)
+    if name in xobjects and xobjects.raw_get(name) != xobject:
+        # The page already uses our resource name for something else
+        name = NameObject(f"{name}_{uuid.uuid4().hex[:8]}")
+        shared = False
+    xobjects[name] = xobject
+
+    # Drawing the stamp only costs a "Do" operator; the content streams
+    # that wrap it are shared by every page with the same geometry
+    draw = _draw_operators(name, ctm)
+    key = (layer, name, ctm)
+    if not shared or key not in shared_streams:
+        if layer == 'above':
+            streams = (_add_content_stream(writer, b"q\n"), _add_content_stream(writer, b"\nQ\n" + draw))
+        else:
+            streams = (_add_content_stream(writer, draw), None)
+        if not shared:
+            return _set_page_contents(page, streams)
+        shared_streams[key] = streams
+    _set_page_contents(page, shared_streams[key])
+
+def _set_page_contents(page, streams):
+    before, after = streams
+    contents = ArrayObject([before] + _page_content_refs(page))
+    if after is not None:
+        contents.append(after)
+    page[NameObject(PG.CONTENTS)] = contents
+
+def _merge_stamp_page(page, stamp_page, ctm, layer):
+    if ctm == IDENTITY_MATRIX:
+        transformation = None
+    else:
+        transformation = lambda content: PageObject._add_transformation_matrix(content, stamp_page.pdf, ctm)
+
+    if layer == 'above':
+        page._merge_page(stamp_page, transformation, ctm)
+    else:  # below
+        # Merge the page onto a copy of the stamp so the stamp is drawn
+        # first, then keep the page's own boxes and annotations
+        merged = PageObject(stamp_page.pdf)
+        merged.update(stamp_page)
+        if transformation is not None:
+            merged.add_transformation(ctm)
+        merged.merge_page(page)
+        for key in (PG.CONTENTS, PG.RESOURCES, PG.ANNOTS):
+            page[NameObject(key)] = merged[key]
+
+
+@contextlib.contextmanager
+def _source_file(source):
+    # A document's source is a path or an open binary stream
+    if isinstance(source, str):
+        with open(source, 'rb') as file:
+            yield file
+    else:
+        yield source
+
+def _last_xref(file):
+    # Offset of the file's last cross-reference section and whether it is a
+    # table (or else a stream), or None when the end of the file does not
+    # point at one and so cannot be followed by an incremental update
+    file.seek(0, os.SEEK_END)
+    file.seek(max(0, file.tell() - 1024))
+    tail = file.read()
+    match = re.search(rb'startxref\s+(\d+)\s*%%EOF\s*$', tail)
+    if match is None:
+        return None
+    offset = int(match.group(1))
+    file.seek(offset)
+    head = file.read(32)
+    if head.startswith(b'xref'):
+        return offset, True
+    if re.match(rb'\d+\s+\d+\s+obj', head):
+        return offset, False
+    return None
+
+class _PageTree:
+    # A document's pages, found in the page tree by the /Count of its nodes
+    # when they are asked for. PyPDF2 reads every page the first time any page
+    # is asked for; this reads the nodes on the way to the pages that are used.
+    def __init__(self, reader):
+        self.reader = reader
+        self.root = reader.trailer[TK.ROOT][CD.PAGES]
+        self.count = int(self.root[PA.COUNT])
+        self._pages = {}
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self[i] for i in range(self.count))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('page index out of range')
+        page = self._pages.get(index)
+        if page is None:
+            page = self._pages[index] = self._find(index)
+        return page
+
+    def _find(self, index):
+        node, inherited = self.root, {}
+        for _ in range(MAX_PAGE_TREE_DEPTH):
+            for key in INHERITED_PAGE_ATTRIBUTES:
+                if key in node:
+                    inherited[key] = node.raw_get(key)
+            for ref in node[PA.KIDS]:
+                kid = ref.get_object()
+                if PA.KIDS in kid:
+                    count = int(kid[PA.COUNT])
+                    if index < count:
+                        node = kid
+                        break
+                    index -= count
+                elif index == 0:
+                    if not isinstance(ref, IndirectObject):
+                        raise ValueError('Page is not an indirect object')
+                    page = PageObject(self.reader, ref)
+                    page.update(kid)
+                    for key, value in inherited.items():
+                        if key not in page:
+                            page[NameObject(key)] = value
+                    return page
+                else:
+                    index -= 1
+            else:
+                raise ValueError('Page tree does not match its page count')
+        raise ValueError('Page tree is too deep')
+
+def _next_object_number(reader):
+    # Trailers do not always count every object, so the cross-reference is checked too
+    numbers = [number for table in reader.xref.values() for number in table]
+    numbers.extend(reader.xref_objStm)
+    return max([int(reader.trailer.get(TK.SIZE, 0))] + [number + 1 for number in numbers])
+
+def _xref_sections(numbers):
+    # Runs of consecutive object numbers, as [first number, count]
+    sections = []
+    for number in sorted(numbers):
+        if sections and sections[-1][0] + sections[-1][1] == number:
+            sections[-1][1] += 1
+        else:
+            sections.append([number, 1])
+    return sections
+
+def _write_object(stream, number, generation, obj):
+    stream.write(f"{number} {generation} obj\n".encode())
+    obj.write_to_stream(stream, None)
+    stream.write(b"\nendobj\n")
+
+
+class PyPDF2Document:
+    engine = 'pypdf2'
+
+    def __init__(self, source, reader=None, pages=None):
+        self.source = source
+        self.reader = reader or PdfReader(source)
+        self.pages = self.reader.pages if pages is None else pages
+        # Whether this is the reader's whole document, or a range of its pages
+        self._whole_document = pages is None
+        self.writer = None
+        self._password = None
+        self._shared_streams = {}
+        self._appended = []
+        # Set while the document is written as an incremental update
+        self._update = None
+
+    @property
+    def is_encrypted(self):
+        return self.reader.is_encrypted
+
+    def decrypt(self, password):
+        # Use a new reader for each attempt to avoid state issues
+        reader = PdfReader(self.source)
+        if not reader.decrypt(password):
+            return False
+        self.reader = reader
+        self.pages = reader.pages
+        return True
+
+    @property
+    def page_count(self):
+        return len(self.pages)
+
+    def page_geometry(self, index):
+        # The visible area of a page is its crop box, which defaults to the media box
+        page = self.pages[index]
+        return _box_geometry(page.cropbox, page.rotation)
+
+    def _output(self):
+        # Pages are copied into a writer the first time the document is changed
+        if self._update is not None:
+            raise ValueError('Only stamps can be added to a document written as an incremental update')
+        if self.writer is None:
+            self.writer = PdfWriter()
+            for page in self.pages:
+                self.writer.add_page(page)
+        return self.writer
+
+    def _document_writer(self):
+        # A writer over the whole document as it is. The catalog and everything
+        # it refers to, outlines, named destinations and forms included, are
+        # copied in one pass; the page tree is kept instead of being rebuilt.
+        writer = PdfWriter()
+        root = self.reader.trailer[TK.ROOT].clone(writer)
+        writer._root, writer._root_object = root.indirect_reference, root
+        info = self.reader.trailer.get(TK.INFO)
+        if info is not None:
+            writer._info = info.get_object().clone(writer).indirect_reference
+        return writer
+
+    def extract_pages(self, start, end):
+        # A document made of pages start to end - 1, sharing this document's reader
+        return PyPDF2Document(self.source, self.reader, [self.reader.pages[i] for i in range(start, end)])
+
+    def select_pages(self, indexes):
+        # A document made of the pages at indexes, in that order, sharing this
+        # document's reader. Only those pages are copied when it is written.
+        return PyPDF2Document(self.source, self.reader, [self.pages[i] for i in indexes])
+
+    def rotate_page(self, index, angle):
+        # Turns a page clockwise by a multiple of 90 degrees
+        page = self._output().pages[index]
+        page[NameObject(PG.ROTATE)] = NumberObject((page.rotation + angle) % 360)
+
+    def release_objects(self):
+        # Forgets the objects the reader has parsed so far; they are read
+        # again if they are needed. Documents written in parts call this
+        # between parts so that memory use follows the part, not the document.
+        self.reader.resolved_objects.clear()
+
+    def append(self, other):
+        # Copies the other document's pages, as they are, after this document's
+        # pages. Content streams are copied as raw bytes and never parsed.
+        writer = self._output()
+        for page in other.pages:
+            writer.add_page(page)
+        self.pages = list(self.pages) + list(other.pages)
+        self._appended.append(other)
+
+    def import_stamp(self, source, name, index=0):
+        return {'page': PdfReader(source).pages[index], 'xobject': None, 'writer_page': None, 'name': name}
+
+    def import_stamps(self, source, name):
+        # One stamp per page of a stamp document. The pages share a reader,
+        # so resources they have in common are copied into the output once.
+        return [
+            {'page': page, 'xobject': None, 'writer_page': None, 'name': name}
+            for page in PdfReader(source).pages
+        ]
+
+    def read_pages_lazily(self):
+        # Looks pages up in the page tree when they are asked for, instead of
+        # reading every page first, for documents of which only a few pages
+        # are used. Call before the pages are counted or looked at. Returns
+        # False when the page tree cannot be used that way.
+        if self.writer is not None or not self._whole_document or self.reader.is_encrypted:
+            return False
+        try:
+            self.pages = _PageTree(self.reader)
+        except (KeyError, TypeError, ValueError):
+            return False
+        return True
+
+    def incremental_update(self):
+        # Writes the document as an incremental update: the original file is
+        # copied as it is, followed by the stamped pages, the objects that
+        # are new and a cross-reference section for them. Returns False, and
+        # leaves the document as it was, when the file cannot be updated.
+        # Only the pages that are stamped are read, so this is best called
+        # before the pages are counted or looked at.
+        if self.writer is not None or not self._whole_document or self.reader.is_encrypted:
+            return False
+        with _source_file(self.source) as file:
+            xref = _last_xref(file)
+        if xref is None or not self.read_pages_lazily():
+            return False
+        # New objects are numbered after the file's own. The writer numbers
+        # the objects it adds or clones by their place in its list, so the
+        # numbers taken by the file are filled with placeholders.
+        first_number = _next_object_number(self.reader)
+        writer = PdfWriter()
+        writer._objects = [None] * (first_number - 1)
+        self._update = {'writer': writer, 'first_number': first_number, 'xref': xref, 'changed': {}}
+        return True
+
+    def _stamp_update(self, index, stamp, ctm, layer, mode):
+        # The file's own page is stamped, and recorded with the objects that
+        # stamping changed in place: an indirect /Resources or /XObject dictionary
+        if mode != 'xobject':
+            raise ValueError('Incremental updates only stamp in xobject mode')
+        writer, changed = self._update['writer'], self._update['changed']
+        page = self.pages[index]
+        if stamp['xobject'] is None:
+            stamp['xobject'] = _stamp_form_xobject(writer, stamp['page'])
+        _place_stamp_xobject(writer, page, stamp['xobject'], stamp['name'], ctm, layer, self._shared_streams)
+        changed[page.indirect_reference.idnum] = (page.indirect_reference.generation, page)
+        resources = page.raw_get(PG.RESOURCES)
+        for ref in (resources, resources.get_object().raw_get(RES.XOBJECT)):
+            if isinstance(ref, IndirectObject):
+                changed[ref.idnum] = (ref.generation, ref.get_object())
+
+    def _write_update(self, stream):
+        writer, first_number = self._update['writer'], self._update['first_number']
+        prev, table = self._update['xref']
+        objects = dict(self._update['changed'])
+        for number in range(first_number, len(writer._objects) + 1):
+            objects[number] = (0, writer._objects[number - 1])
+
+        with _source_file(self.source) as source:
+            if not objects:
+                # No page was stamped, so the original is the result
+                source.seek(0)
+                shutil.copyfileobj(source, stream, COPY_CHUNK_BYTES)
+                return
+            source.seek(-1, os.SEEK_END)
+            separator = b'' if source.read(1) in b'\r\n' else b'\n'
+            size = source.tell()
+
+            # The update is put together first, since the offsets in its
+            # cross-reference count from the start of the file
+            update = io.BytesIO()
+            update.write(separator)
+            offsets = {}
+            for number in sorted(objects):
+                generation, obj = objects[number]
+                offsets[number] = (size + update.tell(), generation)
+                _write_object(update, number, generation, obj)
+
+            trailer = DictionaryObject()
+            for key in (TK.ROOT, TK.INFO):
+                if key in self.reader.trailer:
+                    trailer[NameObject(key)] = self.reader.trailer.raw_get(key)
+            ids = self.reader.trailer.get(TK.ID)
+            if ids is not None:
+                # The first identifier stays, the second changes with every update
+                trailer[NameObject(TK.ID)] = ArrayObject([ids.get_object()[0], ByteStringObject(os.urandom(16))])
+            trailer[NameObject('/Prev')] = NumberObject(prev)
+            xref_offset = size + update.tell()
+            if table:
+                trailer[NameObject(TK.SIZE)] = NumberObject(max(first_number, max(objects) + 1))
+                update.write(b"xref\n")
+                for start, count in _xref_sections(offsets):
+                    update.write(f"{start} {count}\n".encode())
+                    for number in range(start, start + count):
+                        offset, generation = offsets[number]
+                        update.write(f"{offset:010d} {generation:05d} n\r\n".encode())
+                update.write(b"trailer\n")
+                trailer.write_to_stream(update, None)
+                update.write(b"\n")
+            else:
+                # A file with cross-reference streams gets one more, which lists itself
+                number = max(first_number, max(objects) + 1)
+                offsets[number] = (xref_offset, 0)
+                width = max(4, (xref_offset.bit_length() + 7) // 8)
+                rows = DecodedStreamObject()
+                rows.set_data(b''.join(
+                    b'\x01' + offset.to_bytes(width, 'big') + generation.to_bytes(2, 'big')
+                    for _, (offset, generation) in sorted(offsets.items())
+                ))
+                xref = rows.flate_encode()
+                xref.update(trailer)
+                xref[NameObject('/Type')] = NameObject('/XRef')
+                xref[NameObject(TK.SIZE)] = NumberObject(number + 1)
+                xref[NameObject('/W')] = ArrayObject([NumberObject(1), NumberObject(width), NumberObject(2)])
+                xref[NameObject('/Index')] = ArrayObject(
+                    NumberObject(value) for section in _xref_sections(offsets) for value in section
+                )
+                _write_object(update, number, 0, xref)
+            update.write(f"startxref\n{xref_offset}\n%%EOF\n".encode())
+
+            source.seek(0)
+            shutil.copyfileobj(source, stream, COPY_CHUNK_BYTES)
+        stream.write(update.getvalue())
+
+    def stamp_page(self, index, stamp, ctm, layer, mode='xobject'):
+        if self._update is not None:
+            return self._stamp_update(index, stamp, ctm, layer, mode)
+        writer = self._output()
+        page = writer.pages[index]
+        if mode == 'merge':
+            if stamp.get('writer_page') is None:
+                # The writer's pages can only merge objects the writer owns
+                stamp['writer_page'] = PageObject(writer)
+                stamp['writer_page'].update(stamp['page'].clone(writer, ignore_fields=(PG.PARENT,)))
+            _merge_stamp_page(page, stamp['writer_page'], ctm, layer)
+            # Merging leaves a direct content stream, which must be indirect
+            page[NameObject(PG.CONTENTS)] = writer._add_object(page[PG.CONTENTS])
+            return
+        if stamp['xobject'] is None:
+            stamp['xobject'] = _stamp_form_xobject(writer, stamp['page'])
+        _place_stamp_xobject(writer, page, stamp['xobject'], stamp['name'], ctm, layer, self._shared_streams)
+
+    def encrypt(self, password, aes256=False):
+        # Applied when the document is written. PyPDF2 only writes RC4.
+        if aes256:
+            raise ValueError('AES-256 encryption needs the pikepdf engine')
+        if self._update is not None:
+            raise ValueError('Incremental updates cannot be encrypted')
+        self._password = password
+
+    def write(self, stream):
+        if self._update is not None:
+            return self._write_update(stream)
+        # Documents that were only encrypted or decrypted are written as a
+        # whole rather than page by page
+        if self.writer is None and self._whole_document:
+            writer = self._document_writer()
+        else:
+            writer = self._output()
+        if self._password is not None:
+            writer.encrypt(self._password)
+        writer.write(stream)
+
+    def close(self):
+        if self.writer is not None:
+            # The writer's objects refer back to the writer. Emptying it lets
+            # reference counting free them without waiting for a collection.
+            self.writer._objects.clear()
+        self.writer = None
+        if self._update is not None:
+            self._update['writer']._objects.clear()
+            self._update = None
+        for other in self._appended:
+            other.close()
+        self._appended = []
+
+
+# pikepdf --------------------------------------------------------------------
+
+def _inherited(page, key):
+    # Page attributes such as /MediaBox and /Rotate may live on a parent node
+    node = page
+    while node is not None:
+        if key in node:
+            return node[key]
+        node = node.get('/Parent')
+    return None
+
+
+class _MappedFile(io.RawIOBase):
+    # Read-only file object over a memory map. qpdf reads streams through
+    # readable(), seek() and readinto(), and a map has no readable().
+    def __init__(self, mapped):
+        self._map = mapped
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._map[self._position:self._position + len(buffer)]
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._map)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+def pikepdf_source(source):
+    # Something pikepdf.open() can read: spooled uploads arrive as memory
+    # maps, which are wrapped rather than copied
+    if hasattr(source, 'read') and not hasattr(source, 'readable'):
+        return _MappedFile(source)
+    return source
+
+
+class PikepdfDocument:
+    engine = 'pikepdf'
+
+    def __init__(self, source, pdf=None):
+        self.source = source
+        self._source_documents = []
+        self._shared_streams = {}
+        self._encryption = False
+        if pdf is not None:
+            self.pdf = pdf
+            self.is_encrypted = False
+            return
+        try:
+            self.pdf = pikepdf.open(pikepdf_source(source))
+            self.is_encrypted = self.pdf.is_encrypted
+        except pikepdf.PasswordError:
+            # Opening needs the user password, which decrypt() supplies
+            self.pdf = None
+            self.is_encrypted = True
+
+    def decrypt(self, password):
+        try:
+            pdf = pikepdf.open(pikepdf_source(self.source), password=password)
+        except pikepdf.PasswordError:
+            return False
+        if self.pdf is not None:
+            self.pdf.close()
+        self.pdf = pdf
+        return True
+
+    @property
+    def page_count(self):
+        return len(self.pdf.pages)
+
+    def page_geometry(self, index):
+        page = self.pdf.pages[index].obj
+        box = _inherited(page, '/CropBox') or _inherited(page, '/MediaBox')
+        return _box_geometry(box, _inherited(page, '/Rotate') or 0)
+
+    def import_stamp(self, source, name, index=0):
+        # The stamp document stays open until the output is written,
+        # because copied stream data is read from it lazily
+        stamp_pdf = pikepdf.open(pikepdf_source(source))
+        self._source_documents.append(stamp_pdf)
+        return {'page': stamp_pdf.pages[index], 'xobject': None, 'name': name}
+
+    def import_stamps(self, source, name):
+        # qpdf copies objects shared by several stamp pages only once
+        stamp_pdf = pikepdf.open(pikepdf_source(source))
+        self._source_documents.append(stamp_pdf)
+        return [{'page': page, 'xobject': None, 'name': name} for page in stamp_pdf.pages]
+
+    def read_pages_lazily(self):
+        # qpdf reads objects when they are used
+        return True
+
+    def incremental_update(self):
+        # qpdf always writes the whole file
+        return False
+
+    def extract_pages(self, start, end):
+        part = pikepdf.new()
+        part.pages.extend(self.pdf.pages[start:end])
+        return PikepdfDocument(self.source, part)
+
+    def select_pages(self, indexes):
+        part = pikepdf.new()
+        part.pages.extend([self.pdf.pages[i] for i in indexes])
+        return PikepdfDocument(self.source, part)
+
+    def rotate_page(self, index, angle):
+        page = self.pdf.pages[index].obj
+        page[pikepdf.Name.Rotate] = (int(_inherited(page, '/Rotate') or 0) + angle) % 360
+
+    def release_objects(self):
+        # pikepdf has no way to drop the objects qpdf has read
+        pass
+
+    def append(self, other):
+        # The other document stays open until this one is written
+        self.pdf.pages.extend(other.pdf.pages)
+        self._source_documents.append(other.pdf)
+
+    def _content_stream(self, data):
+        return self.pdf.make_indirect(pikepdf.Stream(self.pdf, data))
+
+    def stamp_page(self, index, stamp, ctm, layer, mode='xobject'):
+        page = self.pdf.pages[index]
+        # qpdf cannot merge content streams, so 'merge' embeds a separate
+        # copy of the stamp for every page instead of sharing one
+        shared = mode != 'merge'
+        if stamp['xobject'] is None or not shared:
+            xobject = self.pdf.copy_foreign(stamp['page'].as_form_xobject())
+            if shared:
+                stamp['xobject'] = xobject
+        else:
+            xobject = stamp['xobject']
+
+        if pikepdf.Name.Resources not in page.obj:
+            # Point the page at its inherited resources, or give it its own
+            inherited = _inherited(page.obj, '/Resources')
+            if inherited is None:
+                inherited = pikepdf.Dictionary()
+            elif not inherited.is_indirect:
+                inherited = pikepdf.Dictionary(inherited)
+            page.obj[pikepdf.Name.Resources] = inherited
+        resources = page.obj[pikepdf.Name.Resources]
+        if pikepdf.Name.XObject not in resources:
+            resources[pikepdf.Name.XObject] = pikepdf.Dictionary()
+        xobjects = resources[pikepdf.Name.XObject]
+        name = pikepdf.Name(stamp['name'])
+        if name in xobjects and xobjects[name].objgen != xobject.objgen:
+            # The page already uses our resource name for something else
+            name = pikepdf.Name(f"{stamp['name']}_{uuid.uuid4().hex[:8]}")
+            shared = False
+        xobjects[name] = xobject
+
+        draw = _draw_operators(name, ctm)
+        key = (layer, str(name), ctm)
+        if not shared or key not in self._shared_streams:
+            if layer == 'above':
+                streams = (self._content_stream(b"q\n"), self._content_stream(b"\nQ\n" + draw))
+            else:
+                streams = (self._content_stream(draw), None)
+            if shared:
+                self._shared_streams[key] = streams
+        else:
+            streams = self._shared_streams[key]
+
+        before, after = streams
+        contents = page.obj.get(pikepdf.Name.Contents)
+        if contents is None:
+            contents = []
+        elif isinstance(contents, pikepdf.Array):
+            contents = list(contents)
+        else:
+            contents = [contents]
+        page.obj[pikepdf.Name.Contents] = pikepdf.Array(
+            [before] + contents + ([after] if after is not None else [])
+        )
+
+    def encrypt(self, password, aes256=False):
+        # Revision 4 is AES-128, revision 6 is AES-256
+        self._encryption = pikepdf.Encryption(owner=password, user=password, R=6 if aes256 else 4)
+
+    def write(self, stream):
+        # encryption=False writes the document without any encryption.
+        # qpdf only writes to streams that can seek, which streamed responses
+        # and ZIP members cannot, so their output goes through a spool.
+        seekable = getattr(stream, 'seekable', None)
+        if seekable is not None and seekable():
+            self.pdf.save(stream, encryption=self._encryption)
+            return
+        with tempfile.SpooledTemporaryFile(max_size=WRITE_SPOOL_BYTES) as spool:
+            self.pdf.save(spool, encryption=self._encryption)
+            spool.seek(0)
+            shutil.copyfileobj(spool, stream, COPY_CHUNK_BYTES)
+
+    def close(self):
+        for pdf in self._source_documents + [self.pdf]:
+            if pdf is not None:
+                pdf.close()
+        self._source_documents = []
+
+
+ENGINES = {
+    'pypdf2': PyPDF2Document,
+    'pikepdf': PikepdfDocument,
+}
+
+
+def open_document(source, engine=None):
+    engine = engine or DEFAULT_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown PDF engine: {engine}")
+    if engine == 'pikepdf' and pikepdf is None:
+        print("Warning: pikepdf is not installed, falling back to PyPDF2")
+        engine = 'pypdf2'
+    return ENGINES[engine](source)
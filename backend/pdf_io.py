@@ -0,0 +1,207 @@
+import io
+import mmap
+import os
+import queue
+import tempfile
+import threading
+
+from flask import Request, Response
+
+import metrics
+
+# Uploads up to this size are kept in memory, larger ones spill to a scratch file
+UPLOAD_SPOOL_BYTES = int(os.getenv('UPLOAD_SPOOL_BYTES', 8 * 1024 * 1024))
+# Directory for spilled uploads, defaults to the system temp directory
+UPLOAD_SCRATCH_DIR = os.getenv('UPLOAD_SCRATCH_DIR') or None
+# Size of the chunks sent to the client, and how many may be waiting
+STREAM_CHUNK_BYTES = int(os.getenv('STREAM_CHUNK_BYTES', 256 * 1024))
+STREAM_QUEUE_CHUNKS = int(os.getenv('STREAM_QUEUE_CHUNKS', 8))
+
+
+class PdfRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= UPLOAD_SPOOL_BYTES:
+            return io.BytesIO()
+        # Anonymous file that disappears as soon as it is closed
+        return tempfile.TemporaryFile('w+b', dir=UPLOAD_SCRATCH_DIR)
+
+
+def open_upload(file_storage):
+    # Returns a seekable stream over the uploaded bytes without copying them.
+    # Werkzeug closes the upload when the request context ends, which happens
+    # before a streamed response is sent, so the stream returned here must
+    # not depend on the original file object staying open.
+    stream = file_storage.stream
+    if isinstance(stream, io.BytesIO):
+        # getvalue() and BytesIO(bytes) share the buffer instead of copying it
+        return io.BytesIO(stream.getvalue())
+
+    stream.flush()
+    if os.fstat(stream.fileno()).st_size == 0:
+        return io.BytesIO()
+    # The map keeps its own file descriptor, so it outlives the upload
+    return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def open_stored_file(path):
+    # Like open_upload, for a document already on disk. The map stays
+    # readable even if the file is removed while a response is streaming.
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return io.BytesIO()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _StreamCancelled(Exception):
+    pass
+
+
+class _ChunkSink:
+    # File-like object handed to the PDF writer. Written bytes are grouped
+    # into chunks and passed to the response through a bounded queue, so the
+    # writer waits for the client instead of buffering the whole document.
+    def __init__(self, chunks, cancelled):
+        self._chunks = chunks
+        self._cancelled = cancelled
+        self._buffer = bytearray()
+        self._position = 0
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        if len(self._buffer) >= STREAM_CHUNK_BYTES:
+            self.flush()
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+
+    def put(self, item):
+        while True:
+            try:
+                self._chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                if self._cancelled.is_set():
+                    raise _StreamCancelled()
+
+
+_DONE = object()
+
+
+def stream_output(write):
+    # Runs write(sink) in a background thread and yields the bytes it
+    # produces as they become available
+    chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    sink = _ChunkSink(chunks, cancelled)
+
+    def produce():
+        try:
+            write(sink)
+            sink.flush()
+            sink.put(_DONE)
+        except _StreamCancelled:
+            pass
+        except Exception as e:
+            print(f"Error while streaming output: {str(e)}")
+            try:
+                sink.put(e)
+            except _StreamCancelled:
+                pass
+
+    def generate():
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = chunks.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Stop the writer if the client went away
+            cancelled.set()
+            producer.join()
+
+    return generate()
+
+
+def send_pdf_stream(write, download_name, cleanup=None):
+    return send_stream(write, download_name, 'application/pdf', cleanup)
+
+
+def send_stream(write, download_name, mimetype, cleanup=None):
+    # The body is written after the request has been handled, so the write
+    # stage is reported to the request's metrics from the producer thread
+    request_metrics = metrics.current()
+    if request_metrics is not None:
+        write = _timed_write(write, request_metrics)
+    # Not a direct passthrough: Werkzeug only runs the call_on_close
+    # callbacks when it wraps the body itself
+    response = Response(stream_output(write), mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = 0
+    # Runs after the body has been sent, or dropped by the client
+    if cleanup is not None:
+        response.call_on_close(cleanup)
+    return response
+
+
+def _timed_write(write, request_metrics):
+    def timed_write(sink):
+        with request_metrics.stage('write'):
+            write(sink)
+        request_metrics.output_bytes = sink.tell()
+    return timed_write
+
+
+def read_upload(stream):
+    # Bytes of a stream returned by open_upload
+    if isinstance(stream, io.BytesIO):
+        return stream.getvalue()
+    stream.seek(0)
+    return stream.read()
+
+
+def write_upload(stream, sink):
+    # Copies a stream returned by open_upload to sink as it is
+    stream.seek(0)
+    while True:
+        chunk = stream.read(STREAM_CHUNK_BYTES)
+        if not chunk:
+            break
+        sink.write(chunk)
+
+
+class PositionWriter:
+    # Counts the bytes written to a stream that cannot report its position,
+    # such as a ZIP member, for PDF writers that record offsets with tell()
+    def __init__(self, stream):
+        self._stream = stream
+        self._position = 0
+
+    def write(self, data):
+        self._stream.write(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+
+def close_quietly(*streams):
+    for stream in streams:
+        try:
+            if stream is not None:
+                stream.close()
+        except Exception as e:
+            print(f"Warning: Error closing stream: {str(e)}")
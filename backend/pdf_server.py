@@ -1,44 +1,234 @@
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 import os
-import tempfile
-import subprocess
-import shutil
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
-from reportlab.lib.utils import ImageReader
 from werkzeug.utils import secure_filename
-from PIL import Image
 import io
-import img2pdf
+import hashlib
+import functools
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import json
+import math
+import re
+import zipfile
+import base64
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Local modules read their settings from the environment when imported.
+# Those that load PyPDF2, pikepdf, PIL or the ReportLab canvas (pdf_engine,
+# pdf_compress, watermark_image) are imported where they are first used, so
+# that starting a worker and answering health checks stay cheap; a preloaded
+# server imports them once before forking (see warm_up).
+from stamp_cache import StampCache
+from result_cache import ResultCache, code_version, input_digest
+from watermark_template import WatermarkTemplate, parse_template, stamp_position
+from pdf_io import PdfRequest, UPLOAD_SCRATCH_DIR, PositionWriter, open_upload, open_stored_file, read_upload, write_upload, send_pdf_stream, send_stream, close_quietly
+from jobs import JobManager
+from document_store import DocumentStore
+from upload_sessions import UploadSessions
+import metrics
+from metrics import timed
+from admission import AdmissionControl
+
 app = Flask(__name__)
+# Small uploads stay in memory, large ones are spilled to a scratch file
+app.request_class = PdfRequest
 
 # Configure CORS
 CORS(app, resources={
     r"/*": {
         "origins": "*",  # Allow all origins in development
-        "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization", "Accept", "Origin", "X-Requested-With"],
-        "expose_headers": ["Content-Disposition"]
+        "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+        "allow_headers": ["Content-Type", "Authorization", "Accept", "Origin", "X-Requested-With", "If-None-Match",
+                          "X-Chunk-Sha256"],
+        "expose_headers": ["Content-Disposition", "Server-Timing", "ETag", "X-Document-Id", "X-Page-Count"]
     }
 })
 
-def create_watermark_pdf(watermark_type, watermark_content, output_path, font_size=50, opacity=0.3, rotation=45, position='center', image_size=100):
+# Largest request body accepted, larger ones are answered with 413 (0 for no limit)
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 1024 * 1024 * 1024)) or None
+
+# Admission control: requests are weighed by upload size (one slot per
+# ADMISSION_SLOT_BYTES) and page count (one slot per ADMISSION_SLOT_PAGES), and
+# run while their weights fit in ADMISSION_SLOTS. Uploads up to
+# ADMISSION_SMALL_BYTES use a lane of their own. Requests that cannot be queued,
+# or wait longer than ADMISSION_QUEUE_TIMEOUT seconds, get 503 with Retry-After;
+# their uploads are read and discarded first up to ADMISSION_DRAIN_BYTES.
+# ADMISSION_SLOTS=0 turns admission control off.
+admission_control = AdmissionControl(
+    slots=int(os.getenv('ADMISSION_SLOTS', 4)),
+    queue_size=int(os.getenv('ADMISSION_QUEUE', 6)),
+    queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 30)),
+    slot_bytes=int(os.getenv('ADMISSION_SLOT_BYTES', 32 * 1024 * 1024)),
+    slot_pages=int(os.getenv('ADMISSION_SLOT_PAGES', 1000)),
+    small_bytes=int(os.getenv('ADMISSION_SMALL_BYTES', 1024 * 1024)),
+    small_slots=int(os.getenv('ADMISSION_SMALL_SLOTS', 2)),
+    small_queue_size=int(os.getenv('ADMISSION_SMALL_QUEUE', 4)),
+    retry_after=int(os.getenv('ADMISSION_RETRY_AFTER', 10)),
+    drain_bytes=int(os.getenv('ADMISSION_DRAIN_BYTES', 16 * 1024 * 1024))
+)
+# Registered first, so that requests are admitted before their uploads are parsed.
+# Job submissions only store their upload; the job queue limits the work itself.
+admission_control.init_app(app, light_endpoints=('create_job',))
+
+# Stage timings in a Server-Timing header, a JSON log line per request and /metrics
+metrics.init_app(app)
+
+# How stamps are applied: 'xobject' draws one shared Form XObject on every
+# page, 'merge' merges the stamp into each page's content stream
+WATERMARK_STAMP_MODE = os.getenv('WATERMARK_STAMP_MODE', 'xobject')
+WATERMARK_XOBJECT_NAME = '/ZenWatermark'
+WATERMARK_POSITIONS = ['center', 'top-left', 'top-right', 'bottom-left', 'bottom-right']
+WATERMARK_LAYERS = ['above', 'below']
+# Accepted ranges of the numeric watermark options: (smallest, largest)
+WATERMARK_TRANSPARENCY_RANGE = (0, 1)
+WATERMARK_ROTATION_RANGE = (-360, 360)
+WATERMARK_FONT_SIZE_RANGE = (1, 500)
+WATERMARK_IMAGE_SIZE_RANGE = (1, 500)
+# Watermark options given as text; pipeline steps may hold any JSON value
+WATERMARK_TEXT_FIELDS = ['watermarkType', 'watermarkText', 'position', 'layer', 'selectedPages', 'stampMode',
+                         'outputMode', 'templateFields']
+
+# How watermarked documents are written: 'full' rewrites the whole document,
+# 'incremental' copies the original file as it is and appends the stamped
+# pages (PyPDF2 engine, xobject stamps), 'auto' is incremental unless all
+# pages are selected. Requests choose with outputMode; the default is 'full'.
+# An incremental update holds the original, unwatermarked file byte for byte,
+# and anyone can get it back by cutting the output at its first %%EOF, so it
+# must not be used where the watermark is meant to mark or restrict copies.
+WATERMARK_OUTPUT_MODE = os.getenv('WATERMARK_OUTPUT_MODE', 'full')
+WATERMARK_OUTPUT_MODES = ['auto', 'full', 'incremental']
+
+# PDF engine used to parse, stamp, encrypt and write documents: 'pypdf2' or 'pikepdf'
+PDF_ENGINE = os.getenv('PDF_ENGINE', 'pypdf2')
+
+# Documents with at least this many pages are watermarked in parallel, one
+# page range per worker process (0 turns parallel watermarking off)
+WATERMARK_PARALLEL_PAGES = int(os.getenv('WATERMARK_PARALLEL_PAGES', 5000))
+WATERMARK_PARALLEL_WORKERS = int(os.getenv('WATERMARK_PARALLEL_WORKERS') or os.cpu_count() or 1)
+process_pools = {}
+process_pools_lock = threading.Lock()
+
+# Most operations one /pipeline request can chain
+PIPELINE_MAX_OPERATIONS = int(os.getenv('PIPELINE_MAX_OPERATIONS', 10))
+
+# Batch and merge requests: most files per request, and worker processes that
+# handle batches
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 500))
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS') or os.cpu_count() or 1)
+
+# Threads used to recompress images in /compress (defaults to the CPU count)
+COMPRESS_IMAGE_WORKERS = int(os.getenv('COMPRESS_IMAGE_WORKERS') or os.cpu_count() or 1)
+
+# Background jobs for large documents, processed by a pool of worker processes
+job_manager = JobManager(
+    root=os.getenv('JOBS_DIR') or None,
+    workers=int(os.getenv('JOB_WORKERS', 2)),
+    max_pending=int(os.getenv('JOB_MAX_PENDING', 16)),
+    ttl=int(os.getenv('JOB_TTL_SECONDS', 3600))
+)
+
+# Uploaded documents kept on disk so that /watermark-preview can refer to them
+# by id after the first request; removed DOCUMENT_TTL_SECONDS after their last
+# use, or sooner, least recently used first, beyond DOCUMENTS_MAX_BYTES
+document_store = DocumentStore(
+    root=os.getenv('DOCUMENTS_DIR') or None,
+    ttl=int(os.getenv('DOCUMENT_TTL_SECONDS', 1800)),
+    max_bytes=int(os.getenv('DOCUMENTS_MAX_BYTES', 4 * 1024 * 1024 * 1024))
+)
+
+# Resumable uploads of large documents, sent in chunks to /uploads. Chunks are
+# UPLOAD_CHUNK_BYTES unless the client asks for another size, between
+# UPLOAD_MIN_CHUNK_BYTES and UPLOAD_MAX_CHUNK_BYTES (and never more than
+# MAX_CONTENT_LENGTH). Files may be up to UPLOAD_MAX_FILE_BYTES, and uploads in
+# progress may hold up to UPLOADS_MAX_BYTES of disk between them. Uploads that
+# receive no chunk for UPLOAD_SESSION_TTL_SECONDS expire and are removed.
+# Finished uploads become documents of the document store, and keep their id.
+upload_sessions = UploadSessions(
+    root=os.getenv('UPLOADS_DIR') or None,
+    ttl=int(os.getenv('UPLOAD_SESSION_TTL_SECONDS', 3600)),
+    chunk_bytes=int(os.getenv('UPLOAD_CHUNK_BYTES', 8 * 1024 * 1024)),
+    max_bytes=int(os.getenv('UPLOADS_MAX_BYTES', 8 * 1024 * 1024 * 1024))
+)
+UPLOAD_MIN_CHUNK_BYTES = int(os.getenv('UPLOAD_MIN_CHUNK_BYTES', 256 * 1024))
+UPLOAD_MAX_CHUNK_BYTES = int(os.getenv('UPLOAD_MAX_CHUNK_BYTES', 64 * 1024 * 1024))
+UPLOAD_MAX_FILE_BYTES = int(os.getenv('UPLOAD_MAX_FILE_BYTES', 2 * 1024 * 1024 * 1024))
+UPLOAD_MAX_CHUNKS = 10000
+UPLOAD_NOT_FOUND = 'Upload not found, it may have expired; upload the file again'
+SHA256_PATTERN = re.compile(r'^[0-9a-fA-F]{64}$')
+
+# PNG previews: width in pixels when none is asked for, and the widest allowed.
+# pdfium, which draws them, must not be used by two threads at once.
+PREVIEW_IMAGE_WIDTH = int(os.getenv('PREVIEW_IMAGE_WIDTH', 800))
+PREVIEW_MAX_IMAGE_WIDTH = int(os.getenv('PREVIEW_MAX_IMAGE_WIDTH', 2000))
+preview_render_lock = threading.Lock()
+
+# Processed documents on disk, so repeated requests are not processed again
+# (RESULT_CACHE_BYTES=0 turns the cache off). Keys include the version of the
+# code and libraries that write results, and RESULT_CACHE_VERSION, which can
+# be changed to stop serving every result cached so far.
+RESULT_CACHE_MODULES = ['pdf_server.py', 'pdf_engine.py', 'pdf_io.py', 'stamp_cache.py', 'watermark_image.py',
+                        'watermark_template.py']
+RESULT_CACHE_PACKAGES = ['PyPDF2', 'pikepdf', 'reportlab', 'Pillow']
+result_cache = ResultCache(
+    root=os.getenv('RESULT_CACHE_DIR') or None,
+    max_bytes=int(os.getenv('RESULT_CACHE_BYTES', 1024 * 1024 * 1024)),
+    secret=os.getenv('RESULT_CACHE_SECRET') or None,
+    version=os.getenv('RESULT_CACHE_VERSION', '') + code_version(
+        [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in RESULT_CACHE_MODULES],
+        RESULT_CACHE_PACKAGES
+    )
+)
+
+# Rendered watermark stamps, shared by every request served by this process
+stamp_cache = StampCache(
+    max_entries=int(os.getenv('WATERMARK_CACHE_ENTRIES', 128)),
+    max_bytes=int(os.getenv('WATERMARK_CACHE_BYTES', 64 * 1024 * 1024))
+)
+
+# Image watermarks are scaled down to this resolution at their placed size
+# (0 keeps every pixel); opaque images are stored as JPEG of this quality
+WATERMARK_IMAGE_DPI = int(os.getenv('WATERMARK_IMAGE_DPI', 150))
+WATERMARK_IMAGE_JPEG_QUALITY = int(os.getenv('WATERMARK_IMAGE_JPEG_QUALITY', 90))
+
+# Prepared watermark images by content hash and size, so that stamps for
+# new page sizes or options do not decode and encode the image again
+image_cache = StampCache(
+    max_entries=int(os.getenv('WATERMARK_IMAGE_CACHE_ENTRIES', 32)),
+    max_bytes=int(os.getenv('WATERMARK_IMAGE_CACHE_BYTES', 32 * 1024 * 1024))
+)
+
+# Text watermarks that warm_up renders with the default options for letter and
+# A4 pages, so that a preloaded server starts with them in the stamp cache
+WARMUP_WATERMARK_TEXTS = [text for text in os.getenv('WARMUP_WATERMARK_TEXTS', 'CONFIDENTIAL,DRAFT').split(',') if text]
+
+def get_watermark_image(content, image_size):
+    from watermark_image import prepare_image
+
+    digest = hashlib.sha256(content).hexdigest()
+    key = (digest, image_size, WATERMARK_IMAGE_DPI, WATERMARK_IMAGE_JPEG_QUALITY)
+    return image_cache.get_or_render(key, lambda: prepare_image(
+        content, digest, image_size, WATERMARK_IMAGE_DPI, WATERMARK_IMAGE_JPEG_QUALITY
+    ))
+
+def render_watermark_stamp(watermark_type, watermark_content, font_size=50, opacity=0.3, rotation=45, position='center', image_size=100, pagesize=letter):
+    from reportlab.pdfgen import canvas
+
     try:
-        # Create output directory if it doesn't exist
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
-        # Create a PDF with ReportLab
-        c = canvas.Canvas(output_path, pagesize=letter)
+        # Render the stamp into memory instead of a temporary file
+        buffer = io.BytesIO()
+        c = canvas.Canvas(buffer, pagesize=pagesize)
         
         # Get page dimensions
-        page_width, page_height = letter
+        page_width, page_height = pagesize
         
         if watermark_type == 'text':
             # Set font and color for text watermark
@@ -50,21 +240,7 @@ def create_watermark_pdf(watermark_type, watermark_content, output_path, font_si
             text_height = font_size  # Approximate height
             
             # Calculate position based on the selected position
-            if position == 'center':
-                x = (page_width - text_width) / 2
-                y = (page_height - text_height) / 2
-            elif position == 'top-left':
-                x = 50
-                y = page_height - 50 - text_height
-            elif position == 'top-right':
-                x = page_width - 50 - text_width
-                y = page_height - 50 - text_height
-            elif position == 'bottom-left':
-                x = 50
-                y = 50
-            elif position == 'bottom-right':
-                x = page_width - 50 - text_width
-                y = 50
+            x, y = stamp_position(position, page_width, page_height, text_width, text_height)
             
             # Save the current state
             c.saveState()
@@ -80,31 +256,17 @@ def create_watermark_pdf(watermark_type, watermark_content, output_path, font_si
             c.restoreState()
             
         else:  # Image watermark
-            # Open and process the image
-            img = Image.open(watermark_content)
+            # Scaled and encoded once per image and size, then reused
+            img = get_watermark_image(watermark_content, image_size)
             
             # Calculate image size based on percentage
-            img_width, img_height = img.size
+            img_width, img_height = img.source_size
             scale_factor = image_size / 100.0
             new_width = img_width * scale_factor
             new_height = img_height * scale_factor
             
             # Calculate position based on the selected position
-            if position == 'center':
-                x = (page_width - new_width) / 2
-                y = (page_height - new_height) / 2
-            elif position == 'top-left':
-                x = 50
-                y = page_height - 50 - new_height
-            elif position == 'top-right':
-                x = page_width - 50 - new_width
-                y = page_height - 50 - new_height
-            elif position == 'bottom-left':
-                x = 50
-                y = 50
-            elif position == 'bottom-right':
-                x = page_width - 50 - new_width
-                y = 50
+            x, y = stamp_position(position, page_width, page_height, new_width, new_height)
             
             # Save the current state
             c.saveState()
@@ -114,429 +276,1388 @@ def create_watermark_pdf(watermark_type, watermark_content, output_path, font_si
             c.rotate(rotation)
             
             # Draw the image centered at the origin
-            c.drawImage(
-                ImageReader(img),
-                -new_width/2,
-                -new_height/2,
-                width=new_width,
-                height=new_height,
-                mask='auto'
-            )
+            img.draw(c, -new_width/2, -new_height/2, new_width, new_height)
             
             # Restore the state
             c.restoreState()
         
         c.save()
+        return buffer.getvalue()
+    except Exception as e:
+        print(f"Error in render_watermark_stamp: {str(e)}")
+        return None
+
+def get_watermark_stamp(watermark_type, watermark_content, font_size=50, opacity=0.3, rotation=45, position='center', image_size=100, pagesize=letter):
+    # Only the options that affect the rendered stamp are part of the key
+    if watermark_type == 'text':
+        key = ('text', watermark_content, font_size, None, opacity, rotation, position,
+               tuple(float(v) for v in pagesize))
+    else:
+        key = ('image', hashlib.sha256(watermark_content).hexdigest(), None, image_size,
+               opacity, rotation, position, tuple(float(v) for v in pagesize))
+
+    return stamp_cache.get_or_render(key, lambda: render_watermark_stamp(
+        watermark_type, watermark_content, font_size, opacity, rotation, position, image_size, pagesize
+    ))
+
+def create_watermark_pdf(watermark_type, watermark_content, output_path, font_size=50, opacity=0.3, rotation=45, position='center', image_size=100):
+    try:
+        # Image watermarks are passed as a path to the image file
+        if watermark_type != 'text':
+            with open(watermark_content, 'rb') as f:
+                watermark_content = f.read()
+
+        stamp = get_watermark_stamp(watermark_type, watermark_content, font_size, opacity, rotation, position, image_size)
+        if stamp is None:
+            return False
+
+        # Create output directory if it doesn't exist
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, 'wb') as f:
+            f.write(stamp)
         return True
     except Exception as e:
         print(f"Error in create_watermark_pdf: {str(e)}")
         return False
 
-def add_watermark(input_pdf, watermark_pdf, output_pdf, layer='above', selected_pages='all'):
+def record_pages(pages):
+    # The page count is reported in the metrics and weighs in on admission
+    metrics.record_pages(pages)
+    admission_control.record_pages(pages)
+
+def record_stored_document(meta):
+    # Requests that name a stored document by id have a small body, so they
+    # are weighed by the size of the document instead
+    admission_control.record_bytes(meta['bytes'])
+
+def parse_page_selection(selected_pages, page_count):
+    # Parse selected pages ("all" or a list such as "1,3,5-7") into zero-based
+    # indexes. Raises ValueError for a malformed list, which includes page 0
+    # and ranges that run backwards.
+    pages = set()
+    if selected_pages.lower() == 'all':
+        pages = set(range(page_count))
+    else:
+        for part in selected_pages.split(','):
+            if '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = end = int(part)
+            if not 1 <= start <= end:
+                raise ValueError(f'Invalid page range: {part}')
+            pages.update(range(start-1, end))
+    return pages
+
+def parse_number(value, limits, integer=False):
+    # Returns value as a number within limits, (smallest, largest), or None.
+    # Form fields arrive as text, pipeline steps as JSON numbers.
+    if isinstance(value, bool):
+        return None
+    if integer and isinstance(value, float) and not value.is_integer():
+        return None
     try:
-        template = PdfReader(input_pdf)
-        watermark = PdfReader(watermark_pdf)
-        output = PdfWriter()
-
-        # Parse selected pages
-        pages_to_watermark = set()
-        if selected_pages.lower() == 'all':
-            pages_to_watermark = set(range(len(template.pages)))
+        number = int(value) if integer else float(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if not math.isfinite(number) or not limits[0] <= number <= limits[1]:
+        return None
+    return number
+
+def open_document(source, engine=None):
+    # pdf_engine loads PyPDF2, and pikepdf when it is installed
+    import pdf_engine
+    return pdf_engine.open_document(source, engine)
+
+def stamp_placement(geometry):
+    # Size of the page as it is displayed, and the matrix that maps a stamp
+    # drawn for that size onto the page's own coordinate system
+    left, bottom, width, height, rotation = geometry
+    width, height = round(width, 2), round(height, 2)
+    if rotation == 90:
+        return (height, width), (0, 1, -1, 0, left + width, bottom)
+    if rotation == 180:
+        return (width, height), (-1, 0, 0, -1, left + width, bottom + height)
+    if rotation == 270:
+        return (height, width), (0, -1, 1, 0, left, bottom + height)
+    return (width, height), (1, 0, 0, 1, left, bottom)
+
+def watermark_document(input_pdf, watermark_pdf, layer='above', selected_pages='all', mode=None, engine=None, progress=None, workers=None, output_mode=None):
+    mode = mode or WATERMARK_STAMP_MODE
+    engine = engine or PDF_ENGINE
+    workers = WATERMARK_PARALLEL_WORKERS if workers is None else workers
+    output_mode = output_mode or WATERMARK_OUTPUT_MODE
+    if output_mode == 'auto':
+        incremental = selected_pages.lower() != 'all'
+    else:
+        incremental = output_mode == 'incremental'
+    with timed('parse'):
+        document = open_document(input_pdf, engine)
+        # Stamping a few pages of a large document costs little next to
+        # rewriting all of it. An incremental update only reads and writes the
+        # stamped pages, so it is chosen before the pages are counted.
+        # Documents that cannot be updated that way are written in full.
+        incremental = incremental and mode == 'xobject' and document.incremental_update()
+        record_pages(document.page_count)
+
+    pages_to_watermark = parse_page_selection(selected_pages, document.page_count)
+
+    if incremental:
+        with timed('stamp'):
+            stamp_pages(document, watermark_pdf, layer, pages_to_watermark, mode, progress)
+        return document
+
+    # Only merge stamping is split across processes. In xobject mode stamping
+    # is a small part of the time next to parsing and writing, which stitching
+    # the page ranges back together would have to do a second time.
+    if mode == 'merge' and workers > 1 and WATERMARK_PARALLEL_PAGES and document.page_count >= WATERMARK_PARALLEL_PAGES:
+        try:
+            with timed('stamp'):
+                return watermark_parallel(document, input_pdf, watermark_pdf, layer, pages_to_watermark, mode, engine, workers, progress)
+        finally:
+            close_quietly(document)
+
+    with timed('stamp'):
+        stamp_pages(document, watermark_pdf, layer, pages_to_watermark, mode, progress)
+    return document
+
+def stamp_pages(document, watermark_pdf, layer, pages_to_watermark, mode, progress=None):
+    from pdf_engine import IDENTITY_MATRIX
+
+    # watermark_pdf is either a ready-made stamp that is used as is on
+    # every page, or a function that renders a stamp for a page size.
+    # In the second case pages are grouped by their displayed size and
+    # one stamp is rendered and embedded per group.
+    if isinstance(watermark_pdf, WatermarkTemplate):
+        return stamp_template_pages(document, watermark_pdf, layer, pages_to_watermark, mode, progress)
+    stamps = {}
+    for i in range(document.page_count):
+        if progress is not None:
+            progress(i, document.page_count)
+        if i not in pages_to_watermark:
+            continue
+        if callable(watermark_pdf):
+            size, ctm = stamp_placement(document.page_geometry(i))
+        else:
+            size, ctm = None, IDENTITY_MATRIX
+        stamp = stamps.get(size)
+        if stamp is None:
+            name = f"{WATERMARK_XOBJECT_NAME}{len(stamps)}"
+            if size is None:
+                if isinstance(watermark_pdf, bytes):
+                    watermark_pdf = io.BytesIO(watermark_pdf)
+                stamp = document.import_stamp(watermark_pdf, name)
+            else:
+                with timed('render'):
+                    stamp_data = watermark_pdf(size)
+                if stamp_data is None:
+                    raise ValueError(f"Could not render a watermark for page size {size}")
+                stamp = document.import_stamp(io.BytesIO(stamp_data), name)
+            stamps[size] = stamp
+        document.stamp_page(i, stamp, ctm, layer, mode)
+
+def stamp_template_pages(document, template, layer, pages_to_watermark, mode, progress=None):
+    # Every watermarked page gets its own stamp, all rendered in one pass
+    pages = sorted(pages_to_watermark)
+    placements = [stamp_placement(document.page_geometry(i)) for i in pages]
+    with timed('render'):
+        stamp_data = template.render(
+            [template.first_page + i + 1 for i in pages],
+            template.total or document.page_count,
+            [size for size, _ in placements]
+        )
+    stamps = dict(zip(pages, zip(document.import_stamps(io.BytesIO(stamp_data), WATERMARK_XOBJECT_NAME), placements)))
+    for i in range(document.page_count):
+        if progress is not None:
+            progress(i, document.page_count)
+        if i in stamps:
+            stamp, (_, ctm) = stamps[i]
+            document.stamp_page(i, stamp, ctm, layer, mode)
+
+def get_process_pool(workers):
+    # Pools are created on first use, so forked server workers never inherit one
+    with process_pools_lock:
+        pool = process_pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            process_pools[workers] = pool
+        return pool
+
+def shutdown_process_pools():
+    with process_pools_lock:
+        pools = list(process_pools.values())
+        process_pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+def scratch_file():
+    return tempfile.NamedTemporaryFile('wb', suffix='.pdf', dir=UPLOAD_SCRATCH_DIR, delete=False)
+
+def watermark_page_range(input_path, start, end, watermark_pdf, layer, pages_to_watermark, mode, engine):
+    # Runs in a worker process: stamps pages start to end - 1 and writes
+    # them to a scratch file whose path is returned
+    document = open_document(input_path, engine)
+    part = document.extract_pages(start, end)
+    try:
+        stamp_pages(part, watermark_pdf, layer, pages_to_watermark, mode)
+        with scratch_file() as output:
+            part.write(output)
+        return output.name
+    finally:
+        close_quietly(part, document)
+
+def watermark_parallel(document, input_pdf, watermark_pdf, layer, pages_to_watermark, mode, engine, workers, progress=None):
+    # Stamps are rendered here, once per page size, and handed to every worker.
+    # Templates are rendered by the workers, each for its own page range.
+    if isinstance(watermark_pdf, WatermarkTemplate):
+        pass
+    elif callable(watermark_pdf):
+        stamps = {}
+        for i in sorted(pages_to_watermark):
+            size, _ = stamp_placement(document.page_geometry(i))
+            if size not in stamps:
+                stamps[size] = watermark_pdf(size)
+        watermark_pdf = stamps.get
+    elif not isinstance(watermark_pdf, str):
+        watermark_pdf.seek(0)
+        watermark_pdf = watermark_pdf.read()
+
+    # Workers read the input from a file rather than receiving a copy of it
+    input_path = input_pdf if isinstance(input_pdf, str) else None
+    if input_path is None:
+        with scratch_file() as spilled:
+            input_pdf.seek(0)
+            shutil.copyfileobj(input_pdf, spilled)
+        input_path = spilled.name
+
+    page_count = document.page_count
+    workers = min(workers, page_count)
+    bounds = [page_count * k // workers for k in range(workers + 1)]
+    futures = {}
+    parts = {}
+    try:
+        for k in range(workers):
+            start, end = bounds[k], bounds[k + 1]
+            pages = {i - start for i in pages_to_watermark if start <= i < end}
+            stamp = watermark_pdf
+            if isinstance(watermark_pdf, WatermarkTemplate):
+                stamp = watermark_pdf.for_range(start, page_count)
+            future = get_process_pool(workers).submit(
+                watermark_page_range, input_path, start, end, stamp, layer, pages, mode, engine
+            )
+            futures[future] = k
+        done = 0
+        for future in as_completed(futures):
+            k = futures[future]
+            parts[k] = future.result()
+            done += bounds[k + 1] - bounds[k]
+            if progress is not None:
+                progress(done, page_count)
+
+        # Stitch the stamped ranges back together in page order
+        result = open_document(parts[0], engine)
+        for k in range(1, workers):
+            result.append(open_document(parts[k], engine))
+        return result
+    finally:
+        # Collect the ranges that were still running when another one failed
+        for future, k in futures.items():
+            if k not in parts and not future.cancel() and future.exception() is None:
+                parts[k] = future.result()
+        # Open documents keep their own handle on a removed file
+        for path in parts.values():
+            os.remove(path)
+        if input_path is not input_pdf:
+            os.remove(input_path)
+
+def add_watermark(input_pdf, watermark_pdf, output_pdf, layer='above', selected_pages='all', mode=None, engine=None, progress=None, workers=None, output_mode=None):
+    document = None
+    try:
+        document = watermark_document(input_pdf, watermark_pdf, layer, selected_pages, mode, engine, progress, workers, output_mode)
+        if isinstance(output_pdf, str):
+            with open(output_pdf, 'wb') as file:
+                document.write(file)
         else:
-            for part in selected_pages.split(','):
-                if '-' in part:
-                    start, end = map(int, part.split('-'))
-                    pages_to_watermark.update(range(start-1, end))
-                else:
-                    pages_to_watermark.add(int(part)-1)
-
-        for i in range(len(template.pages)):
-            page = template.pages[i]
-            if i in pages_to_watermark:
-                if layer == 'above':
-                    page.merge_page(watermark.pages[0])
-                else:  # below
-                    watermark_page = watermark.pages[0]
-                    watermark_page.merge_page(page)
-                    page = watermark_page
-            output.add_page(page)
-
-        with open(output_pdf, 'wb') as file:
-            output.write(file)
+            document.write(output_pdf)
+        if progress is not None:
+            progress(document.page_count, document.page_count)
         return True
     except Exception as e:
         print(f"Error in add_watermark: {str(e)}")
         return False
+    finally:
+        close_quietly(document)
+
+def parse_watermark_options(form, files):
+    # Returns (options, None) for a valid watermark request, or (None, error message)
+    for field in WATERMARK_TEXT_FIELDS:
+        if field in form and not isinstance(form[field], str):
+            return None, f'{field} must be a string'
+    watermark_type = form.get('watermarkType', 'text')
+    if watermark_type not in ['text', 'image', 'template']:
+        return None, 'Invalid watermark type'
+    
+    template_fields = None
+    if watermark_type in ['text', 'template']:
+        watermark_content = form.get('watermarkText', '')
+        if not watermark_content:
+            return None, 'Watermark text is required'
+    if watermark_type == 'template':
+        # Values for named fields such as {user}; {n} and {total} are filled in per page
+        try:
+            template_fields = json.loads(form.get('templateFields') or '{}')
+        except ValueError:
+            template_fields = None
+        if not isinstance(template_fields, dict):
+            return None, 'Template fields must be a JSON object'
+        _, error = parse_template(watermark_content, template_fields)
+        if error:
+            return None, error
+    elif watermark_type == 'image':
+        if 'watermarkImage' not in files:
+            return None, 'No watermark image provided'
+        watermark_content = files['watermarkImage']
+        if watermark_content.filename == '':
+            return None, 'No selected watermark image'
+        if not watermark_content.filename.lower().endswith(('.jpg', '.jpeg', '.png')):
+            return None, 'Watermark image must be JPEG or PNG'
+    
+    options = {
+        'watermark_type': watermark_type,
+        'position': form.get('position', 'center'),
+        'transparency': parse_number(form.get('transparency', 0.3), WATERMARK_TRANSPARENCY_RANGE),
+        'rotation': parse_number(form.get('rotation', 45), WATERMARK_ROTATION_RANGE),
+        'layer': form.get('layer', 'above'),
+        'selected_pages': form.get('selectedPages', 'all'),
+        'font_size': parse_number(form.get('fontSize', 50), WATERMARK_FONT_SIZE_RANGE, integer=True),
+        'image_size': parse_number(form.get('imageSize', 100), WATERMARK_IMAGE_SIZE_RANGE, integer=True),
+        'stamp_mode': form.get('stampMode', WATERMARK_STAMP_MODE),
+        'output_mode': form.get('outputMode', WATERMARK_OUTPUT_MODE),
+    }
+    for key, label, limits in [('transparency', 'Transparency', WATERMARK_TRANSPARENCY_RANGE),
+                               ('rotation', 'Rotation', WATERMARK_ROTATION_RANGE),
+                               ('font_size', 'Font size', WATERMARK_FONT_SIZE_RANGE),
+                               ('image_size', 'Image size', WATERMARK_IMAGE_SIZE_RANGE)]:
+        if options[key] is None:
+            return None, f'{label} must be a number from {limits[0]} to {limits[1]}'
+    if options['layer'] not in WATERMARK_LAYERS:
+        return None, 'Invalid layer, use above or below'
+    if options['stamp_mode'] not in ['xobject', 'merge']:
+        return None, 'Invalid stamp mode'
+    if options['output_mode'] not in WATERMARK_OUTPUT_MODES:
+        return None, 'Invalid output mode'
+    if options['position'] not in WATERMARK_POSITIONS:
+        return None, 'Invalid watermark position'
+    # Page lists are checked before the document's page count is known
+    try:
+        parse_page_selection(options['selected_pages'], 0)
+    except ValueError:
+        return None, 'Invalid page selection'
+    
+    # Image watermarks are kept as bytes so the options can be passed to a job
+    if watermark_type == 'image':
+        watermark_content = watermark_content.read()
+    options['watermark_content'] = watermark_content
+    if template_fields is not None:
+        options['template_fields'] = template_fields
+    return options, None
+
+def watermark_renderer(options):
+    # Stamps are rendered per page size while the watermark is applied,
+    # and only if they are not cached yet. Templates render a stamp per page.
+    if options['watermark_type'] == 'template':
+        runs, _ = parse_template(options['watermark_content'], options['template_fields'])
+        return WatermarkTemplate(runs, options['font_size'], options['transparency'], options['rotation'], options['position'])
+    return functools.partial(
+        get_watermark_stamp, options['watermark_type'], options['watermark_content'], options['font_size'],
+        options['transparency'], options['rotation'], options['position'], options['image_size']
+    )
+
+# Encryption offered by /protect-pdf: the engine's standard encryption, or
+# AES-256, which only pikepdf can write
+PROTECT_ENCRYPTION = ['standard', 'aes256']
+
+def protect_document(input_pdf, password, engine=None, aes256=False):
+    with timed('parse'):
+        document = open_document(input_pdf, engine or PDF_ENGINE)
+        record_pages(document.page_count)
+    with timed('encrypt'):
+        document.encrypt(password, aes256)
+    return document
+
+# Passwords tried when an encrypted PDF is unlocked without one
+COMMON_PASSWORDS = [
+    '',  # Empty password
+    'password',
+    '123456',
+    'admin',
+    'user',
+    '1234',
+    '12345',
+    '12345678',
+    'qwerty',
+    'abc123',
+    '0000',
+    '1111',
+    '2222',
+    '3333',
+    '4444',
+    '5555',
+    '6666',
+    '7777',
+    '8888',
+    '9999',
+    # Add more common passwords
+    'admin123',
+    'password123',
+    'welcome',
+    'welcome123',
+    'test',
+    'test123',
+    'guest',
+    'guest123',
+    'default',
+    'default123',
+    'user123',
+    'admin1234',
+    'password1234',
+    '123456789',
+    '1234567890',
+    'qwerty123',
+    'qwerty1234',
+    'qwertyuiop',
+    'asdfghjk',
+    'zxcvbnm',
+    'qwerty1',
+    'qwerty12',
+    'qwerty123',
+    'qwerty1234',
+    'qwerty12345',
+    'qwerty123456',
+    'qwerty1234567',
+    'qwerty12345678',
+    'qwerty123456789',
+    'qwerty1234567890',
+    'qwertyuiop123',
+    'qwertyuiop1234',
+    'qwertyuiop12345',
+    'qwertyuiop123456',
+    'qwertyuiop1234567',
+    'qwertyuiop12345678',
+    'qwertyuiop123456789',
+    'qwertyuiop1234567890',
+    'asdfghjk123',
+    'asdfghjk1234',
+    'asdfghjk12345',
+    'asdfghjk123456',
+    'asdfghjk1234567',
+    'asdfghjk12345678',
+    'asdfghjk123456789',
+    'asdfghjk1234567890',
+    'zxcvbnm123',
+    'zxcvbnm1234',
+    'zxcvbnm12345',
+    'zxcvbnm123456',
+    'zxcvbnm1234567',
+    'zxcvbnm12345678',
+    'zxcvbnm123456789',
+    'zxcvbnm1234567890',
+    'qwerty1!',
+    'qwerty12!',
+    'qwerty123!',
+    'qwerty1234!',
+    'qwerty12345!',
+    'qwerty123456!',
+    'qwerty1234567!',
+    'qwerty12345678!',
+    'qwerty123456789!',
+    'qwerty1234567890!'
+]
+
+def unlock_document(input_pdf, password='', engine=None):
+    # Returns (document, None) once the document is decrypted, or (None, error message)
+    with timed('parse'):
+        document = open_document(input_pdf, engine or PDF_ENGINE)
+    error = decrypt_document(document, password)
+    if error:
+        close_quietly(document)
+        return None, error
+    return document, None
+
+def decrypt_document(document, password=''):
+    # Decrypts an open document with password, or with one of the common
+    # passwords when none is given. Returns None, or an error message.
+    print(f"PDF is encrypted: {document.is_encrypted}")
+    
+    # Check if PDF is encrypted
+    if not document.is_encrypted:
+        # Counting pages would mean reading the whole page tree, which an
+        # unencrypted document returned as it is never needs
+        return None
+    print("PDF is encrypted, attempting to decrypt...")
+    
+    # First try with provided password
+    if password:
+        try:
+            with timed('decrypt'):
+                success = document.decrypt(password)
+            print(f"Decryption with provided password {'succeeded' if success else 'failed'}")
+        except Exception as e:
+            print(f"Error decrypting with provided password: {str(e)}")
+            success = False
+        if not success:
+            return 'Incorrect password provided'
+        record_pages(document.page_count)
+        return None
+
+    # If no password provided, try common passwords
+    for pwd in COMMON_PASSWORDS:
+        try:
+            print(f"Trying password: {pwd}")
+            with timed('decrypt'):
+                success = document.decrypt(pwd)
+            if success:
+                print(f"Successfully decrypted with password: {pwd}")
+                record_pages(document.page_count)
+                return None
+        except Exception as e:
+            print(f"Failed to decrypt with password {pwd}: {str(e)}")
+            continue
+    
+    print("All password attempts failed")
+    return 'Could not decrypt PDF. Please provide the correct password.'
+
+# Operations /pipeline can chain on one parsed document. unlock can only
+# come first and protect only last, since encryption applies to the write.
+PIPELINE_OPERATIONS = ['unlock', 'watermark', 'protect']
+
+def parse_pipeline_watermark(operation, files):
+    # Watermark steps take the /watermark-pdf form fields, with images
+    # named by the upload field that holds them
+    form = dict(operation)
+    if isinstance(form.get('templateFields'), dict):
+        form['templateFields'] = json.dumps(form['templateFields'])
+    step_files = {}
+    if form.get('watermarkImage') in files:
+        image = files[form['watermarkImage']]
+        # Several steps may use the same image
+        image.stream.seek(0)
+        step_files['watermarkImage'] = image
+    try:
+        options, error = parse_watermark_options(form, step_files)
+        if error:
+            return None, error
+    except (AttributeError, TypeError, ValueError):
+        return None, 'Invalid watermark options'
+    return options, None
+
+def parse_pipeline(operations, files):
+    # Returns ([(operation, options), ...], None) for a valid pipeline, or
+    # (None, error message). Nothing is read from the PDF here.
+    try:
+        operations = json.loads(operations or '')
+    except ValueError:
+        operations = None
+    if not isinstance(operations, list) or not operations:
+        return None, 'Operations must be a non-empty JSON list'
+    if len(operations) > PIPELINE_MAX_OPERATIONS:
+        return None, f'Too many operations, the limit is {PIPELINE_MAX_OPERATIONS}'
+
+    steps = []
+    for number, operation in enumerate(operations, 1):
+        name = operation.get('op') if isinstance(operation, dict) else None
+        if name not in PIPELINE_OPERATIONS:
+            return None, f"Step {number}: unknown operation, use one of {', '.join(PIPELINE_OPERATIONS)}"
+        if name == 'unlock':
+            if number != 1:
+                return None, f'Step {number}: unlock must be the first operation'
+            password = operation.get('password', '')
+            if not isinstance(password, str):
+                return None, f'Step {number}: password must be a string'
+            options = {'password': password}
+        elif name == 'protect':
+            if number != len(operations):
+                return None, f'Step {number}: protect must be the last operation'
+            password = operation.get('password')
+            if not password or not isinstance(password, str):
+                return None, f'Step {number}: No password provided'
+            encryption = operation.get('encryption', 'standard')
+            if encryption not in PROTECT_ENCRYPTION:
+                return None, f'Step {number}: Invalid encryption, use standard or aes256'
+            options = {'password': password, 'aes256': encryption == 'aes256'}
+        else:
+            options, error = parse_pipeline_watermark(operation, files)
+            if error:
+                return None, f'Step {number}: {error}'
+        steps.append((name, options))
+    return steps, None
+
+def pipeline_cache_params(steps):
+    # Pipelines that protect the document are never cached, like /protect-pdf
+    params = []
+    for name, options in steps:
+        if name == 'protect':
+            return None
+        params.append([name, unlock_cache_params(options['password']) if name == 'unlock' else watermark_cache_params(options)])
+    return params
+
+def run_pipeline(input_pdf, steps, engine=None):
+    # Applies every step to one parsed document, which is written once by
+    # the caller. Returns (document, None), or (None, error message).
+    with timed('parse'):
+        document = open_document(input_pdf, engine or PDF_ENGINE)
+    try:
+        # is_encrypted stays true once a document has been decrypted
+        unlocked = False
+        for name, options in steps:
+            if name == 'unlock':
+                error = decrypt_document(document, options['password'])
+                if error:
+                    close_quietly(document)
+                    return None, error
+                unlocked = True
+                continue
+            if document.is_encrypted and not unlocked:
+                close_quietly(document)
+                return None, 'PDF is encrypted, start the pipeline with an unlock operation'
+            if name == 'watermark':
+                pages_to_watermark = parse_page_selection(options['selected_pages'], document.page_count)
+                # Checked before anything is stamped, as the page count is
+                # only known once the document is open
+                if not pages_to_watermark or max(pages_to_watermark) >= document.page_count:
+                    close_quietly(document)
+                    return None, f"Selected pages {options['selected_pages']} are outside the document, which has {document.page_count} pages"
+                with timed('stamp'):
+                    stamp_pages(document, watermark_renderer(options), options['layer'], pages_to_watermark, options['stamp_mode'])
+            else:
+                with timed('encrypt'):
+                    document.encrypt(options['password'], options['aes256'])
+        record_pages(document.page_count)
+    except BaseException:
+        close_quietly(document)
+        raise
+    return document, None
+
+# Job functions run in a worker process with the job's input and output paths
+# and a progress callback that takes (pages done, total pages)
+def run_watermark_job(input_path, output_path, progress, options):
+    try:
+        if not add_watermark(input_path, watermark_renderer(options), output_path, options['layer'],
+                             options['selected_pages'], options['stamp_mode'], progress=progress,
+                             output_mode=options['output_mode']):
+            raise RuntimeError('Failed to apply watermark')
+    finally:
+        # A job worker cannot exit cleanly while it still owns a pool of its own
+        shutdown_process_pools()
+
+def run_protect_job(input_path, output_path, progress, password):
+    write_job_output(protect_document(input_path, password), output_path, progress)
+
+def run_unlock_job(input_path, output_path, progress, password):
+    document, error = unlock_document(input_path, password)
+    if error:
+        raise ValueError(error)
+    if not document.is_encrypted:
+        # Nothing to remove, so the input is the result
+        close_quietly(document)
+        shutil.copyfile(input_path, output_path)
+        return
+    write_job_output(document, output_path, progress)
+
+# Batch functions run in a worker process and return the processed file's bytes
+def watermark_pdf_bytes(data, options):
+    document = watermark_document(
+        io.BytesIO(data), watermark_renderer(options), options['layer'], options['selected_pages'], options['stamp_mode'], workers=1,
+        output_mode=options['output_mode']
+    )
+    return write_document_bytes(document)
+
+def protect_pdf_bytes(data, password):
+    return write_document_bytes(protect_document(io.BytesIO(data), password))
+
+def write_document_bytes(document):
+    output = io.BytesIO()
+    try:
+        document.write(output)
+    finally:
+        close_quietly(document)
+    return output.getvalue()
+
+def write_batch_archive(output, entries, function, args):
+    # Writes a ZIP of processed files to output, a stream that cannot seek.
+    # entries are (file name, name in the archive, upload stream or None, error).
+    # Files are processed in worker processes and each one is added to the
+    # archive as soon as it is done; a manifest describing every file comes last.
+    pool = get_process_pool(BATCH_WORKERS)
+    manifest = [
+        {'file': file_name, 'output': None, 'status': 'error', 'error': error, 'bytes': None}
+        for file_name, _, _, error in entries
+    ]
+    waiting = [(i, entry) for i, entry in enumerate(entries) if entry[3] is None]
+    waiting.reverse()
+    running = {}
+    try:
+        # PDFs are compressed already, so members are stored as they are
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+            while waiting or running:
+                # Keep a couple of files per worker in flight, not the whole batch
+                while waiting and len(running) < BATCH_WORKERS * 2:
+                    i, (_, _, stream, _) = waiting.pop()
+                    running[pool.submit(function, read_upload(stream), *args)] = i
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    file_name, archive_name = entries[i][:2]
+                    try:
+                        data = future.result()
+                    except Exception as e:
+                        print(f"Error processing {file_name}: {str(e)}")
+                        manifest[i]['error'] = str(e)
+                        continue
+                    archive.writestr(archive_name, data)
+                    manifest[i].update(output=archive_name, status='ok', error=None, bytes=len(data))
+            archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+    finally:
+        # Stop work that nobody will receive if the client went away
+        for future in running:
+            future.cancel()
+
+def batch_entries(files, prefix):
+    # Pairs each upload with a unique name in the archive, or with the reason it is skipped
+    entries = []
+    names = set()
+    for file in files:
+        if not file.filename.lower().endswith('.pdf'):
+            entries.append((file.filename, None, None, 'File must be a PDF'))
+            continue
+        base = f"{prefix}{secure_filename(file.filename)}"
+        name, number = base, 1
+        while name in names:
+            number += 1
+            name = f"{base[:-4]}-{number}.pdf"
+        names.add(name)
+        entries.append((file.filename, name, open_upload(file), None))
+    return entries
+
+def check_pdf_upload(file):
+    # Returns an error message for a missing or non-PDF upload, or None
+    if file is None:
+        return 'No file provided'
+    if file.filename == '':
+        return 'No selected file'
+    if not file.filename.lower().endswith('.pdf'):
+        return 'File must be a PDF'
+    return None
+
+def open_pages_document(input_pdf):
+    # Returns (document, None), or (None, error message) for a PDF whose
+    # pages cannot be read without a password
+    with timed('parse'):
+        document = open_document(input_pdf, PDF_ENGINE)
+    if document.is_encrypted:
+        close_quietly(document)
+        return None, 'PDF is encrypted, unlock it first'
+    record_pages(document.page_count)
+    return document, None
+
+def page_indexes(selected_pages, page_count):
+    # Zero-based indexes of the selected pages that exist, in page order
+    return sorted(i for i in parse_page_selection(selected_pages, page_count) if 0 <= i < page_count)
+
+def split_parts(ranges, every_pages, page_count):
+    # Page indexes of each output of a split: one per comma-separated part
+    # of ranges, or one per every_pages pages. Returns (parts, None), or
+    # (None, error message).
+    if ranges:
+        parts = []
+        for part in ranges.split(','):
+            indexes = page_indexes(part, page_count)
+            if not indexes:
+                return None, f'Page range {part.strip()} is outside the document'
+            parts.append(indexes)
+        return parts, None
+    return [list(range(start, min(start + every_pages, page_count))) for start in range(0, page_count, every_pages)], None
+
+def write_split_archive(output, document, parts, stem, zip64=False):
+    # Writes a ZIP with one PDF per part to output, a stream that cannot seek.
+    # Parts are written one at a time, straight into the archive, and the
+    # objects read for a part are dropped before the next one.
+    names = set()
+    # PDFs are compressed already, so members are stored as they are
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+        for indexes in parts:
+            first, last = indexes[0] + 1, indexes[-1] + 1
+            base = f"{stem}_page_{first}" if first == last else f"{stem}_pages_{first}-{last}"
+            name, number = f"{base}.pdf", 1
+            while name in names:
+                number += 1
+                name = f"{base}-{number}.pdf"
+            names.add(name)
+
+            part = document.select_pages(indexes)
+            try:
+                with archive.open(name, 'w', force_zip64=zip64) as member:
+                    part.write(PositionWriter(member))
+            finally:
+                close_quietly(part)
+                document.release_objects()
+
+def watermark_cache_params(options):
+    # Everything that affects the watermarked output; images by their hash
+    params = dict(options, engine=PDF_ENGINE)
+    if options['watermark_type'] == 'image':
+        params['watermark_content'] = hashlib.sha256(options['watermark_content']).hexdigest()
+        params['image_dpi'] = WATERMARK_IMAGE_DPI
+        params['image_jpeg_quality'] = WATERMARK_IMAGE_JPEG_QUALITY
+    return params
+
+def unlock_cache_params(password):
+    # Passwords only appear as a keyed hash, so a key reveals nothing about them
+    return {'password': result_cache.secret_digest(password), 'engine': PDF_ENGINE}
+
+def result_cache_key(operation, input_stream, params):
+    if not result_cache.enabled:
+        return None
+    with timed('hash'):
+        return result_cache.key(operation, input_digest(input_stream), params)
+
+def cached_result_response(key, download_name):
+    # Returns a response for a result that the client or the cache already
+    # has, or None when the document has to be processed
+    if key is None:
+        return None
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        file = result_cache.open(key)
+        if file is None:
+            return None
+        response = send_file(file, mimetype='application/pdf', as_attachment=True, download_name=download_name, max_age=0)
+    response.set_etag(key)
+    return response
+
+def send_cached_pdf_stream(key, write, download_name, cleanup):
+    # Streams the result while it is being written and stores it under key
+    response = send_pdf_stream(result_cache.writer(key, write), download_name, cleanup=cleanup)
+    if key is not None:
+        response.set_etag(key)
+    return response
+
+def write_job_output(document, output_path, progress):
+    try:
+        progress(0, document.page_count)
+        with open(output_path, 'wb') as f:
+            document.write(f)
+        progress(document.page_count, document.page_count)
+    finally:
+        close_quietly(document)
+
+def open_finished_upload(upload_id):
+    # Opens a finished chunked upload, for routes that take an uploadId in
+    # place of the file part. Returns (stream, file name), or None when the
+    # upload is unknown or has expired.
+    meta = document_store.get(upload_id)
+    if meta is None:
+        return None
+    record_stored_document(meta)
+    try:
+        return open_stored_file(document_store.file_path(upload_id)), meta['fileName']
+    except FileNotFoundError:
+        return None
+
+def preview_page(document_id, meta, index):
+    # Returns ((path of a one-page PDF of page index, page count), None), or
+    # (None, error message). The page is copied out of the stored document the
+    # first time it is previewed, so later previews parse one page, not the
+    # whole document.
+    page_count = meta.get('pages')
+    if page_count is not None and not 0 <= index < page_count:
+        return None, f'Page {index + 1} is not in the document, which has {page_count} pages'
+    page_path = document_store.file_path(document_id, f'page-{index + 1}.pdf')
+    if page_count is not None and os.path.exists(page_path):
+        return (page_path, page_count), None
+
+    part = None
+    with timed('parse'):
+        document = open_document(document_store.file_path(document_id), PDF_ENGINE)
+    try:
+        if document.is_encrypted:
+            return None, 'PDF is encrypted, unlock it first'
+        # Only the previewed page is read
+        document.read_pages_lazily()
+        page_count = document.page_count
+        if page_count != meta.get('pages'):
+            document_store.update(document_id, pages=page_count)
+        if not 0 <= index < page_count:
+            return None, f'Page {index + 1} is not in the document, which has {page_count} pages'
+        part = document.select_pages([index])
+        with timed('write'):
+            document_store.write_file(document_id, os.path.basename(page_path), part.write)
+        return (page_path, page_count), None
+    finally:
+        close_quietly(part, document)
+
+def render_preview_image(pdf_data, width):
+    # PNG of the first page of a PDF, width pixels wide
+    import pypdfium2
+
+    with preview_render_lock:
+        document = pypdfium2.PdfDocument(pdf_data)
+        try:
+            page = document[0]
+            try:
+                image = page.render(scale=width / page.get_width()).to_pil()
+            finally:
+                page.close()
+        finally:
+            document.close()
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue()
+
+def warm_up():
+    # Loads what the first requests would otherwise load: PyPDF2 (and pikepdf),
+    # PIL, the ReportLab canvas and font metrics, and the stamps of common
+    # watermarks. A preloaded server calls this before forking its workers,
+    # which then share the memory instead of each loading their own copy.
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfbase import pdfmetrics
+    import pdf_compress  # noqa: F401
+    import watermark_image  # noqa: F401
+
+    pdfmetrics.getFont('Helvetica-Bold')
+    for text in WARMUP_WATERMARK_TEXTS:
+        for pagesize in (letter, A4):
+            get_watermark_stamp('text', text, 50, 0.3, 45, 'center', 100, pagesize)
+
+    # One small document through parsing, stamping and writing
+    sample = render_watermark_stamp('text', 'ZenPDF', 12, 1, 0, 'center', 100, letter)
+    if not add_watermark(io.BytesIO(sample), io.BytesIO(sample), io.BytesIO(), workers=1):
+        print("Warning: warm-up watermark failed")
+
+@app.errorhandler(413)
+def request_too_large(error):
+    limit = app.config['MAX_CONTENT_LENGTH']
+    return {'error': f'Upload is too large, the limit is {limit // (1024 * 1024)} MB'}, 413
 
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({"status": "ok", "message": "Server is running"})
 
+@app.route('/watermark-cache/stats', methods=['GET'])
+def watermark_cache_stats():
+    return jsonify(stamp_cache.stats())
+
+@app.route('/watermark-image-cache/stats', methods=['GET'])
+def watermark_image_cache_stats():
+    return jsonify(image_cache.stats())
+
+@app.route('/documents/stats', methods=['GET'])
+def document_stats():
+    return jsonify(document_store.stats())
+
+@app.route('/uploads/stats', methods=['GET'])
+def upload_stats():
+    return jsonify(upload_sessions.stats())
+
+@app.route('/admission/stats', methods=['GET'])
+def admission_stats():
+    return jsonify(admission_control.stats())
+
+@app.route('/result-cache/stats', methods=['GET'])
+def result_cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/results/<key>', methods=['GET'])
+def cached_result(key):
+    # Downloads a result again by its ETag, for clients that retry a download
+    file = result_cache.open(key)
+    if file is None:
+        return {'error': 'Result not found'}, 404
+    return send_file(
+        file,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=secure_filename(request.args.get('name', '')) or 'result.pdf',
+        etag=key,
+        max_age=0,
+        conditional=True
+    )
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return metrics.render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    # Starts a resumable upload of a large document: the client sends the
+    # file's name and size, and optionally a chunk size and the SHA-256 of
+    # the whole file. Chunks are then sent with PUT /uploads/<id>/chunks/<n>,
+    # in any order and again after a failure, GET /uploads/<id> lists the
+    # chunks still missing, and POST /uploads/<id>/complete finishes the
+    # upload. The id can then be sent as uploadId to /watermark-pdf,
+    # /protect-pdf and /unlock-pdf, or as documentId to /watermark-preview.
+    try:
+        file_name = request.form.get('fileName', '')
+        if not file_name:
+            return {'error': 'No file name provided'}, 400
+        if not file_name.lower().endswith('.pdf'):
+            return {'error': 'File must be a PDF'}, 400
+        try:
+            size = int(request.form.get('size', ''))
+            chunk_size = int(request.form.get('chunkSize', upload_sessions.chunk_bytes))
+        except ValueError:
+            return {'error': 'Size and chunk size must be whole numbers'}, 400
+        if size <= 0:
+            return {'error': 'Size must be at least 1 byte'}, 400
+        if size > UPLOAD_MAX_FILE_BYTES:
+            return {'error': f'Upload is too large, the limit is {UPLOAD_MAX_FILE_BYTES // (1024 * 1024)} MB'}, 413
+        max_chunk_size = min(UPLOAD_MAX_CHUNK_BYTES, app.config['MAX_CONTENT_LENGTH'] or UPLOAD_MAX_CHUNK_BYTES)
+        if not UPLOAD_MIN_CHUNK_BYTES <= chunk_size <= max_chunk_size:
+            return {'error': f'Chunk size must be between {UPLOAD_MIN_CHUNK_BYTES} and {max_chunk_size} bytes'}, 400
+        if (size + chunk_size - 1) // chunk_size > UPLOAD_MAX_CHUNKS:
+            return {'error': f'Too many chunks, the limit is {UPLOAD_MAX_CHUNKS}; use larger ones'}, 400
+        sha256 = request.form.get('sha256') or None
+        if sha256 is not None and not SHA256_PATTERN.match(sha256):
+            return {'error': 'Invalid SHA-256 checksum'}, 400
+
+        upload = upload_sessions.create(secure_filename(file_name), size, chunk_size, sha256)
+        if upload is None:
+            response = jsonify({'error': 'Too many uploads in progress, please try again later'})
+            response.headers['Retry-After'] = '60'
+            return response, 503
+        return jsonify(upload), 201
+
+    except Exception as e:
+        print(f"Error in create_upload: {str(e)}")
+        return {'error': str(e)}, 500
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    upload = upload_sessions.status(upload_id)
+    if upload is None:
+        return {'error': UPLOAD_NOT_FOUND}, 404
+    return jsonify(upload)
+
+@app.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    # The body is the chunk's bytes, and the X-Chunk-Sha256 header their
+    # SHA-256. They are written at the chunk's place in the upload's file.
+    try:
+        session = upload_sessions.session(upload_id)
+        if session is None:
+            return {'error': UPLOAD_NOT_FOUND}, 404
+        length = upload_sessions.chunk_length(session, index)
+        if length is None:
+            return {'error': f"Chunk {index} is not in the upload, which has chunks 0 to {session['chunks'] - 1}"}, 400
+        if request.content_length != length:
+            return {'error': f'Chunk {index} must be {length} bytes'}, 400
+        sha256 = request.headers.get('X-Chunk-Sha256', '')
+        if not SHA256_PATTERN.match(sha256):
+            return {'error': 'Missing or invalid X-Chunk-Sha256 header'}, 400
+
+        with timed('upload'):
+            error = upload_sessions.write_chunk(session, index, request.stream, sha256)
+        if error:
+            return {'error': error}, 400
+        return '', 204
+
+    except Exception as e:
+        print(f"Error in upload_chunk: {str(e)}")
+        return {'error': str(e)}, 500
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    try:
+        upload = upload_sessions.status(upload_id)
+        if upload is None:
+            return {'error': UPLOAD_NOT_FOUND}, 404
+        if upload['missing']:
+            return jsonify({'error': 'Some chunks have not been received', 'missing': upload['missing']}), 409
+
+        with timed('hash'):
+            meta, error = upload_sessions.finish(upload_id, document_store)
+        if error:
+            return {'error': error}, 400
+        return jsonify(meta)
+
+    except Exception as e:
+        print(f"Error in complete_upload: {str(e)}")
+        return {'error': str(e)}, 500
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    if not upload_sessions.remove(upload_id):
+        return {'error': UPLOAD_NOT_FOUND}, 404
+    return '', 204
+
 @app.route('/watermark-pdf', methods=['POST'])
 def watermark_pdf():
-    temp_dir = None
+    input_stream = None
+    document = None
+    streaming = False
     try:
-        if 'file' not in request.files:
-            return {'error': 'No file part'}, 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return {'error': 'No selected file'}, 400
-        
-        if not file.filename.lower().endswith('.pdf'):
-            return {'error': 'File must be a PDF'}, 400
-        
-        watermark_type = request.form.get('watermarkType', 'text')
-        if watermark_type not in ['text', 'image']:
-            return {'error': 'Invalid watermark type'}, 400
-        
-        if watermark_type == 'text':
-            watermark_content = request.form.get('watermarkText', '')
-            if not watermark_content:
-                return {'error': 'Watermark text is required'}, 400
-        else:
-            if 'watermarkImage' not in request.files:
-                return {'error': 'No watermark image provided'}, 400
-            watermark_content = request.files['watermarkImage']
-            if watermark_content.filename == '':
-                return {'error': 'No selected watermark image'}, 400
-            if not watermark_content.filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-                return {'error': 'Watermark image must be JPEG or PNG'}, 400
-        
-        # Get watermark options
-        position = request.form.get('position', 'center')
-        transparency = float(request.form.get('transparency', 0.3))
-        rotation = float(request.form.get('rotation', 45))
-        layer = request.form.get('layer', 'above')
-        selected_pages = request.form.get('selectedPages', 'all')
-        font_size = int(request.form.get('fontSize', 50))
-        image_size = int(request.form.get('imageSize', 100))
-        
-        # Create a temporary directory
-        temp_dir = tempfile.mkdtemp()
-        
-        # Save the uploaded file
-        input_path = os.path.join(temp_dir, secure_filename(file.filename))
-        file.save(input_path)
-        
-        # Create watermark PDF
-        watermark_path = os.path.join(temp_dir, 'watermark.pdf')
-        
-        if watermark_type == 'text':
-            if not create_watermark_pdf('text', watermark_content, watermark_path, font_size, transparency, rotation, position):
-                return {'error': 'Failed to create watermark'}, 500
+        upload_id = request.form.get('uploadId')
+        if upload_id:
+            # A document sent earlier in chunks
+            upload = open_finished_upload(upload_id)
+            if upload is None:
+                return {'error': UPLOAD_NOT_FOUND}, 404
+            input_stream, file_name = upload
         else:
-            # Save the watermark image temporarily
-            watermark_image_path = os.path.join(temp_dir, secure_filename(watermark_content.filename))
-            watermark_content.save(watermark_image_path)
-            if not create_watermark_pdf('image', watermark_image_path, watermark_path, font_size, transparency, rotation, position, image_size):
-                return {'error': 'Failed to create watermark'}, 500
-        
-        # Set output path
-        output_filename = f"watermarked_{secure_filename(file.filename)}"
-        output_path = os.path.join(temp_dir, output_filename)
-        
-        # Apply watermark
-        if not add_watermark(input_path, watermark_path, output_path, layer, selected_pages):
-            return {'error': 'Failed to apply watermark'}, 500
+            if 'file' not in request.files:
+                return {'error': 'No file part'}, 400
+
+            file = request.files['file']
+            if file.filename == '':
+                return {'error': 'No selected file'}, 400
+
+            if not file.filename.lower().endswith('.pdf'):
+                return {'error': 'File must be a PDF'}, 400
+            file_name = file.filename
         
-        # Read the file into memory
-        with open(output_path, 'rb') as f:
-            file_data = f.read()
+        options, error = parse_watermark_options(request.form, request.files)
+        if error:
+            return {'error': error}, 400
         
-        # Clean up temporary files
+        download_name = f"watermarked_{secure_filename(file_name)}"
+        if input_stream is None:
+            input_stream = open_upload(file)
+        cache_key = result_cache_key('watermark', input_stream, watermark_cache_params(options))
+        response = cached_result_response(cache_key, download_name)
+        if response is not None:
+            return response
+
+        # Parse the upload in place and apply the watermark
         try:
-            if os.path.exists(input_path):
-                os.unlink(input_path)
-            if os.path.exists(watermark_path):
-                os.unlink(watermark_path)
-            if os.path.exists(output_path):
-                os.unlink(output_path)
-            if watermark_type == 'image' and os.path.exists(watermark_image_path):
-                os.unlink(watermark_image_path)
+            document = watermark_document(
+                input_stream, watermark_renderer(options), options['layer'], options['selected_pages'], options['stamp_mode'],
+                output_mode=options['output_mode']
+            )
         except Exception as e:
-            print(f"Warning: Error during cleanup: {str(e)}")
+            print(f"Error in add_watermark: {str(e)}")
+            return {'error': 'Failed to apply watermark'}, 500
         
-        # Send the file data from memory
-        return send_file(
-            io.BytesIO(file_data),
-            as_attachment=True,
-            download_name=output_filename,
-            mimetype='application/pdf',
-            max_age=0,
-            etag=False,
-            last_modified=None
+        # Stream the result back while it is being written
+        response = send_cached_pdf_stream(
+            cache_key,
+            document.write,
+            download_name,
+            cleanup=functools.partial(close_quietly, document, input_stream)
         )
+        streaming = True
+        return response
     
     except Exception as e:
         print(f"Error in watermark_pdf: {str(e)}")
         return {'error': str(e)}, 500
     finally:
-        # Clean up the temporary directory
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir)
-            except Exception as e:
-                print(f"Warning: Error removing temp directory: {str(e)}")
+        # The input stays open while a response is streaming
+        if not streaming:
+            close_quietly(document, input_stream)
+
+@app.route('/watermark-preview', methods=['POST'])
+def watermark_preview():
+    # One page with the watermark applied, as a one-page PDF or a PNG, for
+    # trying out settings. The first request uploads the document, whose id
+    # comes back in the X-Document-Id header; later requests send that id as
+    # documentId instead of the file, until it expires.
+    document = None
+    try:
+        options, error = parse_watermark_options(request.form, request.files)
+        if error:
+            return {'error': error}, 400
+        try:
+            index = int(request.form.get('page', 1)) - 1
+            width = int(request.form.get('width', PREVIEW_IMAGE_WIDTH))
+        except ValueError:
+            return {'error': 'Page and width must be whole numbers'}, 400
+        if index < 0:
+            return {'error': 'Invalid page number'}, 400
+        preview_format = request.form.get('format', 'pdf')
+        if preview_format not in ['pdf', 'png']:
+            return {'error': 'Invalid preview format, use pdf or png'}, 400
+        if preview_format == 'png':
+            if not 0 < width <= PREVIEW_MAX_IMAGE_WIDTH:
+                return {'error': f'Width must be between 1 and {PREVIEW_MAX_IMAGE_WIDTH} pixels'}, 400
+            import importlib.util
+            if importlib.util.find_spec('pypdfium2') is None:
+                return {'error': 'PNG previews are not available on this server'}, 501
+
+        if 'file' in request.files:
+            file = request.files['file']
+            error = check_pdf_upload(file)
+            if error:
+                return {'error': error}, 400
+            meta = document_store.put(file, secure_filename(file.filename))
+        else:
+            meta = document_store.get(request.form.get('documentId'))
+            if meta is None:
+                if not request.form.get('documentId'):
+                    return {'error': 'No file or document id provided'}, 400
+                return {'error': 'Document not found, it may have expired; upload it again'}, 404
+            record_stored_document(meta)
+        document_id = meta['id']
+
+        page, error = preview_page(document_id, meta, index)
+        if error:
+            return {'error': error}, 400
+        page_path, page_count = page
+
+        watermark = watermark_renderer(options)
+        if isinstance(watermark, WatermarkTemplate):
+            # {n} and {total} are those of the page in the whole document
+            watermark = watermark.for_range(index, page_count)
+        document = watermark_document(page_path, watermark, options['layer'], 'all', options['stamp_mode'],
+                                      workers=1, output_mode='full')
+        output = io.BytesIO()
+        with timed('write'):
+            document.write(output)
+        if preview_format == 'png':
+            with timed('rasterize'):
+                output = io.BytesIO(render_preview_image(output.getvalue(), width))
+        output.seek(0)
+
+        stem = os.path.splitext(meta['fileName'])[0]
+        response = send_file(
+            output,
+            mimetype='image/png' if preview_format == 'png' else 'application/pdf',
+            download_name=f"preview_{stem}_page{index + 1}.{preview_format}",
+            max_age=0
+        )
+        response.headers['X-Document-Id'] = document_id
+        response.headers['X-Page-Count'] = str(page_count)
+        return response
+
+    except Exception as e:
+        print(f"Error in watermark_preview: {str(e)}")
+        return {'error': str(e)}, 500
+    finally:
+        close_quietly(document)
 
 @app.route('/protect-pdf', methods=['POST'])
 def protect_pdf():
-    temp_input = None
-    temp_output = None
+    input_stream = None
+    document = None
+    streaming = False
     try:
-        if 'file' not in request.files:
-            return {'error': 'No file provided'}, 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return {'error': 'No selected file'}, 400
-            
-        if not file.filename.lower().endswith('.pdf'):
-            return {'error': 'File must be a PDF'}, 400
+        upload_id = request.form.get('uploadId')
+        if upload_id:
+            # A document sent earlier in chunks
+            upload = open_finished_upload(upload_id)
+            if upload is None:
+                return {'error': UPLOAD_NOT_FOUND}, 404
+            input_stream, file_name = upload
+        else:
+            if 'file' not in request.files:
+                return {'error': 'No file provided'}, 400
+
+            file = request.files['file']
+            if file.filename == '':
+                return {'error': 'No selected file'}, 400
+
+            if not file.filename.lower().endswith('.pdf'):
+                return {'error': 'File must be a PDF'}, 400
+            file_name = file.filename
             
         password = request.form.get('password')
         if not password:
             return {'error': 'No password provided'}, 400
 
-        # Create a temporary file to store the uploaded PDF
-        temp_input = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-        file.save(temp_input.name)
-        temp_input.close()
-
-        # Create PDF reader and writer objects
-        reader = PdfReader(temp_input.name)
-        writer = PdfWriter()
-
-        # Copy all pages to the writer
-        for page in reader.pages:
-            writer.add_page(page)
-
-        # Encrypt the PDF
-        writer.encrypt(password)
-
-        # Create a temporary file for the encrypted PDF
-        temp_output = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-        temp_output.close()
-
-        # Write the encrypted PDF to the temporary file
-        with open(temp_output.name, 'wb') as output_file:
-            writer.write(output_file)
-
-        # Clean up the input temporary file
-        if os.path.exists(temp_input.name):
-            os.unlink(temp_input.name)
-
-        # Send the encrypted PDF
-        return send_file(
-            temp_output.name,
-            as_attachment=True,
-            download_name=f"protected_{secure_filename(file.filename)}",
-            mimetype='application/pdf',
-            max_age=0,
-            etag=False,
-            last_modified=None
+        encryption = request.form.get('encryption', 'standard')
+        if encryption not in PROTECT_ENCRYPTION:
+            return {'error': 'Invalid encryption, use standard or aes256'}, 400
+        aes256 = encryption == 'aes256'
+        import pdf_engine
+        if aes256 and pdf_engine.pikepdf is None:
+            return {'error': 'AES-256 encryption is not available on this server'}, 501
+
+        # Parse the uploaded PDF in place
+        if input_stream is None:
+            input_stream = open_upload(file)
+
+        # Encrypt the PDF. Protected results are never cached, so a password
+        # set by one user is never handed to another.
+        document = protect_document(input_stream, password, 'pikepdf' if aes256 else None, aes256)
+
+        # Stream the encrypted PDF back while it is being written
+        response = send_pdf_stream(
+            document.write,
+            f"protected_{secure_filename(file_name)}",
+            cleanup=functools.partial(close_quietly, document, input_stream)
         )
+        streaming = True
+        return response
 
     except Exception as e:
         print(f"Error in protect_pdf: {str(e)}")
         return {'error': str(e)}, 500
     finally:
-        # Clean up temporary files if they still exist
-        if temp_input and os.path.exists(temp_input.name):
-            try:
-                os.unlink(temp_input.name)
-            except:
-                pass
-        if temp_output and os.path.exists(temp_output.name):
-            try:
-                os.unlink(temp_output.name)
-            except:
-                pass
+        # The input stays open while a response is streaming
+        if not streaming:
+            close_quietly(document, input_stream)
 
 @app.route('/unlock-pdf', methods=['POST'])
 def unlock_pdf():
+    input_stream = None
+    document = None
+    streaming = False
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        if not file or not file.filename.lower().endswith('.pdf'):
-            return jsonify({'error': 'Invalid file. Please provide a PDF file'}), 400
+        upload_id = request.form.get('uploadId')
+        if upload_id:
+            # A document sent earlier in chunks
+            upload = open_finished_upload(upload_id)
+            if upload is None:
+                return jsonify({'error': UPLOAD_NOT_FOUND}), 404
+            input_stream, file_name = upload
+        else:
+            if 'file' not in request.files:
+                return jsonify({'error': 'No file provided'}), 400
+
+            file = request.files['file']
+            if not file or not file.filename.lower().endswith('.pdf'):
+                return jsonify({'error': 'Invalid file. Please provide a PDF file'}), 400
+            file_name = file.filename
         
         password = request.form.get('password', '')  # Get password from form data
         fileName = request.form.get('fileName', 'unlocked_pdf')
         
-        print(f"Processing file: {file.filename}")
+        print(f"Processing file: {file_name}")
         print(f"Password provided: {'Yes' if password else 'No'}")
         
-        # Create a temporary file to store the uploaded PDF
-        temp_input = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-        file.save(temp_input.name)
-        temp_input.close()
-        print(f"Saved input file to: {temp_input.name}")
+        # Parse the uploaded PDF in place
+        if input_stream is None:
+            input_stream = open_upload(file)
+        cache_key = result_cache_key('unlock', input_stream, unlock_cache_params(password))
+        response = cached_result_response(cache_key, f'{fileName}.pdf')
+        if response is not None:
+            return response
 
         try:
-            # Create PDF reader object
-            reader = PdfReader(temp_input.name)
-            print(f"PDF is encrypted: {reader.is_encrypted}")
-            
-            # Check if PDF is encrypted
-            if reader.is_encrypted:
-                print("PDF is encrypted, attempting to decrypt...")
-                
-                # First try with provided password
-                if password:
-                    try:
-                        success = reader.decrypt(password)
-                        print(f"Decryption with provided password {'succeeded' if success else 'failed'}")
-                        if not success:
-                            return jsonify({'error': 'Incorrect password provided'}), 400
-                    except Exception as e:
-                        print(f"Error decrypting with provided password: {str(e)}")
-                        return jsonify({'error': 'Incorrect password provided'}), 400
-                else:
-                    # If no password provided, try common passwords
-                    common_passwords = [
-                        '',  # Empty password
-                        'password',
-                        '123456',
-                        'admin',
-                        'user',
-                        '1234',
-                        '12345',
-                        '12345678',
-                        'qwerty',
-                        'abc123',
-                        '0000',
-                        '1111',
-                        '2222',
-                        '3333',
-                        '4444',
-                        '5555',
-                        '6666',
-                        '7777',
-                        '8888',
-                        '9999',
-                        # Add more common passwords
-                        'admin123',
-                        'password123',
-                        'welcome',
-                        'welcome123',
-                        'test',
-                        'test123',
-                        'guest',
-                        'guest123',
-                        'default',
-                        'default123',
-                        'user123',
-                        'admin1234',
-                        'password1234',
-                        '123456789',
-                        '1234567890',
-                        'qwerty123',
-                        'qwerty1234',
-                        'qwertyuiop',
-                        'asdfghjk',
-                        'zxcvbnm',
-                        'qwerty1',
-                        'qwerty12',
-                        'qwerty123',
-                        'qwerty1234',
-                        'qwerty12345',
-                        'qwerty123456',
-                        'qwerty1234567',
-                        'qwerty12345678',
-                        'qwerty123456789',
-                        'qwerty1234567890',
-                        'qwertyuiop123',
-                        'qwertyuiop1234',
-                        'qwertyuiop12345',
-                        'qwertyuiop123456',
-                        'qwertyuiop1234567',
-                        'qwertyuiop12345678',
-                        'qwertyuiop123456789',
-                        'qwertyuiop1234567890',
-                        'asdfghjk123',
-                        'asdfghjk1234',
-                        'asdfghjk12345',
-                        'asdfghjk123456',
-                        'asdfghjk1234567',
-                        'asdfghjk12345678',
-                        'asdfghjk123456789',
-                        'asdfghjk1234567890',
-                        'zxcvbnm123',
-                        'zxcvbnm1234',
-                        'zxcvbnm12345',
-                        'zxcvbnm123456',
-                        'zxcvbnm1234567',
-                        'zxcvbnm12345678',
-                        'zxcvbnm123456789',
-                        'zxcvbnm1234567890',
-                        'qwerty1!',
-                        'qwerty12!',
-                        'qwerty123!',
-                        'qwerty1234!',
-                        'qwerty12345!',
-                        'qwerty123456!',
-                        'qwerty1234567!',
-                        'qwerty12345678!',
-                        'qwerty123456789!',
-                        'qwerty1234567890!'
-                    ]
-                    decrypted = False
-                    for pwd in common_passwords:
-                        try:
-                            print(f"Trying password: {pwd}")
-                            # Create a new reader for each attempt to avoid state issues
-                            temp_reader = PdfReader(temp_input.name)
-                            success = temp_reader.decrypt(pwd)
-                            if success:
-                                print(f"Successfully decrypted with password: {pwd}")
-                                reader = temp_reader  # Use the successful reader
-                                decrypted = True
-                                break
-                        except Exception as e:
-                            print(f"Failed to decrypt with password {pwd}: {str(e)}")
-                            continue
-                    
-                    if not decrypted:
-                        print("All password attempts failed")
-                        return jsonify({'error': 'Could not decrypt PDF. Please provide the correct password.'}), 400
-
-            # Create PDF writer object
-            writer = PdfWriter()
-
-            # Copy all pages to the writer
-            for page in reader.pages:
-                writer.add_page(page)
-
-            # Create a temporary file for the unlocked PDF
-            temp_output = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_output.close()
-            print(f"Created output file: {temp_output.name}")
-
-            # Write the unlocked PDF to the temporary file
-            with open(temp_output.name, 'wb') as output_file:
-                writer.write(output_file)
-            print("Successfully wrote unlocked PDF")
-
-            # Clean up the input temporary file
-            try:
-                os.unlink(temp_input.name)
-                print("Cleaned up input file")
-            except Exception as e:
-                print(f"Warning: Could not delete input file: {str(e)}")
-
-            # Send the unlocked PDF
-            return send_file(
-                temp_output.name,
-                as_attachment=True,
-                download_name=f'{fileName}.pdf',
-                mimetype='application/pdf',
-                max_age=0,
-                etag=False,
-                last_modified=None
+            document, error = unlock_document(input_stream, password)
+            if error:
+                return jsonify({'error': error}), 400
+
+            if not document.is_encrypted:
+                # Nothing to remove: send the upload back untouched
+                close_quietly(document)
+                document = None
+                response = send_pdf_stream(
+                    functools.partial(write_upload, input_stream),
+                    f'{fileName}.pdf',
+                    cleanup=functools.partial(close_quietly, input_stream)
+                )
+                streaming = True
+                return response
+
+            # Stream the unlocked PDF back while it is being written
+            response = send_cached_pdf_stream(
+                cache_key,
+                document.write,
+                f'{fileName}.pdf',
+                cleanup=functools.partial(close_quietly, document, input_stream)
             )
+            streaming = True
+            return response
 
         except Exception as e:
             print(f"Error processing PDF: {str(e)}")
@@ -547,8 +1668,456 @@ def unlock_pdf():
     except Exception as e:
         print(f"Error in unlock_pdf: {str(e)}")
         return jsonify({'error': str(e)}), 500
+    finally:
+        # The input stays open while a response is streaming
+        if not streaming:
+            close_quietly(document, input_stream)
+
+
+@app.route('/pipeline', methods=['POST'])
+def pipeline():
+    input_stream = None
+    document = None
+    streaming = False
+    try:
+        if 'file' not in request.files:
+            return {'error': 'No file provided'}, 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return {'error': 'No selected file'}, 400
+            
+        if not file.filename.lower().endswith('.pdf'):
+            return {'error': 'File must be a PDF'}, 400
+
+        # The whole pipeline is checked before the PDF is parsed
+        steps, error = parse_pipeline(request.form.get('operations'), request.files)
+        if error:
+            return {'error': error}, 400
+        aes256 = any(name == 'protect' and options['aes256'] for name, options in steps)
+        import pdf_engine
+        if aes256 and pdf_engine.pikepdf is None:
+            return {'error': 'AES-256 encryption is not available on this server'}, 501
+
+        download_name = f"processed_{secure_filename(file.filename)}"
+        input_stream = open_upload(file)
+        params = pipeline_cache_params(steps)
+        cache_key = result_cache_key('pipeline', input_stream, params) if params is not None else None
+        response = cached_result_response(cache_key, download_name)
+        if response is not None:
+            return response
+
+        try:
+            document, error = run_pipeline(input_stream, steps, 'pikepdf' if aes256 else None)
+        except Exception as e:
+            print(f"Error in run_pipeline: {str(e)}")
+            return {'error': 'Failed to process PDF'}, 500
+        if error:
+            return {'error': error}, 400
+
+        # Stream the result back while it is being written
+        response = send_cached_pdf_stream(
+            cache_key,
+            document.write,
+            download_name,
+            cleanup=functools.partial(close_quietly, document, input_stream)
+        )
+        streaming = True
+        return response
+
+    except Exception as e:
+        print(f"Error in pipeline: {str(e)}")
+        return {'error': str(e)}, 500
+    finally:
+        # The input stays open while a response is streaming
+        if not streaming:
+            close_quietly(document, input_stream)
+
+@app.route('/batch/<operation>', methods=['POST'])
+def batch_process(operation):
+    entries = []
+    streaming = False
+    try:
+        if operation not in ['watermark', 'protect']:
+            return {'error': 'Unknown batch operation'}, 404
+
+        files = [file for file in request.files.getlist('files') if file.filename != '']
+        if not files:
+            return {'error': 'No files provided'}, 400
+        if len(files) > BATCH_MAX_FILES:
+            return {'error': f'Too many files, the limit is {BATCH_MAX_FILES}'}, 400
+
+        # Options are checked once for the whole batch
+        if operation == 'watermark':
+            options, error = parse_watermark_options(request.form, request.files)
+            if error:
+                return {'error': error}, 400
+            function, args, prefix = watermark_pdf_bytes, (options,), 'watermarked_'
+        else:
+            password = request.form.get('password')
+            if not password:
+                return {'error': 'No password provided'}, 400
+            function, args, prefix = protect_pdf_bytes, (password,), 'protected_'
+
+        entries = batch_entries(files, prefix)
+        response = send_stream(
+            functools.partial(write_batch_archive, entries=entries, function=function, args=args),
+            f"{prefix}files.zip",
+            'application/zip',
+            cleanup=functools.partial(close_quietly, *[entry[2] for entry in entries])
+        )
+        streaming = True
+        return response
+
+    except Exception as e:
+        print(f"Error in batch_process: {str(e)}")
+        return {'error': str(e)}, 500
+    finally:
+        # The uploads stay open while a response is streaming
+        if not streaming:
+            close_quietly(*[entry[2] for entry in entries])
+
+@app.route('/compress', methods=['POST'])
+def compress_pdf():
+    import pdf_compress
+
+    input_stream = None
+    try:
+        if 'file' not in request.files:
+            return {'error': 'No file provided'}, 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return {'error': 'No selected file'}, 400
+            
+        if not file.filename.lower().endswith('.pdf'):
+            return {'error': 'File must be a PDF'}, 400
+
+        quality = request.form.get('quality', 'medium')
+        if quality not in pdf_compress.COMPRESSION_PRESETS:
+            return {'error': 'Invalid quality, use high, medium or low'}, 400
+
+        target_size_mb = request.form.get('targetSizeMB')
+        target_size = None
+        if target_size_mb:
+            try:
+                target_size = int(float(target_size_mb) * 1024 * 1024)
+            except ValueError:
+                target_size = 0
+            if target_size <= 0:
+                return {'error': 'Invalid target size'}, 400
+
+        if pdf_compress.pikepdf is None:
+            return {'error': 'PDF compression is not available on this server'}, 501
+
+        # Parse the uploaded PDF in place
+        input_stream = open_upload(file)
+        input_stream.seek(0, os.SEEK_END)
+        original_size = input_stream.tell()
+
+        start = time.perf_counter()
+        with timed('compress'):
+            data, report = pdf_compress.compress_to_size(input_stream, quality, target_size, COMPRESS_IMAGE_WORKERS)
+        # Never hand back a file that is larger than the one that was sent
+        if len(data) >= original_size:
+            data = read_upload(input_stream)
+            report['unchanged'] = True
+        report['timings']['total'] = round((time.perf_counter() - start) * 1000, 1)
+
+        return jsonify({
+            'success': True,
+            'fileData': base64.b64encode(data).decode('ascii'),
+            'metadata': {
+                'originalSize': original_size,
+                'compressedSize': len(data),
+                'compressionRatio': f"{(1 - len(data) / original_size) * 100:.1f}%" if original_size else '0.0%',
+                'qualityUsed': report['quality'],
+                'targetSizeUsed': float(target_size_mb) if target_size else None,
+                **report
+            }
+        })
+
+    except Exception as e:
+        print(f"Error in compress_pdf: {str(e)}")
+        return {'error': str(e)}, 500
+    finally:
+        close_quietly(input_stream)
+
+@app.route('/merge-pdf', methods=['POST'])
+def merge_pdf():
+    streams = []
+    documents = []
+    streaming = False
+    try:
+        files = [file for file in request.files.getlist('files') if file.filename != '']
+        if len(files) < 2:
+            return {'error': 'At least two files are needed to merge'}, 400
+        if len(files) > BATCH_MAX_FILES:
+            return {'error': f'Too many files, the limit is {BATCH_MAX_FILES}'}, 400
+        for file in files:
+            error = check_pdf_upload(file)
+            if error:
+                return {'error': f'{file.filename}: {error}'}, 400
+
+        # Pages are copied into the first document in upload order
+        for file in files:
+            streams.append(open_upload(file))
+            document, error = open_pages_document(streams[-1])
+            if error:
+                return {'error': f'{file.filename}: {error}'}, 400
+            documents.append(document)
+        with timed('pages'):
+            merged = documents[0]
+            for document in documents[1:]:
+                merged.append(document)
+
+        # Stream the merged PDF back while it is being written
+        response = send_pdf_stream(
+            merged.write,
+            f"merged_{secure_filename(files[0].filename)}",
+            cleanup=functools.partial(close_quietly, *documents, *streams)
+        )
+        streaming = True
+        return response
+
+    except Exception as e:
+        print(f"Error in merge_pdf: {str(e)}")
+        return {'error': str(e)}, 500
+    finally:
+        # The inputs stay open while a response is streaming
+        if not streaming:
+            close_quietly(*documents, *streams)
+
+@app.route('/split-pdf', methods=['POST'])
+def split_pdf():
+    input_stream = None
+    document = None
+    streaming = False
+    try:
+        file = request.files.get('file')
+        error = check_pdf_upload(file)
+        if error:
+            return {'error': error}, 400
+
+        # Either ranges such as "1-3,4-6,7", one file per part, or every N pages
+        ranges = request.form.get('ranges', '')
+        try:
+            every_pages = int(request.form.get('everyPages', 1))
+            if ranges:
+                parse_page_selection(ranges, 0)
+        except ValueError:
+            return {'error': 'Invalid page ranges'}, 400
+        if every_pages < 1:
+            return {'error': 'everyPages must be at least 1'}, 400
+
+        input_stream = open_upload(file)
+        document, error = open_pages_document(input_stream)
+        if error:
+            return {'error': error}, 400
+        parts, error = split_parts(ranges, every_pages, document.page_count)
+        if error:
+            return {'error': error}, 400
+
+        # Members larger than 4 GiB need ZIP64 headers, and a part is never
+        # much larger than the document it comes from
+        input_stream.seek(0, os.SEEK_END)
+        zip64 = input_stream.tell() >= zipfile.ZIP64_LIMIT
+        stem = secure_filename(file.filename)[:-4] or 'document'
+        response = send_stream(
+            functools.partial(write_split_archive, document=document, parts=parts, stem=stem, zip64=zip64),
+            f"split_{stem}.zip",
+            'application/zip',
+            cleanup=functools.partial(close_quietly, document, input_stream)
+        )
+        streaming = True
+        return response
+
+    except Exception as e:
+        print(f"Error in split_pdf: {str(e)}")
+        return {'error': str(e)}, 500
+    finally:
+        # The input stays open while a response is streaming
+        if not streaming:
+            close_quietly(document, input_stream)
+
+@app.route('/rotate-pdf', methods=['POST'])
+def rotate_pdf():
+    input_stream = None
+    document = None
+    streaming = False
+    try:
+        file = request.files.get('file')
+        error = check_pdf_upload(file)
+        if error:
+            return {'error': error}, 400
+
+        # Clockwise angles per page number, such as {"1": 90, "3": 180}, or
+        # one angle for selectedPages
+        selected_pages = request.form.get('selectedPages', 'all')
+        try:
+            if request.form.get('rotations'):
+                rotations = {int(page): int(angle) for page, angle in json.loads(request.form['rotations']).items()}
+                angles = list(rotations.values())
+            else:
+                rotations = None
+                angle = int(request.form.get('angle', 90))
+                angles = [angle]
+                parse_page_selection(selected_pages, 0)
+        except (AttributeError, TypeError, ValueError):
+            return {'error': 'Invalid rotation'}, 400
+        if any(angle % 90 for angle in angles):
+            return {'error': 'Rotation must be a multiple of 90 degrees'}, 400
+
+        input_stream = open_upload(file)
+        document, error = open_pages_document(input_stream)
+        if error:
+            return {'error': error}, 400
+        if rotations is None:
+            rotations = {i + 1: angle for i in page_indexes(selected_pages, document.page_count)}
+        with timed('pages'):
+            for page, angle in rotations.items():
+                if 1 <= page <= document.page_count and angle % 360:
+                    document.rotate_page(page - 1, angle)
+
+        response = send_pdf_stream(
+            document.write,
+            f"rotated_{secure_filename(file.filename)}",
+            cleanup=functools.partial(close_quietly, document, input_stream)
+        )
+        streaming = True
+        return response
+
+    except Exception as e:
+        print(f"Error in rotate_pdf: {str(e)}")
+        return {'error': str(e)}, 500
+    finally:
+        # The input stays open while a response is streaming
+        if not streaming:
+            close_quietly(document, input_stream)
+
+def select_pages_response(keep_selected, prefix):
+    # /extract-pages keeps the selected pages, /remove-pages every other page
+    input_stream = None
+    document = None
+    part = None
+    streaming = False
+    try:
+        file = request.files.get('file')
+        error = check_pdf_upload(file)
+        if error:
+            return {'error': error}, 400
+
+        selected_pages = request.form.get('selectedPages', '')
+        if not selected_pages:
+            return {'error': 'No pages selected'}, 400
+        try:
+            parse_page_selection(selected_pages, 0)
+        except ValueError:
+            return {'error': 'Invalid page selection'}, 400
+
+        input_stream = open_upload(file)
+        document, error = open_pages_document(input_stream)
+        if error:
+            return {'error': error}, 400
+        selected = page_indexes(selected_pages, document.page_count)
+        if keep_selected:
+            indexes = selected
+        else:
+            removed = set(selected)
+            indexes = [i for i in range(document.page_count) if i not in removed]
+        if not indexes:
+            return {'error': 'No pages left in the document' if selected else 'No selected page is in the document'}, 400
+
+        # Only the pages that are kept are copied into the output
+        part = document.select_pages(indexes)
+        response = send_pdf_stream(
+            part.write,
+            f"{prefix}{secure_filename(file.filename)}",
+            cleanup=functools.partial(close_quietly, part, document, input_stream)
+        )
+        streaming = True
+        return response
+
+    except Exception as e:
+        print(f"Error in select_pages_response: {str(e)}")
+        return {'error': str(e)}, 500
+    finally:
+        # The input stays open while a response is streaming
+        if not streaming:
+            close_quietly(part, document, input_stream)
+
+@app.route('/extract-pages', methods=['POST'])
+def extract_pages():
+    return select_pages_response(True, 'extracted_')
+
+@app.route('/remove-pages', methods=['POST'])
+def remove_pages():
+    return select_pages_response(False, 'removed_')
+
+@app.route('/jobs/<job_type>', methods=['POST'])
+def create_job(job_type):
+    try:
+        if job_type not in ['watermark', 'protect', 'unlock']:
+            return {'error': 'Unknown job type'}, 404
+
+        if 'file' not in request.files:
+            return {'error': 'No file provided'}, 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return {'error': 'No selected file'}, 400
+            
+        if not file.filename.lower().endswith('.pdf'):
+            return {'error': 'File must be a PDF'}, 400
+
+        if job_type == 'watermark':
+            options, error = parse_watermark_options(request.form, request.files)
+            if error:
+                return {'error': error}, 400
+            job = job_manager.submit(job_type, file, f"watermarked_{secure_filename(file.filename)}", run_watermark_job, options)
+        elif job_type == 'protect':
+            password = request.form.get('password')
+            if not password:
+                return {'error': 'No password provided'}, 400
+            job = job_manager.submit(job_type, file, f"protected_{secure_filename(file.filename)}", run_protect_job, password)
+        else:
+            password = request.form.get('password', '')
+            fileName = request.form.get('fileName', 'unlocked_pdf')
+            job = job_manager.submit(job_type, file, f'{fileName}.pdf', run_unlock_job, password)
+
+        if job is None:
+            response = jsonify({'error': 'Too many jobs in progress, please try again later'})
+            response.headers['Retry-After'] = '30'
+            return response, 503
+        return jsonify(job), 202
+
+    except Exception as e:
+        print(f"Error in create_job: {str(e)}")
+        return {'error': str(e)}, 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job_manager.cleanup()
+    job = job_manager.status(job_id)
+    if job is None:
+        return {'error': 'Job not found'}, 404
+    return jsonify(job)
 
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_manager.status(job_id)
+    if job is None:
+        return {'error': 'Job not found'}, 404
+    # Queued, running and failed jobs have no result; report their status instead
+    if job['status'] != 'done':
+        return jsonify(job), 409
+    return send_file(
+        job_manager.result_path(job_id),
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=job['downloadName'],
+        max_age=0
+    )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,208 @@
+import hashlib
+import hmac
+import importlib.metadata
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+# Disk cache of processed documents, addressed by a hash of the input bytes,
+# the options that produced them and the version of the code that did. Files
+# live in a directory that every server process shares, and that outlives
+# them; each process evicts the least recently used files once the directory
+# grows past max_bytes.
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+SECRET_FILE = '.secret'
+# Partial files older than this were left behind by a process that died
+STALE_TEMP_SECONDS = 3600
+
+
+def input_digest(stream):
+    # SHA-256 of a stream returned by open_upload, without copying it
+    if hasattr(stream, 'getbuffer'):
+        return hashlib.sha256(stream.getbuffer()).hexdigest()
+    return hashlib.sha256(stream).hexdigest()
+
+
+def code_version(paths, packages=()):
+    # Hash of the given source files and the versions of the given packages,
+    # so that results written before a deploy are not served after it
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    for package in packages:
+        try:
+            version = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            version = None
+        digest.update(f'{package}={version};'.encode())
+    return digest.hexdigest()
+
+
+class _TeeSink:
+    # Passes written bytes on to the response and into the cache file
+    def __init__(self, sink, file):
+        self._sink = sink
+        self._file = file
+
+    def write(self, data):
+        self._file.write(data)
+        return self._sink.write(data)
+
+    def tell(self):
+        return self._sink.tell()
+
+
+class ResultCache:
+    def __init__(self, root=None, max_bytes=1024 * 1024 * 1024, secret=None, version=''):
+        self.root = root or os.path.join(tempfile.gettempdir(), 'zenpdf-results')
+        self.max_bytes = max_bytes
+        self.version = version
+        self._lock = threading.Lock()
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._secret = None
+        if self.enabled:
+            os.makedirs(self.root, exist_ok=True)
+            self._secret = secret.encode() if secret else self._load_secret()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load_secret(self):
+        # Shared by every process using the directory, so that they agree on keys
+        path = os.path.join(self.root, SECRET_FILE)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            with open(path, 'rb') as f:
+                return f.read()
+        with os.fdopen(fd, 'wb') as f:
+            secret = os.urandom(32)
+            f.write(secret)
+        return secret
+
+    def secret_digest(self, value):
+        # Keyed hash for secrets such as passwords, which must never appear
+        # in a key that could be derived without knowing them
+        if self._secret is None:
+            return None
+        return hmac.new(self._secret, value.encode(), hashlib.sha256).hexdigest()
+
+    def key(self, operation, digest, params):
+        # Returns None when the cache is off
+        if not self.enabled:
+            return None
+        description = json.dumps([self.version, operation, digest, params], sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.pdf")
+
+    def open(self, key):
+        # Returns an open file with the cached result, or None
+        if key is None or not KEY_PATTERN.match(key):
+            return None
+        path = self._path(key)
+        try:
+            file = open(path, 'rb')
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            # Recently used files are evicted last
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return file
+
+    def writer(self, key, write):
+        # Wraps write(sink) so that the result is also stored under key.
+        # The file only appears in the cache once write has finished.
+        if key is None:
+            return write
+
+        def write_and_store(sink):
+            directory = os.path.dirname(self._path(key))
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    write(_TeeSink(sink, file))
+                os.replace(temp_path, self._path(key))
+            except BaseException:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                raise
+            self._added(os.path.getsize(self._path(key)))
+
+        return write_and_store
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            if self._size is not None and self._size <= self.max_bytes:
+                return
+        self.evict()
+
+    def _files(self):
+        files = []
+        now = time.time()
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                    if name.endswith('.tmp') and now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        os.remove(path)
+                except OSError:
+                    continue
+                if name.endswith('.pdf'):
+                    files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        # Other processes write to the same directory, so its size is
+        # measured again before deciding what to remove
+        files = self._files()
+        size = sum(file_size for _, file_size, _ in files)
+        evicted = 0
+        if size > self.max_bytes:
+            # Leave some room so eviction does not run on every write
+            limit = self.max_bytes * 0.9
+            for _, file_size, path in sorted(files):
+                if size <= limit:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= file_size
+                evicted += 1
+        with self._lock:
+            self._size = size
+            self.evictions += evicted
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'bytes': self._size,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
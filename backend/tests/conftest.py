@@ -0,0 +1,74 @@
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+from flask.testing import FlaskClient
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Set before pdf_server loads .env, which does not override them. Results are
+# not cached, so every request does the work under test, and files the server
+# keeps go to a directory of their own.
+DATA_DIR = tempfile.mkdtemp(prefix='zenpdf-tests-')
+os.environ['RESULT_CACHE_BYTES'] = '0'
+os.environ['REQUEST_LOG'] = 'false'
+for name in ('JOBS_DIR', 'DOCUMENTS_DIR', 'UPLOADS_DIR'):
+    os.environ[name] = os.path.join(DATA_DIR, name.lower())
+
+from benchmarks.synthetic import text_pdf  # noqa: E402
+
+
+class ClosingClient(FlaskClient):
+    # Reads and closes every response, as a WSGI server does, so that
+    # functions waiting for the response to close run
+    def open(self, *args, **kwargs):
+        response = super().open(*args, **kwargs)
+        response.get_data()
+        response.close()
+        return response
+
+
+@pytest.fixture(scope='session')
+def app():
+    import pdf_server
+    pdf_server.app.config['TESTING'] = True
+    pdf_server.app.test_client_class = ClosingClient
+    return pdf_server.app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture(params=['pypdf2', 'pikepdf'])
+def engine(request, monkeypatch):
+    # Runs the test once with each PDF engine
+    import pdf_engine
+    import pdf_server
+    if request.param == 'pikepdf' and pdf_engine.pikepdf is None:
+        pytest.skip('pikepdf is not installed')
+    monkeypatch.setattr(pdf_server, 'PDF_ENGINE', request.param)
+    return request.param
+
+
+@pytest.fixture(params=['memory', 'spooled'])
+def upload_size(request, monkeypatch):
+    # Runs the test with an upload kept in memory and with one spilled to a
+    # scratch file, which routes read through a memory map
+    import pdf_io
+    if request.param == 'spooled':
+        monkeypatch.setattr(pdf_io, 'UPLOAD_SPOOL_BYTES', 0)
+    return request.param
+
+
+@pytest.fixture(scope='session')
+def sample_pdf():
+    return text_pdf(3, lines=5)
+
+
+def upload(data, name='input.pdf'):
+    return (io.BytesIO(data), name)
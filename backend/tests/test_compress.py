@@ -0,0 +1,23 @@
+import base64
+import io
+
+import pytest
+from PyPDF2 import PdfReader
+
+import pdf_compress
+from conftest import upload
+from benchmarks.synthetic import image_pdf
+
+pytestmark = pytest.mark.skipif(pdf_compress.pikepdf is None, reason='pikepdf is not installed')
+
+
+@pytest.mark.parametrize('quality', ['low', 'medium'])
+def test_compress(client, upload_size, quality):
+    source = image_pdf(2)
+    response = client.post('/compress', data={'file': upload(source), 'quality': quality})
+
+    assert response.status_code == 200, response.data
+    data = base64.b64decode(response.json['fileData'])
+    assert len(PdfReader(io.BytesIO(data)).pages) == 2
+    assert len(data) < len(source)
+    assert response.json['metadata']['originalSize'] == len(source)
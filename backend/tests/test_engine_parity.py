@@ -0,0 +1,128 @@
+# Every PDF engine must produce the same documents for the same requests:
+# page count, page geometry and extracted text, compared with what PyPDF2
+# produces from an upload kept in memory. Requests go through the Flask
+# routes, so streaming, spooled uploads and ZIP members are covered too.
+import io
+import json
+import zipfile
+
+import pytest
+from PyPDF2 import PdfReader, PdfWriter
+from reportlab.lib.pagesizes import A4, landscape, letter
+
+import pdf_engine
+import pdf_io
+import pdf_server
+from conftest import upload
+from benchmarks.synthetic import text_pdf
+
+PASSWORD = 'secret'
+
+
+def mixed_pdf(pages):
+    # Mixed page sizes, with some pages rotated
+    writer = PdfWriter()
+    for i, page in enumerate(PdfReader(io.BytesIO(text_pdf(pages, (letter, A4, landscape(letter)), lines=5))).pages):
+        page = writer.add_page(page)
+        if i % 4 == 1:
+            page.rotate(90)
+        elif i % 4 == 3:
+            page.rotate(270)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def protected_pdf(data):
+    document = pdf_engine.open_document(io.BytesIO(data), 'pypdf2')
+    try:
+        document.encrypt(PASSWORD)
+        buffer = io.BytesIO()
+        document.write(buffer)
+    finally:
+        document.close()
+    return buffer.getvalue()
+
+
+def summary(data, password=None):
+    reader = PdfReader(io.BytesIO(data))
+    if password is not None:
+        assert reader.is_encrypted and reader.decrypt(password)
+    else:
+        assert not reader.is_encrypted
+    return [
+        (pdf_engine._box_geometry(page.cropbox, page.rotation), ' '.join(page.extract_text().split()))
+        for page in reader.pages
+    ]
+
+
+def response_summary(response, password=None):
+    assert response.status_code == 200, response.data
+    if response.mimetype == 'application/zip':
+        with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+            return {name: summary(archive.read(name)) for name in sorted(archive.namelist())}
+    return summary(response.data, password)
+
+
+WATERMARK_CASES = [
+    pytest.param({'watermarkText': 'PARITY', 'selectedPages': '1-3,5', 'stampMode': mode, 'layer': layer},
+                 id=f'watermark-{mode}-{layer}')
+    for mode in ('xobject', 'merge') for layer in ('above', 'below')
+]
+CASES = WATERMARK_CASES + [
+    pytest.param({'watermarkText': 'Page {n} of {total}', 'watermarkType': 'template'}, id='watermark-template'),
+]
+
+
+def post(client, route, form, data):
+    return client.post(route, data=dict(form, file=upload(data)))
+
+
+def expected(client, route, form, data, password=None):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(pdf_server, 'PDF_ENGINE', 'pypdf2')
+        patch.setattr(pdf_io, 'UPLOAD_SPOOL_BYTES', 8 * 1024 * 1024)
+        return response_summary(post(client, route, form, data), password)
+
+
+@pytest.fixture(scope='module')
+def source():
+    return mixed_pdf(8)
+
+
+@pytest.mark.parametrize('form', CASES)
+def test_watermark(client, engine, upload_size, source, form):
+    reference = expected(client, '/watermark-pdf', form, source)
+    assert response_summary(post(client, '/watermark-pdf', form, source)) == reference
+
+
+def test_protect(client, engine, upload_size, source):
+    form = {'password': PASSWORD}
+    reference = expected(client, '/protect-pdf', form, source, PASSWORD)
+    assert response_summary(post(client, '/protect-pdf', form, source), PASSWORD) == reference
+
+
+def test_unlock(client, engine, upload_size, source):
+    form = {'password': PASSWORD}
+    protected = protected_pdf(source)
+    assert response_summary(post(client, '/unlock-pdf', form, protected)) == summary(source)
+
+
+@pytest.mark.parametrize('route, form', [
+    ('/rotate-pdf', {'angle': '90', 'selectedPages': '2-3'}),
+    ('/extract-pages', {'selectedPages': '1,3,8'}),
+    ('/remove-pages', {'selectedPages': '2-4'}),
+    ('/split-pdf', {'ranges': '1-2,5,6-8'}),
+])
+def test_page_operations(client, engine, upload_size, source, route, form):
+    reference = expected(client, route, form, source)
+    assert response_summary(post(client, route, form, source)) == reference
+
+
+def test_pipeline(client, engine, upload_size, source):
+    form = {'operations': json.dumps([
+        {'op': 'watermark', 'watermarkText': 'PIPELINE', 'selectedPages': '2-4'},
+        {'op': 'protect', 'password': PASSWORD},
+    ])}
+    reference = expected(client, '/pipeline', form, source, PASSWORD)
+    assert response_summary(post(client, '/pipeline', form, source), PASSWORD) == reference
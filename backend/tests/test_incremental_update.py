@@ -0,0 +1,127 @@
+# Watermarks written as an incremental update must leave the original file
+# untouched: its bytes are an exact prefix of the output, the new
+# cross-reference section points back at the original one, and only the
+# selected pages change.
+import io
+import re
+import shutil
+import subprocess
+
+import pytest
+from PyPDF2 import PdfReader
+
+import pdf_engine
+from conftest import upload
+from benchmarks.synthetic import text_pdf
+
+pikepdf = pdf_engine.pikepdf
+WATERMARK = 'INCREMENTAL'
+SELECTED = [1, 3]
+
+
+def startxref(data):
+    return int(re.findall(rb'startxref\s+(\d+)\s*%%EOF', data)[-1])
+
+
+def xref_stream_pdf(data):
+    # The same document saved with object streams and a cross-reference stream
+    output = io.BytesIO()
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        pdf.save(output, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+    return output.getvalue()
+
+
+@pytest.fixture(params=['xref-table', 'xref-stream'])
+def source(request):
+    data = text_pdf(5, lines=5)
+    if request.param == 'xref-stream':
+        if pikepdf is None:
+            pytest.skip('pikepdf is not installed')
+        data = xref_stream_pdf(data)
+    offset = startxref(data)
+    assert data[offset:offset + 4] == b'xref' if request.param == 'xref-table' else data[offset:offset + 4] != b'xref'
+    return data
+
+
+@pytest.fixture
+def output(client, source):
+    response = client.post('/watermark-pdf', data={
+        'file': upload(source),
+        'watermarkText': WATERMARK,
+        'selectedPages': ','.join(str(i + 1) for i in SELECTED),
+        'stampMode': 'xobject',
+        'outputMode': 'incremental',
+    })
+    assert response.status_code == 200, response.data
+    return response.data
+
+
+def test_original_bytes_are_a_prefix(source, output):
+    assert len(output) > len(source)
+    assert output[:len(source)] == source
+
+
+def test_new_section_points_at_the_original(source, output):
+    new_offset = startxref(output)
+    assert new_offset >= len(source)
+    # A table is followed by its trailer, a stream's dictionary is its trailer
+    section = output[new_offset:]
+    assert section.startswith(b'xref') == source[startxref(source):].startswith(b'xref')
+    prev = re.search(rb'/Prev\s+(\d+)', section)
+    assert prev is not None and int(prev.group(1)) == startxref(source)
+    # The first /ID entry identifies the original document
+    assert PdfReader(io.BytesIO(output)).trailer['/ID'][0] == PdfReader(io.BytesIO(source)).trailer['/ID'][0]
+
+
+def page_contents(page):
+    contents = page.get('/Contents')
+    if contents is None:
+        return b''
+    contents = contents.get_object()
+    streams = contents if isinstance(contents, list) else [contents]
+    return b'\n'.join(stream.get_object().get_data() for stream in streams)
+
+
+def test_only_selected_pages_are_stamped(source, output):
+    before = PdfReader(io.BytesIO(source)).pages
+    after = PdfReader(io.BytesIO(output)).pages
+    assert len(after) == len(before)
+    for index, (old, new) in enumerate(zip(before, after)):
+        old_xobjects = set(old['/Resources'].get('/XObject', {}).keys())
+        new_xobjects = new['/Resources'].get('/XObject', {})
+        if index in SELECTED:
+            added = set(new_xobjects.keys()) - old_xobjects
+            assert len(added) == 1
+            stamp = new_xobjects[added.pop()].get_object()
+            assert WATERMARK.encode() in stamp.get_data()
+            assert page_contents(new) != page_contents(old)
+        else:
+            assert set(new_xobjects.keys()) == old_xobjects
+            assert page_contents(new) == page_contents(old)
+
+
+def test_output_passes_qpdf_check(output, tmp_path):
+    if shutil.which('qpdf'):
+        path = tmp_path / 'output.pdf'
+        path.write_bytes(output)
+        result = subprocess.run(['qpdf', '--check', str(path)], capture_output=True, text=True)
+        assert result.returncode == 0, result.stdout + result.stderr
+    elif pikepdf is not None:
+        # The same checks, through the qpdf library pikepdf is built on
+        with pikepdf.open(io.BytesIO(output)) as pdf:
+            assert pdf.check() == []
+    else:
+        pytest.skip('neither qpdf nor pikepdf is installed')
+
+
+def test_selected_pages_are_rewritten_by_default(client):
+    # The original, unwatermarked file must not be recoverable from output
+    # the client did not ask to be incremental
+    source = text_pdf(5, lines=5)
+    response = client.post('/watermark-pdf', data={
+        'file': upload(source), 'watermarkText': WATERMARK, 'selectedPages': '2'
+    })
+
+    assert response.status_code == 200, response.data
+    assert not response.data.startswith(source)
+    assert response.data.count(b'%%EOF') == 1
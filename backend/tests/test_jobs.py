@@ -0,0 +1,93 @@
+# Jobs run in spawned worker processes, which import the server again
+import io
+import os
+import time
+import uuid
+
+from PyPDF2 import PdfReader
+
+import jobs
+import pdf_server
+from conftest import upload
+
+JOB_TIMEOUT_SECONDS = 120
+
+
+def submit(client, job_type, pdf, **fields):
+    return client.post(f'/jobs/{job_type}', data=dict(fields, file=upload(pdf)))
+
+
+def wait_for(client, job_id):
+    deadline = time.monotonic() + JOB_TIMEOUT_SECONDS
+    while True:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['status'] in ('done', 'failed') or time.monotonic() > deadline:
+            return job
+        time.sleep(0.1)
+
+
+def test_watermark_job_runs_to_its_result(client, sample_pdf):
+    response = submit(client, 'watermark', sample_pdf, watermarkText='JOB')
+    assert response.status_code == 202, response.data
+    job = response.get_json()
+    assert job['status'] == 'queued'
+
+    job = wait_for(client, job['id'])
+
+    assert job['status'] == 'done', job
+    assert job['pagesDone'] == job['pagesTotal'] == 3
+    assert job['error'] is None and job['finishedAt'] >= job['startedAt']
+    result = client.get(f"/jobs/{job['id']}/result")
+    assert result.status_code == 200
+    assert 'watermarked_input.pdf' in result.headers['Content-Disposition']
+    assert len(PdfReader(io.BytesIO(result.data)).pages) == 3
+    # The input is removed once the job has run
+    assert not os.path.exists(os.path.join(pdf_server.job_manager.job_dir(job['id']), jobs.INPUT_FILE))
+
+
+def test_failed_job_reports_its_error(client):
+    job = wait_for(client, submit(client, 'protect', b'not a pdf', password='secret').get_json()['id'])
+
+    assert job['status'] == 'failed'
+    assert job['error']
+    result = client.get(f"/jobs/{job['id']}/result")
+    assert result.status_code == 409
+    assert result.get_json()['status'] == 'failed'
+
+
+def test_unfinished_job_has_no_result(client):
+    job_id = uuid.uuid4().hex
+    job_dir = pdf_server.job_manager.job_dir(job_id)
+    os.makedirs(job_dir)
+    jobs._write_status(job_dir, {'id': job_id, 'status': 'queued'})
+
+    response = client.get(f'/jobs/{job_id}/result')
+
+    assert response.status_code == 409
+    assert response.get_json()['status'] == 'queued'
+
+
+def test_too_many_pending_jobs_are_turned_away(client, sample_pdf, monkeypatch):
+    monkeypatch.setattr(pdf_server.job_manager, 'max_pending', 0)
+
+    response = submit(client, 'watermark', sample_pdf, watermarkText='JOB')
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '30'
+
+
+def test_finished_jobs_are_removed_after_ttl(client, sample_pdf, monkeypatch):
+    job = wait_for(client, submit(client, 'unlock', sample_pdf).get_json()['id'])
+    assert job['status'] == 'done', job
+    monkeypatch.setattr(pdf_server.job_manager, 'ttl', 0)
+    monkeypatch.setattr(pdf_server.job_manager, '_last_cleanup', 0)
+    time.sleep(0.01)
+
+    assert client.get(f"/jobs/{job['id']}").status_code == 404
+    assert not os.path.exists(pdf_server.job_manager.job_dir(job['id']))
+
+
+def test_unknown_jobs_are_not_found(client):
+    assert client.post('/jobs/compress', data={'file': upload(b'%PDF')}).status_code == 404
+    assert client.get(f'/jobs/{uuid.uuid4().hex}').status_code == 404
+    assert client.get('/jobs/not-an-id/result').status_code == 404
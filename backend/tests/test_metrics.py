@@ -0,0 +1,26 @@
+import metrics
+from conftest import upload
+
+
+def test_send_file_response_is_finished(client, sample_pdf):
+    # /watermark-preview answers with send_file, whose body the server gets
+    # without going through the response's close()
+    before = metrics.requests_total.value('watermark_preview', 200)
+
+    response = client.post('/watermark-preview', data={'file': upload(sample_pdf), 'watermarkText': 'X'})
+
+    assert response.status_code == 200
+    assert metrics.requests_in_flight.value() == 0
+    assert metrics.requests_total.value('watermark_preview', 200) == before + 1
+    assert 'total;dur=' in response.headers['Server-Timing']
+    assert all(metrics.admission_slots_in_use.value(lane) == 0 for lane in ('main', 'small'))
+
+
+def test_streamed_response_is_finished(client, sample_pdf):
+    before = metrics.requests_total.value('watermark_pdf', 200)
+
+    response = client.post('/watermark-pdf', data={'file': upload(sample_pdf), 'watermarkText': 'X'})
+
+    assert response.status_code == 200
+    assert metrics.requests_in_flight.value() == 0
+    assert metrics.requests_total.value('watermark_pdf', 200) == before + 1
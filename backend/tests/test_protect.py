@@ -0,0 +1,35 @@
+import io
+
+import pikepdf
+import pytest
+from PyPDF2 import PdfReader
+
+from conftest import upload
+
+
+@pytest.mark.parametrize('encryption', ['standard', 'aes256'])
+def test_protect_pdf_opens_with_password(client, sample_pdf, encryption):
+    response = client.post('/protect-pdf', data={
+        'file': upload(sample_pdf), 'password': 'secret', 'encryption': encryption
+    })
+
+    assert response.status_code == 200, response.data
+    with pikepdf.open(io.BytesIO(response.data), password='secret') as pdf:
+        assert len(pdf.pages) == 3
+        if encryption == 'aes256':
+            assert pdf.encryption.R == 6
+    with pytest.raises(pikepdf.PasswordError):
+        pikepdf.open(io.BytesIO(response.data))
+
+
+def test_protect_pdf_aes256_in_pipeline(client, sample_pdf):
+    response = client.post('/pipeline', data={
+        'file': upload(sample_pdf),
+        'operations': '[{"op": "protect", "password": "secret", "encryption": "aes256"}]'
+    })
+
+    assert response.status_code == 200, response.data
+    reader = PdfReader(io.BytesIO(response.data))
+    assert reader.is_encrypted
+    with pikepdf.open(io.BytesIO(response.data), password='secret') as pdf:
+        assert len(pdf.pages) == 3
@@ -0,0 +1,121 @@
+# The result cache is off in the other tests (see conftest), so every request
+# there does its work. These turn it on with a directory of their own.
+import hashlib
+import io
+import os
+
+import pytest
+
+import pdf_server
+from conftest import upload
+from result_cache import ResultCache, input_digest
+
+WATERMARK = {'watermarkText': 'CACHED'}
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = ResultCache(root=str(tmp_path / 'results'), max_bytes=64 * 1024 * 1024, version='test')
+    monkeypatch.setattr(pdf_server, 'result_cache', cache)
+    return cache
+
+
+def watermark(client, pdf, headers=None, **fields):
+    return client.post('/watermark-pdf', data=dict(WATERMARK, file=upload(pdf), **fields), headers=headers)
+
+
+def cached_files(cache):
+    return [name for _, _, names in os.walk(cache.root) for name in names if name.endswith('.pdf')]
+
+
+def test_repeated_request_is_served_from_cache(client, sample_pdf, cache):
+    first = watermark(client, sample_pdf)
+    second = watermark(client, sample_pdf)
+
+    assert first.status_code == second.status_code == 200
+    assert first.headers['ETag'] == second.headers['ETag']
+    assert second.data == first.data
+    assert cache.stats()['hits'] == 1
+
+
+def test_known_etag_gets_not_modified(client, sample_pdf, cache):
+    etag = watermark(client, sample_pdf).headers['ETag']
+
+    response = watermark(client, sample_pdf, headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_result_can_be_downloaded_again_by_key(client, sample_pdf, cache):
+    first = watermark(client, sample_pdf)
+    key = first.headers['ETag'].strip('"')
+
+    response = client.get(f'/results/{key}?name=again.pdf')
+
+    assert response.status_code == 200
+    assert response.data == first.data
+    assert 'again.pdf' in response.headers['Content-Disposition']
+    assert client.get(f"/results/{'0' * 64}").status_code == 404
+    assert client.get('/results/not-a-key').status_code == 404
+
+
+def test_least_recently_used_results_are_evicted(client, sample_pdf, tmp_path, monkeypatch):
+    size = len(watermark(client, sample_pdf).data)
+    cache = ResultCache(root=str(tmp_path / 'small'), max_bytes=int(size * 1.5), version='test')
+    monkeypatch.setattr(pdf_server, 'result_cache', cache)
+
+    first = watermark(client, sample_pdf, watermarkText='FIRST').headers['ETag'].strip('"')
+    second = watermark(client, sample_pdf, watermarkText='SECOND').headers['ETag'].strip('"')
+
+    assert cache.stats()['evictions'] == 1
+    assert cache.open(first) is None
+    with cache.open(second) as f:
+        assert f.read().startswith(b'%PDF')
+
+
+def test_protected_output_is_never_cached(client, sample_pdf, cache):
+    protected = client.post('/protect-pdf', data={'file': upload(sample_pdf), 'password': 'secret'})
+    pipeline = client.post('/pipeline', data={
+        'file': upload(sample_pdf),
+        'operations': '[{"op": "watermark", "watermarkText": "X"}, {"op": "protect", "password": "secret"}]'
+    })
+
+    assert protected.status_code == pipeline.status_code == 200
+    assert 'ETag' not in protected.headers and 'ETag' not in pipeline.headers
+    assert cached_files(cache) == []
+
+
+def test_unlock_keys_are_keyed_hashes_of_the_password(client, sample_pdf, cache, tmp_path):
+    protected = client.post('/protect-pdf', data={'file': upload(sample_pdf), 'password': 'secret'}).data
+    response = client.post('/unlock-pdf', data={'file': upload(protected), 'password': 'secret'})
+    assert response.status_code == 200, response.data
+
+    params = pdf_server.unlock_cache_params('secret')
+    assert response.headers['ETag'].strip('"') == cache.key('unlock', hashlib.sha256(protected).hexdigest(), params)
+    assert 'secret' not in str(params)
+    assert params != pdf_server.unlock_cache_params('other')
+    # Another secret gives other keys, so keys cannot be derived without it
+    other = ResultCache(root=str(tmp_path / 'other'), version='test')
+    assert other.secret_digest('secret') != cache.secret_digest('secret')
+
+
+def test_results_of_another_version_are_not_served(client, sample_pdf, cache, monkeypatch):
+    etag = watermark(client, sample_pdf).headers['ETag']
+    upgraded = ResultCache(root=cache.root, max_bytes=cache.max_bytes, version='upgraded')
+    monkeypatch.setattr(pdf_server, 'result_cache', upgraded)
+
+    response = watermark(client, sample_pdf, headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert upgraded.stats()['hits'] == 0
+
+
+def test_keys_depend_on_the_code_version(tmp_path):
+    digest = input_digest(io.BytesIO(b'%PDF'))
+    old = ResultCache(root=str(tmp_path), secret='s', version='a')
+    new = ResultCache(root=str(tmp_path), secret='s', version='b')
+    assert old.key('watermark', digest, {}) != new.key('watermark', digest, {})
+    # The server's version covers its own code and PDF libraries
+    assert len(pdf_server.result_cache.version) >= 64
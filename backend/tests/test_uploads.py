@@ -0,0 +1,91 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+import admission
+import pdf_server
+
+CHUNK_BYTES = 256 * 1024
+
+
+def start_upload(client, data):
+    response = client.post('/uploads', data={'fileName': 'input.pdf', 'size': len(data), 'chunkSize': CHUNK_BYTES})
+    assert response.status_code == 201, response.data
+    return response.get_json()['id']
+
+
+def put_chunk(client, upload_id, data):
+    return client.put(f'/uploads/{upload_id}/chunks/0', data=data,
+                      headers={'X-Chunk-Sha256': hashlib.sha256(data).hexdigest()})
+
+
+def upload_document(client, data):
+    upload_id = start_upload(client, data)
+    assert put_chunk(client, upload_id, data).status_code == 204
+    response = client.post(f'/uploads/{upload_id}/complete')
+    assert response.status_code == 200, response.data
+    return response.get_json()
+
+
+def expire(upload_id):
+    upload_dir = pdf_server.upload_sessions.upload_dir(upload_id)
+    last_used = time.time() - pdf_server.upload_sessions.ttl - 1
+    os.utime(upload_dir, (last_used, last_used))
+    return upload_dir
+
+
+def test_chunks_wait_for_admission(client, sample_pdf, monkeypatch):
+    upload_id = start_upload(client, sample_pdf)
+    control = pdf_server.admission_control
+    monkeypatch.setattr(control, 'queue_timeout', 0)
+    monkeypatch.setattr(control.main, 'in_use', control.main.slots)
+    monkeypatch.setattr(control.small, 'in_use', control.small.slots)
+
+    response = put_chunk(client, upload_id, sample_pdf)
+
+    assert response.status_code == 503
+    assert 'Retry-After' in response.headers
+
+
+@pytest.mark.parametrize('route', ['/watermark-pdf', '/watermark-preview'])
+def test_stored_documents_weigh_by_their_size(client, sample_pdf, monkeypatch, route):
+    meta = upload_document(client, sample_pdf)
+    control = pdf_server.admission_control
+    monkeypatch.setattr(control, 'slot_bytes', 1024)
+    weights = []
+    reweigh = admission.Ticket.reweigh
+
+    def record_reweigh(ticket, weight):
+        weights.append(weight)
+        reweigh(ticket, weight)
+
+    monkeypatch.setattr(admission.Ticket, 'reweigh', record_reweigh)
+    field = 'uploadId' if route == '/watermark-pdf' else 'documentId'
+
+    response = client.post(route, data={field: meta['id'], 'watermarkText': 'X'})
+
+    assert response.status_code == 200, response.data
+    assert max(weights) == control.bytes_weight(meta['bytes']) > 1
+    assert control.main.in_use == 0 and control.small.in_use == 0
+
+
+def test_expired_upload_takes_no_chunks(client, sample_pdf):
+    upload_id = start_upload(client, sample_pdf)
+    expire(upload_id)
+
+    assert put_chunk(client, upload_id, sample_pdf).status_code == 404
+    assert client.post(f'/uploads/{upload_id}/complete').status_code == 404
+    assert client.get(f'/uploads/{upload_id}').status_code == 404
+
+
+def test_expired_uploads_are_swept(client, sample_pdf, monkeypatch):
+    expired_dir = expire(start_upload(client, sample_pdf))
+    upload_id = start_upload(client, sample_pdf)
+    monkeypatch.setattr(pdf_server.upload_sessions, '_last_cleanup', 0)
+
+    # Any use of an upload sweeps, not only starting a new one
+    assert put_chunk(client, upload_id, sample_pdf).status_code == 204
+
+    assert not os.path.exists(expired_dir)
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from conftest import upload
+
+
+def pipeline(client, pdf, **step):
+    return client.post('/pipeline', data={
+        'file': upload(pdf),
+        'operations': json.dumps([dict({'op': 'watermark', 'watermarkText': 'DRAFT'}, **step)])
+    })
+
+
+@pytest.mark.parametrize('step', [
+    {'watermarkText': 5},
+    {'position': ['center']},
+    {'selectedPages': 2},
+    {'transparency': 'nan'},
+    {'transparency': 1.5},
+    {'rotation': 'inf'},
+    {'fontSize': 1e400},
+    {'fontSize': 12.5},
+    {'imageSize': True},
+    {'layer': 'middle'},
+])
+def test_pipeline_rejects_invalid_watermark_options(client, sample_pdf, step):
+    response = pipeline(client, sample_pdf, **step)
+
+    assert response.status_code == 400, response.data
+
+
+@pytest.mark.parametrize('selected_pages', ['0', '99', '3-1', '2-', '', '-1'])
+def test_pipeline_rejects_pages_outside_document(client, sample_pdf, selected_pages):
+    response = pipeline(client, sample_pdf, selectedPages=selected_pages)
+
+    assert response.status_code == 400, response.data
+
+
+def test_pipeline_accepts_numbers_as_text_and_json(client, sample_pdf):
+    response = pipeline(client, sample_pdf, transparency='0.5', rotation=-30, fontSize='40', imageSize=80.0,
+                        selectedPages='1,3')
+
+    assert response.status_code == 200, response.data
+    assert response.data.startswith(b'%PDF')
+
+
+@pytest.mark.parametrize('selected_pages', ['2-', '', '-1', '0', '3-1', '1,,2'])
+def test_watermark_pdf_rejects_malformed_pages(client, sample_pdf, selected_pages):
+    response = client.post('/watermark-pdf', data={
+        'file': upload(sample_pdf), 'watermarkText': 'DRAFT', 'selectedPages': selected_pages
+    })
+
+    assert response.status_code == 400, response.data
+    assert response.get_json() == {'error': 'Invalid page selection'}
+
+
+def test_watermark_pdf_checks_pages_before_opening_document(client):
+    response = client.post('/watermark-pdf', data={
+        'file': upload(b'not a pdf'), 'watermarkText': 'DRAFT', 'selectedPages': '2-'
+    })
+
+    assert response.status_code == 400, response.data
@@ -0,0 +1,270 @@
+import errno
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+# Resumable uploads of large documents, sent in numbered chunks that may
+# arrive in any order, from any number of requests, to any server process.
+# Each upload is a directory holding the file, preallocated at its full size,
+# a map with one byte per chunk that is set once the chunk has been written
+# and its checksum checked, and a session.json file. Finished uploads are
+# moved into the document store under the same id. Uploads that receive no
+# chunks for ttl seconds expire: they are no longer found, and are removed by a
+# sweep that runs at most once per cleanup_interval, whenever an upload is used.
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+SESSION_FILE = 'session.json'
+PART_FILE = 'upload.part'
+RECEIVED_FILE = 'received'
+COPY_CHUNK_BYTES = 1024 * 1024
+RECEIVED = b'\x01'
+
+
+def _read_session(upload_dir):
+    try:
+        with open(os.path.join(upload_dir, SESSION_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _preallocate(fd, size):
+    # Reserves the space up front, so a full disk shows up when the upload
+    # is created rather than halfway through it. File systems that cannot
+    # reserve space get a sparse file of the full size instead.
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+    os.ftruncate(fd, size)
+
+
+class UploadSessions:
+    def __init__(self, root=None, ttl=3600, chunk_bytes=8 * 1024 * 1024, max_bytes=8 * 1024 * 1024 * 1024,
+                 cleanup_interval=60):
+        self.root = root or os.path.join(tempfile.gettempdir(), 'zenpdf-uploads')
+        self.ttl = ttl
+        self.chunk_bytes = chunk_bytes
+        self.max_bytes = max_bytes
+        self.cleanup_interval = cleanup_interval
+        self._last_cleanup = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def upload_dir(self, upload_id):
+        if not upload_id or not UPLOAD_ID_PATTERN.match(upload_id):
+            return None
+        return os.path.join(self.root, upload_id)
+
+    def create(self, file_name, size, chunk_size=None, sha256=None):
+        # Returns the new upload's status, or None when the uploads in
+        # progress would take more than max_bytes of disk
+        self.cleanup()
+        chunk_size = chunk_size or self.chunk_bytes
+        with self._lock:
+            if self._reserved_bytes() + size > self.max_bytes:
+                return None
+            upload_id = uuid.uuid4().hex
+            upload_dir = self.upload_dir(upload_id)
+            os.makedirs(upload_dir)
+            try:
+                chunks = max(1, math.ceil(size / chunk_size))
+                fd = os.open(os.path.join(upload_dir, PART_FILE), os.O_WRONLY | os.O_CREAT, 0o600)
+                try:
+                    _preallocate(fd, size)
+                finally:
+                    os.close(fd)
+                with open(os.path.join(upload_dir, RECEIVED_FILE), 'wb') as f:
+                    f.write(bytes(chunks))
+                session = {
+                    'id': upload_id,
+                    'fileName': file_name,
+                    'bytes': size,
+                    'chunkSize': chunk_size,
+                    'chunks': chunks,
+                    'sha256': sha256,
+                    'createdAt': time.time(),
+                }
+                with open(os.path.join(upload_dir, SESSION_FILE), 'w') as f:
+                    json.dump(session, f)
+            except Exception:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+                raise
+        return self.status(upload_id)
+
+    def session(self, upload_id):
+        # The upload's session, or None when it is unknown or has expired
+        self.cleanup()
+        upload_dir = self.upload_dir(upload_id)
+        if upload_dir is None or self._expired(upload_dir):
+            return None
+        return _read_session(upload_dir)
+
+    def _expired(self, upload_dir):
+        try:
+            return time.time() - os.path.getmtime(upload_dir) > self.ttl
+        except OSError:
+            return True
+
+    def status(self, upload_id):
+        # The upload's session with the chunks still missing, or None when it
+        # is unknown, has expired or has been finished
+        session = self.session(upload_id)
+        if session is None:
+            return None
+        try:
+            with open(os.path.join(self.upload_dir(upload_id), RECEIVED_FILE), 'rb') as f:
+                received = f.read()
+        except OSError:
+            return None
+        missing = [index for index, flag in enumerate(received) if flag != RECEIVED[0]]
+        last_used = os.path.getmtime(self.upload_dir(upload_id))
+        return dict(session, missing=missing, complete=not missing, expiresAt=last_used + self.ttl)
+
+    def chunk_length(self, session, index):
+        # Length of chunk index, or None when there is no such chunk
+        if not 0 <= index < session['chunks']:
+            return None
+        return min(session['chunkSize'], session['bytes'] - index * session['chunkSize'])
+
+    def write_chunk(self, session, index, stream, sha256):
+        # Writes chunk index from stream at its place in the file. Returns an
+        # error message, or None once the chunk is written and its SHA-256
+        # matches. A chunk may be sent again, for example after a failed try.
+        upload_dir = self.upload_dir(session['id'])
+        if self._expired(upload_dir):
+            return 'Upload not found'
+        length = self.chunk_length(session, index)
+        offset = index * session['chunkSize']
+        digest = hashlib.sha256()
+        try:
+            fd = os.open(os.path.join(upload_dir, PART_FILE), os.O_WRONLY)
+        except FileNotFoundError:
+            return 'Upload not found'
+        try:
+            written = 0
+            while written < length:
+                data = stream.read(min(COPY_CHUNK_BYTES, length - written))
+                if not data:
+                    break
+                digest.update(data)
+                view = memoryview(data)
+                while view:
+                    count = os.pwrite(fd, view, offset + written)
+                    view = view[count:]
+                    written += count
+        finally:
+            os.close(fd)
+        if written != length:
+            return f'Chunk {index} is {length} bytes, {written} were received'
+        if digest.hexdigest() != sha256.lower():
+            return f'Checksum of chunk {index} does not match'
+
+        # Marked only once the data is in place, so a chunk that failed
+        # halfway stays missing
+        try:
+            fd = os.open(os.path.join(upload_dir, RECEIVED_FILE), os.O_WRONLY)
+        except FileNotFoundError:
+            # Removed while the chunk was being written
+            return 'Upload not found'
+        try:
+            os.pwrite(fd, RECEIVED, index)
+        finally:
+            os.close(fd)
+        os.utime(upload_dir)
+        return None
+
+    def finish(self, upload_id, documents):
+        # Checks the whole file against the SHA-256 given when the upload was
+        # created, if any, and moves it into documents under the upload's id.
+        # Returns (document meta, None), or (None, error message).
+        status = self.status(upload_id)
+        if status is None:
+            return None, 'Upload not found'
+        if status['missing']:
+            return None, f"{len(status['missing'])} chunks are missing"
+        upload_dir = self.upload_dir(upload_id)
+        part_path = os.path.join(upload_dir, PART_FILE)
+        if status['sha256']:
+            digest = hashlib.sha256()
+            with open(part_path, 'rb') as f:
+                for data in iter(lambda: f.read(COPY_CHUNK_BYTES), b''):
+                    digest.update(data)
+            if digest.hexdigest() != status['sha256'].lower():
+                return None, 'Checksum of the uploaded file does not match'
+
+        # Taken out of the upload directory first, so that only one of two
+        # concurrent requests to finish the upload gets the file
+        finished_path = os.path.join(self.root, f"{upload_id}.pdf")
+        try:
+            os.rename(part_path, finished_path)
+        except FileNotFoundError:
+            return None, 'Upload not found'
+        try:
+            meta = documents.put_file(finished_path, status['fileName'], document_id=upload_id)
+        except Exception:
+            # Put back, so that finishing can be tried again
+            if os.path.exists(finished_path):
+                os.rename(finished_path, part_path)
+            raise
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return meta, None
+
+    def remove(self, upload_id):
+        upload_dir = self.upload_dir(upload_id)
+        if upload_dir is None or not os.path.isdir(upload_dir):
+            return False
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return True
+
+    def _reserved_bytes(self):
+        total = 0
+        for name in os.listdir(self.root):
+            upload_dir = self.upload_dir(name)
+            if upload_dir is None or self._expired(upload_dir):
+                continue
+            session = _read_session(upload_dir)
+            if session is not None:
+                total += session['bytes']
+        return total
+
+    def cleanup(self, force=False):
+        # Removes uploads that received no chunk for more than ttl seconds.
+        # Runs at most once per cleanup_interval.
+        now = time.time()
+        if not force and now - self._last_cleanup < self.cleanup_interval:
+            return 0
+        self._last_cleanup = now
+
+        removed = 0
+        for name in os.listdir(self.root):
+            upload_dir = self.upload_dir(name)
+            if upload_dir is None:
+                continue
+            try:
+                last_used = os.path.getmtime(upload_dir)
+            except OSError:
+                continue
+            if now - last_used > self.ttl:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+                removed += 1
+        return removed
+
+    def stats(self):
+        uploads = sum(1 for name in os.listdir(self.root) if self.upload_dir(name) is not None)
+        return {
+            'uploads': uploads,
+            'reservedBytes': self._reserved_bytes(),
+            'maxBytes': self.max_bytes,
+            'chunkSize': self.chunk_bytes,
+            'ttl': self.ttl,
+        }
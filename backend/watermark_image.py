@@ -0,0 +1,142 @@
+import io
+import zlib
+
+from PIL import Image
+from reportlab.pdfbase.pdfdoc import PDFImageXObject
+
+# Image watermarks are prepared once per image and placed size: scaled down
+# to the resolution they are drawn at and encoded as they will be stored in
+# the PDF. Opaque images become JPEG, images with transparency are stored
+# with Flate and a soft mask so that their edges stay exact.
+#
+# Image sizes are given in points per source pixel at 100%, so a watermark
+# drawn at image_size percent covers image_size / 100 points per pixel.
+POINTS_PER_INCH = 72.0
+COLOR_SPACES = {'L': 'DeviceGray', 'RGB': 'DeviceRGB', 'CMYK': 'DeviceCMYK'}
+
+
+class PreparedImage:
+    def __init__(self, name, source_size, size, color_space, data, filters, smask=None, decode=None):
+        self.name = name
+        # The uploaded image's size in pixels, which the stamp layout uses
+        self.source_size = source_size
+        self.size = size
+        self.color_space = color_space
+        self.data = data
+        self.filters = filters
+        # Flate encoded alpha channel, or None for opaque images
+        self.smask = smask
+        self.decode = decode
+
+    def __len__(self):
+        # Lets the image sit in a StampCache, which is bounded in bytes
+        return len(self.data) + len(self.smask or b'')
+
+    def _xobject(self, name, color_space, data, filters):
+        xobject = PDFImageXObject(name)
+        xobject.width, xobject.height = self.size
+        xobject.bitsPerComponent = 8
+        xobject.colorSpace = color_space
+        xobject.streamContent = data
+        xobject._filters = filters
+        xobject.mask = None
+        return xobject
+
+    def draw(self, c, x, y, width, height):
+        # Like canvas.drawImage, but from the encoded data. drawImage would
+        # decode the image again to name it and compress it again to store it.
+        doc = c._doc
+        if not doc.hasForm(self.name):
+            xobject = self._xobject(self.name, self.color_space, self.data, self.filters)
+            xobject._decode = self.decode
+            if self.smask is not None:
+                mask = self._xobject(f"{self.name}Mask", 'DeviceGray', self.smask, ('FlateDecode',))
+                mask._decode = [0, 1]
+                xobject.smask = doc.Reference(mask, doc.getXObjectName(mask.name))
+            doc.addForm(self.name, xobject)
+
+        c._currentPageHasImages = 1
+        c.saveState()
+        c.translate(x, y)
+        c.scale(width, height)
+        c._code.append(f"/{doc.getXObjectName(self.name)} Do")
+        c.restoreState()
+        c._formsinuse.append(self.name)
+
+
+def _alpha(img):
+    # Returns the image without its alpha channel and the alpha channel,
+    # which is None when every pixel is opaque
+    if img.mode == 'P':
+        img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+    elif img.mode in ('1', 'I', 'I;16', 'F'):
+        img = img.convert('L')
+    elif img.mode not in ('L', 'LA', 'RGB', 'RGBA', 'CMYK'):
+        img = img.convert('RGB')
+
+    if img.mode not in ('LA', 'RGBA'):
+        return img, None
+    alpha = img.getchannel('A')
+    img = img.convert(img.mode[:-1])
+    if alpha.getextrema() == (255, 255):
+        return img, None
+    return img, alpha
+
+
+def _jpeg_decode(mode):
+    # CMYK JPEGs are written with inverted channels, as Adobe applications do
+    return [1, 0] * 4 if mode == 'CMYK' else None
+
+
+def _encode(img, alpha, jpeg_quality):
+    # Returns (color space, data, filters, soft mask, decode) for an image and
+    # its alpha channel. jpeg_quality=None stores an opaque image with Flate too.
+    color_space = COLOR_SPACES[img.mode]
+    if alpha is None and jpeg_quality is not None:
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=jpeg_quality, optimize=True)
+        return color_space, buffer.getvalue(), ('DCTDecode',), None, _jpeg_decode(img.mode)
+    smask = zlib.compress(alpha.tobytes()) if alpha is not None else None
+    return color_space, zlib.compress(img.tobytes()), ('FlateDecode',), smask, None
+
+
+def _encoded_size(encoded):
+    return len(encoded[1]) + len(encoded[3] or b'')
+
+
+def prepare_image(content, digest, image_size=100, dpi=150, jpeg_quality=90):
+    # Returns a PreparedImage for the image bytes in content, whose SHA-256 is
+    # digest, drawn at image_size percent. dpi=0 keeps every source pixel.
+    img = Image.open(io.BytesIO(content))
+    source_size = img.size
+    size = source_size
+    # Pixels per source pixel needed for dpi at the placed size
+    ratio = image_size / 100.0 * dpi / POINTS_PER_INCH
+    if dpi > 0 and ratio < 1:
+        size = (max(1, round(source_size[0] * ratio)), max(1, round(source_size[1] * ratio)))
+
+    if size == source_size and img.format == 'JPEG' and img.mode in COLOR_SPACES:
+        # Already stored the way it would be encoded
+        return PreparedImage(
+            f"ZenImage{digest[:16]}x{size[0]}x{size[1]}", source_size, size, COLOR_SPACES[img.mode], content,
+            ('DCTDecode',), decode=_jpeg_decode(img.mode)
+        )
+
+    if img.format == 'JPEG':
+        # Let the JPEG decoder do most of the scaling
+        img.draft(img.mode, size)
+    img, alpha = full, full_alpha = _alpha(img)
+    if img.size != size:
+        img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    if alpha is not None and alpha.size != size:
+        alpha = alpha.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    encoded = _encode(img, alpha, jpeg_quality)
+
+    if full.size == source_size and (size != source_size or alpha is None) and _encoded_size(encoded) > len(content):
+        # Flat artwork from a PNG can take fewer bytes with Flate at full
+        # size than as JPEG, or once scaling has smoothed its edges into many
+        # new colours. Keep whichever is smaller; this happens once per image.
+        full_encoded = _encode(full, full_alpha, None)
+        if _encoded_size(full_encoded) < _encoded_size(encoded):
+            size, encoded = source_size, full_encoded
+    return PreparedImage(f"ZenImage{digest[:16]}x{size[0]}x{size[1]}", source_size, size, *encoded)
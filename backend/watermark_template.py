@@ -0,0 +1,145 @@
+import io
+import string
+
+from reportlab.lib.pagesizes import letter
+
+# Text watermarks that differ from page to page, such as
+# "Copy for {user} - page {n} of {total}". The whole stamp document is
+# rendered in one ReportLab pass, one stamp page per watermarked page.
+# Text that is the same on every page is drawn once into a Form XObject;
+# each page only adds the glyphs of its page number.
+PAGE_FIELDS = ('n', 'page')
+TOTAL_FIELD = 'total'
+FONT_NAME = 'Helvetica-Bold'
+
+
+def stamp_position(position, page_width, page_height, width, height):
+    # Lower-left corner of a width x height stamp at one of the watermark positions
+    if position == 'top-left':
+        return 50, page_height - 50 - height
+    if position == 'top-right':
+        return page_width - 50 - width, page_height - 50 - height
+    if position == 'bottom-left':
+        return 50, 50
+    if position == 'bottom-right':
+        return page_width - 50 - width, 50
+    return (page_width - width) / 2, (page_height - height) / 2
+
+
+def parse_template(template, fields=None):
+    # Splits a template into runs of ('text', text), ('page', None) and
+    # ('total', None). Named fields are filled in from fields right away.
+    # Returns (runs, None), or (None, error message).
+    fields = fields or {}
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError as e:
+        return None, f'Invalid watermark template: {str(e)}'
+
+    runs = []
+    for literal, name, format_spec, conversion in parsed:
+        if literal:
+            runs.append(('text', literal))
+        if name is None:
+            continue
+        if format_spec or conversion:
+            return None, f'Formatting is not supported in template field {name}'
+        if name in PAGE_FIELDS:
+            runs.append(('page', None))
+        elif name == TOTAL_FIELD:
+            runs.append(('total', None))
+        elif name in fields:
+            runs.append(('text', str(fields[name])))
+        else:
+            return None, f'Unknown template field: {name}'
+    if not runs:
+        return None, 'Watermark template is empty'
+    return runs, None
+
+
+class WatermarkTemplate:
+    def __init__(self, runs, font_size=50, opacity=0.3, rotation=45, position='center', first_page=0, total=None):
+        self.runs = runs
+        self.font_size = font_size
+        self.opacity = opacity
+        self.rotation = rotation
+        self.position = position
+        # Number of the pages before the first page stamped, and the page
+        # count to print, for documents that are watermarked in page ranges
+        self.first_page = first_page
+        self.total = total
+
+    def for_range(self, start, total):
+        return WatermarkTemplate(
+            self.runs, self.font_size, self.opacity, self.rotation, self.position, self.first_page + start, total
+        )
+
+    def _layout(self, c, page_text, total_text):
+        # Returns the line's width and (x offset, text, is the page number) per run
+        texts = []
+        for kind, text in self.runs:
+            is_page = kind == 'page'
+            if is_page:
+                text = page_text
+            elif kind == 'total':
+                text = total_text
+            if texts and not is_page and not texts[-1][1]:
+                # Neighbouring static text is drawn as one string
+                texts[-1][0] += text
+            else:
+                texts.append([text, is_page])
+
+        runs = []
+        x = 0
+        for text, is_page in texts:
+            runs.append((x, text, is_page))
+            x += c.stringWidth(text, FONT_NAME, self.font_size)
+        return x, runs
+
+    def _draw(self, c, page_size, width, runs, variable):
+        # Draws the static or the variable runs of a line, rotated about its center
+        x, y = stamp_position(self.position, page_size[0], page_size[1], width, self.font_size)
+        c.saveState()
+        c.setFont(FONT_NAME, self.font_size)
+        # Opacity is set by the page; ReportLab does not give forms the
+        # graphics states they would need to set it themselves
+        c.setFillColorRGB(0.5, 0.5, 0.5)
+        c.translate(x + width / 2, y + self.font_size / 2)
+        c.rotate(self.rotation)
+        for offset, text, is_page in runs:
+            if is_page == variable and text:
+                c.drawString(offset - width / 2, -self.font_size / 2, text)
+        c.restoreState()
+
+    def render(self, page_numbers, total, sizes):
+        # Returns a PDF whose page k is the stamp for page number page_numbers[k],
+        # drawn for a page of size sizes[k]
+        from reportlab.pdfgen import canvas
+
+        total_text = str(total)
+        buffer = io.BytesIO()
+        c = canvas.Canvas(buffer, pagesize=sizes[0] if sizes else letter)
+
+        # Where the static text goes depends on the page size and on the
+        # width of the page number, so pages share a form per pair of those
+        pages = []
+        forms = {}
+        for number, size in zip(page_numbers, sizes):
+            page_text = str(number)
+            width, runs = self._layout(c, page_text, total_text)
+            key = (size, width)
+            if key not in forms:
+                forms[key] = f"ZenTemplate{len(forms)}"
+                c.beginForm(forms[key], 0, 0, size[0], size[1])
+                self._draw(c, size, width, runs, variable=False)
+                c.endForm()
+            pages.append((size, width, runs, forms[key]))
+
+        for size, width, runs, form in pages:
+            c.setPageSize(size)
+            c.setFillAlpha(self.opacity)
+            c.doForm(form)
+            self._draw(c, size, width, runs, variable=True)
+            c.showPage()
+        c.save()
+        return buffer.getvalue()